@@ -0,0 +1,90 @@
+"""
+EVOODec align - wavelength shift of spectra against a model spectrum
+
+A wavelength calibration offset s of the spectrometer moves every band of
+the sample: ABS(x) = MODEL(x-s). The shift is estimated on an evenly spaced
+x-axis, for a spectrum or a batch of spectra at once:
+
+    xcorrShift      peak of the FFT cross-correlation of the derivatives
+                    of the spectra, refined to a fraction of the grid step
+                    by a parabola through the peak, O(N log N)
+    newtonShift     Gauss-Newton step of the least squares shift,
+                    linearized around the current one, O(N)
+    shiftSpectra    spectra resampled at x+s (local cubic interpolation,
+                    one shift per spectrum), O(N)
+
+engine.alignSpectra uses the reconstruction of the deconvolution as the
+model and alternates fits and shifts.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+# >>> Spectra (n_points,) or (n_samples, n_points) on the evenly spaced
+# x-axis X (grid step step) evaluated at X+shift, one shift (nm) per
+# spectrum. Cubic Lagrange interpolation on the 4 nearest points; points
+# beyond the ends of the spectrum take the end values.
+def shiftSpectra(ABS,shift,step=1.0):
+    Y     = np.atleast_2d(np.asarray(ABS,dtype=float))
+    m,n   = Y.shape
+    u     = np.broadcast_to(np.asarray(shift,dtype=float)/step,(m,))
+    k     = np.floor(u).astype(int)
+    f     = (u-k)[:,None]
+
+    # Weights of the points k-1, k, k+1, k+2 around the fractional offset
+    W = [-f*(f-1)*(f-2)/6,(f+1)*(f-1)*(f-2)/2,-(f+1)*f*(f-2)/2,(f+1)*f*(f-1)/6]
+    idx = np.arange(n)[None,:]+k[:,None]
+    OUT = np.zeros((m,n))
+    for j,w in zip(range(-1,3),W):
+        OUT += w*np.take_along_axis(Y,np.clip(idx+j,0,n-1),axis=1)
+    return OUT.reshape(np.shape(ABS))
+
+
+# >>> Shift (nm) of the spectra ABS against the models MODEL (same shape)
+# from the peak of the cross-correlation of their derivatives, computed by
+# FFT (zero padded, so it is not circular). Lags are bounded by max_shift
+# (nm); the peak is refined by a parabola through its neighbours.
+def xcorrShift(ABS,MODEL,step=1.0,max_shift=None):
+    A   = np.diff(np.atleast_2d(np.asarray(ABS,dtype=float)),axis=1)
+    M   = np.diff(np.atleast_2d(np.asarray(MODEL,dtype=float)),axis=1)
+    A   = A-A.mean(axis=1,keepdims=True)
+    M   = M-M.mean(axis=1,keepdims=True)
+    n   = A.shape[1]
+
+    # Lags -lag..lag: padding to n+lag points keeps them free of wrap-around
+    lag = n-1 if max_shift is None else int(min(n-1,np.ceil(abs(max_shift/step))))
+    L   = 1 << int(np.ceil(np.log2(max(n+lag,2))))
+    C   = np.fft.irfft(np.fft.rfft(A,L,axis=1)*np.conj(np.fft.rfft(M,L,axis=1)),L,axis=1)
+    C   = np.concatenate([C[:,L-lag:],C[:,:lag+1]],axis=1)
+    k   = np.argmax(C,axis=1)
+    rows = np.arange(len(C))
+    km  = np.clip(k-1,0,C.shape[1]-1)
+    kp  = np.clip(k+1,0,C.shape[1]-1)
+    c0,cm,cp = C[rows,k],C[rows,km],C[rows,kp]
+    den = cm-2*c0+cp
+    with np.errstate(divide='ignore',invalid='ignore'):
+        frac = np.where((den < 0) & (km < k) & (kp > k),(cm-cp)/(2*den),0.0)
+    shift = (k-lag+frac)*step
+    if max_shift is not None:
+        shift = np.clip(shift,-abs(max_shift),abs(max_shift))
+    return shift.reshape(np.shape(ABS)[:-1])
+
+
+# >>> Gauss-Newton step (nm) of the shift of ABS towards MODEL: least
+# squares delta of ABS(x+delta) ~ ABS(x) + delta ABS'(x) = MODEL(x)
+def newtonShift(ABS,MODEL,step=1.0):
+    Y  = np.atleast_2d(np.asarray(ABS,dtype=float))
+    D  = np.gradient(Y,step,axis=1)
+    dd = np.sum(D**2,axis=1)
+    with np.errstate(divide='ignore',invalid='ignore'):
+        delta = np.where(dd > 0,np.sum((np.atleast_2d(MODEL)-Y)*D,axis=1)/dd,0.0)
+    return delta.reshape(np.shape(ABS)[:-1])
@@ -0,0 +1,272 @@
+"""
+EVOODec archive - memory-mapped storage for large collections of spectra
+
+An archive is a directory (<name>.evooarc) holding:
+    wavelength.npy : wavelength grid shared by all the samples (nm)
+    absorbance.npy : absorbances, shape (n_samples, n_points), float64 or
+                     float32 (half the size, for the --float32 deconvolution)
+    index.csv      : one line per sample (";" separated):
+                     sample id (unique); source file; optical path
+                     length (cm)
+
+The absorbance matrix is memory-mapped: reading one sample or a slice of
+samples only touches the corresponding rows on disk.
+
+Usage (conversion of existing sample files):
+    python evoodec.py archive season.evooarc spectra/
+    python evoodec.py -r pigments/pigments.csv season.evooarc -o results.csv
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import shutil
+import argparse
+
+import numpy as np
+
+import engine
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+ARCHIVE_EXT = '.evooarc'
+WAVELENGTH  = 'wavelength.npy'
+ABSORBANCE  = 'absorbance.npy'
+INDEX       = 'index.csv'
+
+
+# >>> Check if a path is a spectral archive
+def isArchive(path):
+    return (os.path.splitext(path.rstrip('/\\'))[1].lower() == ARCHIVE_EXT and
+            os.path.isfile(os.path.join(path,INDEX)))
+
+
+class Archive:
+
+    # Read access to a spectral archive
+    #   X     : shared wavelength grid (nm)
+    #   ABS   : memory-mapped absorbances, shape (n_samples, n_points)
+    #   names : sample ids (unique; archives written before ids were made
+    #           unique may repeat some, those cannot be selected by id)
+    #   files : source files
+    #   OPLEN : optical path lengths (cm)
+    def __init__(self,path):
+        if not isArchive(path):
+            raise Exception("%s is not a spectral archive!" % path)
+        self.path = path
+        self.X    = np.load(os.path.join(path,WAVELENGTH))
+        self.ABS  = np.load(os.path.join(path,ABSORBANCE),mmap_mode='r')
+
+        names,files,oplen = [],[],[]
+        with open(os.path.join(path,INDEX),'r',encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('#') or not line.strip(): continue
+                name,source,op = line.rstrip('\n').split(';')
+                names.append(name)
+                files.append(source)
+                oplen.append(float(op))
+        self.names = names
+        self.files = files
+        self.OPLEN = np.array(oplen)
+        self._pos  = {}
+        self._dup  = set()
+        for i,name in enumerate(names):
+            if name in self._pos: self._dup.add(name)
+            self._pos.setdefault(name,i)
+
+        if(self.ABS.shape != (len(names),len(self.X))):
+            raise Exception("Archive %s is corrupted!" % path)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Row indices for a selection: an index, a slice, a sample id or a
+    # list of them (None selects all the samples)
+    def indices(self,select=None):
+        if select is None:
+            return np.arange(len(self))
+        if isinstance(select,slice):
+            return np.arange(len(self))[select]
+        if isinstance(select,(str,int,np.integer)):
+            select = [select]
+        idx = []
+        for s in select:
+            if isinstance(s,str):
+                if s not in self._pos:
+                    raise Exception("Sample %s not found in archive %s!" % (s,self.path))
+                if s in self._dup:
+                    raise Exception("Sample id %s is not unique in archive %s, "
+                                    "select it by index!" % (s,self.path))
+                idx.append(self._pos[s])
+            else:
+                idx.append(int(s))
+        return np.array(idx,dtype=int)
+
+    # Read a batch of samples (engine.Spectrum with one row per sample)
+    def read(self,select=None):
+        idx = self.indices(select)
+        if(len(idx) and (idx == np.arange(idx[0],idx[-1]+1)).all()):
+            ABS = np.array(self.ABS[idx[0]:idx[-1]+1])   # contiguous rows
+        else:
+            ABS = np.array(self.ABS[idx])
+        return engine.Spectrum(self.X,ABS.reshape(len(idx),len(self.X)),self.path,
+                               names=[self.names[i] for i in idx],
+                               OPLEN=self.OPLEN[idx],
+                               files=[self.files[i] for i in idx],
+                               members=idx.tolist())
+
+    # Read a single sample (engine.Spectrum of its source file)
+    def spectrum(self,key):
+        i = self.indices(key)[0]
+        return engine.Spectrum(self.X,np.array(self.ABS[i]),self.files[i],
+                               OPLEN=self.OPLEN[i])
+
+
+class ArchiveWriter:
+
+    # Sequential writer of a spectral archive. Spectra are streamed to disk
+    # as they are added, so the collection never needs to fit in memory.
+    # Sample ids are kept unique: a repeated id (e.g. evoo_test.csv and
+    # evoo_test.xlsx) gets the suffix ~2, ~3, ...
+    #   path  : archive directory (created)
+    #   X     : shared wavelength grid (nm)
+    #   dtype : storage of the absorbances ('<f8' or '<f4')
+    def __init__(self,path,X,overwrite=False,dtype='<f8'):
+        if os.path.exists(path):
+            if not overwrite:
+                raise Exception("%s already exists!" % path)
+            shutil.rmtree(path)
+        os.makedirs(path)
+        self.path  = path
+        self.X     = np.asarray(X,dtype=float)
+        self.count = 0
+        self.dtype = np.dtype(dtype).str
+        self._used = set()
+        np.save(os.path.join(path,WAVELENGTH),self.X)
+        self._raw   = open(os.path.join(path,ABSORBANCE+'.tmp'),'wb')
+        self._index = open(os.path.join(path,INDEX),'w',encoding='utf-8')
+        self._index.write('#Sample;File;Optical path length (cm)\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    # Add one spectrum (n_points,) or a batch of spectra (n_samples, n_points)
+    # sampled on the archive grid
+    def add(self,ABS,names,source='',OPLEN=1.0):
+        ABS = np.atleast_2d(np.asarray(ABS,dtype=self.dtype))
+        if isinstance(names,str): names = [names]
+        if(ABS.shape != (len(names),len(self.X))):
+            raise Exception("Spectra do not match the archive grid!")
+        OPLEN = np.broadcast_to(np.asarray(OPLEN,dtype=float),(len(names),))
+        self._raw.write(np.ascontiguousarray(ABS).tobytes())
+        for name,op in zip(names,OPLEN):
+            name   = str(name).replace(';',',').replace('\n',' ')
+            source = str(source).replace(';',',').replace('\n',' ')
+            if name in self._used:
+                k = 2
+                while '%s~%d' % (name,k) in self._used: k += 1
+                name = '%s~%d' % (name,k)
+            self._used.add(name)
+            self._index.write('%s;%s;%r\n' % (name,source,float(op)))
+        self.count += len(names)
+
+    # Write the .npy header and move the data after it
+    def close(self):
+        if self._raw is None: return
+        self._raw.close()
+        self._index.close()
+        raw = os.path.join(self.path,ABSORBANCE+'.tmp')
+        with open(os.path.join(self.path,ABSORBANCE),'wb') as out:
+            np.lib.format.write_array_header_1_0(out,
+                {'descr':self.dtype,'fortran_order':False,
+                 'shape':(self.count,len(self.X))})
+            with open(raw,'rb') as f:
+                shutil.copyfileobj(f,out)
+        os.remove(raw)
+        self._raw = None
+
+
+# >>> Convert sample files (.csv, .xls, .xlsx) to a spectral archive.
+# All the spectra are stored on the grid X (default: the grid of the first
+# file); spectra sampled on a different grid are interpolated on it, files
+# not covering it are skipped. With wide=True every column of the CSV files
+# is a separate sample. With float32=True the absorbances are stored in
+# single precision. Returns the number of samples written.
+def convert(files,path,X=None,OPLEN=1.0,overwrite=False,log=None,wide=False,
+    float32=False):
+    writer = None
+    try:
+        for filename in files:
+            try:
+                evoo = engine.loadEVOO(filename,wide=wide)
+            except Exception as e:
+                engine._log(log,"Skipping %s: %s\n" % (filename,e))
+                continue
+            if X is None:
+                X = evoo.X
+            if writer is None:
+                writer = ArchiveWriter(path,X,overwrite,'<f4' if float32 else '<f8')
+            ABS = evoo.ABS
+            if not np.array_equal(evoo.X,writer.X):
+                if(writer.X.min() < evoo.X_LIM[0] or writer.X.max() > evoo.X_LIM[1]):
+                    engine._log(log,"Skipping %s: it does not cover the archive grid\n" % filename)
+                    continue
+                ABS = engine.interpolateTo(evoo.X,ABS,writer.X)
+            if evoo.isBatch():
+                names = evoo.names
+            else:
+                names = os.path.splitext(os.path.basename(filename))[0]
+            writer.add(ABS,names,os.path.abspath(filename),OPLEN)
+    finally:
+        if writer is not None: writer.close()
+    count = 0 if writer is None else writer.count
+    engine._log(log,"%d samples written to %s\n" % (count,path))
+    return count
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec archive',
+        description='Convert EVOO sample files to a memory-mapped spectral archive')
+    parser.add_argument('archive',help='archive to create (%s directory)' % ARCHIVE_EXT)
+    parser.add_argument('samples',nargs='+',
+        help='sample files, directories or glob patterns (.csv, .xls, .xlsx)')
+    parser.add_argument('--oplen',type=float,default=1.0,
+        help='optical path length in cm of the samples (default: %(default)s)')
+    parser.add_argument('--force',action='store_true',
+        help='overwrite an existing archive')
+    parser.add_argument('--wide',action='store_true',
+        help='CSV files hold one sample per column after the wavelength')
+    parser.add_argument('--float32',action='store_true',
+        help='store the absorbances in single precision')
+    return parser.parse_args(argv)
+
+
+# >>> Entry point of the archive conversion
+def main(argv=None):
+    import batch
+    args = parseArgs(argv)
+    log  = lambda msg: sys.stderr.write(msg)
+    if not args.archive.rstrip('/\\').lower().endswith(ARCHIVE_EXT):
+        sys.stderr.write("Archive name must end with %s!\n" % ARCHIVE_EXT)
+        return 1
+    files = [f for f in batch.findSamples(args.samples) if not isArchive(f)]
+    if not files:
+        sys.stderr.write("No sample files found!\n")
+        return 1
+    count = convert(files,args.archive,OPLEN=args.oplen,overwrite=args.force,
+                    log=log,wide=args.wide,float32=args.float32)
+    return 0 if count else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+EVOODec baseline - baseline models of absorption spectra
+
+Every model works on a spectrum (n_points,) or on a batch of spectra
+(n_samples, n_points) sharing the x-axis, vectorized over the samples, and
+costs O(n_points) per spectrum (per iteration for the iterative ones):
+
+    min         constant shift to the minimum of the spectrum
+    poly        polynomial under the spectrum: least squares fit, clipping
+                the spectrum to the fit until it stays below it
+    rubberband  lower convex hull of the spectrum
+    als         asymmetric least squares smoother (Eilers & Boelens, 2005),
+                a banded (pentadiagonal) Cholesky solve per iteration
+
+Scattering in cloudy oils adds a smooth, slowly varying offset to the
+absorbance: the models estimate it under the absorption bands, so it can
+be subtracted before the deconvolution. Alternatively the baseline can be
+fitted together with the pigments (see engine.fitSpectra), using the
+Legendre polynomials of this module as extra columns of the basis.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+MODELS = ('min','poly','rubberband','als')
+
+
+# >>> Legendre polynomials up to order on the range of X (mapped to [-1,1]),
+# shape (n_points, order+1)
+def legendre(X,order):
+    X = np.asarray(X,dtype=float)
+    span = X.max()-X.min()
+    t = 2*(X-X.min())/span-1 if span > 0 else np.zeros(len(X))
+    return np.polynomial.legendre.legvander(t,order)
+
+
+# >>> Constant baseline: minimum of every spectrum
+def minBaseline(ABS):
+    return np.min(ABS,axis=-1,keepdims=True)*np.ones(np.shape(ABS)[-1])
+
+
+# >>> Polynomial baseline of order: the spectrum is fitted by least squares
+# and clipped to the fit (points above it are absorption bands) until the
+# fit converges (Lieber & Mahadevan-Jansen, 2003)
+def polyBaseline(X,ABS,order=2,niter=100,tol=1E-6):
+    V    = legendre(X,order)
+    PINV = np.linalg.pinv(V)
+    Y    = np.atleast_2d(np.array(ABS,dtype=float))
+    scale = np.abs(Y).max()
+    for it in range(niter):
+        FIT = np.dot(np.dot(Y,PINV.T),V.T)
+        NEW = np.minimum(Y,FIT)
+        if(np.abs(NEW-Y).max() <= tol*scale):
+            break
+        Y = NEW
+    return FIT.reshape(np.shape(ABS))
+
+
+# >>> Indices of the previous and next points of a mask (the point itself
+# included when inclusive), -1 and n when there is none
+def _neighbours(keep,inclusive=False):
+    m,n  = keep.shape
+    idx  = np.arange(n)
+    prev = np.maximum.accumulate(np.where(keep,idx,-1),axis=1)
+    next = np.minimum.accumulate(np.where(keep,idx,n)[:,::-1],axis=1)[:,::-1]
+    if not inclusive:
+        prev = np.concatenate([np.full((m,1),-1),prev[:,:-1]],axis=1)
+        next = np.concatenate([next[:,1:],np.full((m,1),n)],axis=1)
+    return prev,next
+
+
+# >>> Value at X of the segment between the points prev and next
+def _chord(X,Y,prev,next):
+    n  = len(X)
+    p  = np.clip(prev,0,n-1)
+    q  = np.clip(next,0,n-1)
+    yp = np.take_along_axis(Y,p,axis=1)
+    yq = np.take_along_axis(Y,q,axis=1)
+    dx = X[q]-X[p]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        t = np.where(dx != 0,(X-X[p])/dx,0.0)
+    return yp+(yq-yp)*t
+
+
+# >>> Rubber-band baseline: lower convex hull of every spectrum, by the
+# monotone chain algorithm run on all the spectra at once. Every spectrum
+# has its own stack of hull points (one row of the flat arrays SX, SY, SI;
+# top is the flat position of the next free slot) and points are popped
+# while any of the stacks turns clockwise. The hull is interpolated
+# between its points.
+def rubberBand(X,ABS):
+    X     = np.asarray(X,dtype=float)
+    order = np.argsort(X)
+    x     = X[order]
+    Y     = np.atleast_2d(np.asarray(ABS,dtype=float))[:,order]
+    m,n   = Y.shape
+    base  = np.arange(m)*n
+
+    SX  = np.zeros(m*n)
+    SY  = np.zeros(m*n)
+    SI  = np.zeros(m*n,dtype=int)
+    top = base.copy()
+    for i in range(n):
+        yi = Y[:,i]
+        while True:
+            ok = top-base >= 2
+            if not ok.any():
+                break
+            t1 = top-1
+            t2 = np.where(ok,top-2,t1)
+            xa = SX[t2]
+            ya = SY[t2]
+            pop = ok & ((SX[t1]-xa)*(yi-ya) <= (SY[t1]-ya)*(x[i]-xa))
+            if not pop.any():
+                break
+            top -= pop
+        SX[top] = x[i]
+        SY[top] = yi
+        SI[top] = i
+        top += 1
+
+    keep = np.zeros((m,n),dtype=bool)
+    used = np.arange(n) < (top-base)[:,None]
+    keep[np.nonzero(used)[0],SI.reshape(m,n)[used]] = True
+    prev,next = _neighbours(keep,inclusive=True)
+    BASE = np.empty(Y.shape)
+    BASE[:,order] = _chord(x,Y,prev,next)
+    return BASE.reshape(np.shape(ABS))
+
+
+# >>> Solve the symmetric positive definite pentadiagonal systems A x = b,
+# one per row of b, by a LDL^T factorization vectorized over the rows:
+#   a0 : diagonal, shape (n,) or (m, n)
+#   a1 : first off-diagonal, shape (n-1,) or (m, n-1)
+#   a2 : second off-diagonal, shape (n-2,) or (m, n-2)
+#   b  : right-hand sides, shape (n,) or (m, n)
+def solvePenta(a0,a1,a2,b):
+    single = np.ndim(b) == 1
+    B  = np.atleast_2d(np.asarray(b,dtype=float))
+    m,n = B.shape
+    A0 = np.broadcast_to(a0,(m,n)).T
+    A1 = np.broadcast_to(a1,(m,n-1)).T
+    A2 = np.broadcast_to(a2,(m,max(n-2,0))).T
+
+    D  = np.empty((n,m))
+    L1 = np.zeros((n,m))
+    L2 = np.zeros((n,m))
+    for i in range(n):
+        d = A0[i].copy()
+        if(i >= 2):
+            L2[i] = A2[i-2]/D[i-2]
+            d    -= L2[i]**2*D[i-2]
+        if(i >= 1):
+            L1[i] = (A1[i-1]-L2[i]*D[i-2]*L1[i-1])/D[i-1] if i >= 2 else A1[i-1]/D[i-1]
+            d    -= L1[i]**2*D[i-1]
+        D[i] = d
+
+    Y = B.T.copy()
+    for i in range(1,n):
+        Y[i] -= L1[i]*Y[i-1]
+        if(i >= 2): Y[i] -= L2[i]*Y[i-2]
+    Y /= D
+    for i in range(n-2,-1,-1):
+        Y[i] -= L1[i+1]*Y[i+1]
+        if(i+2 < n): Y[i] -= L2[i+2]*Y[i+2]
+    return Y.T[0] if single else Y.T
+
+
+# >>> Asymmetric least squares baseline: smoother z minimizing
+#   sum w (y - z)^2 + lam sum (second difference of z)^2
+# with weights p above the baseline and 1-p below it, updated until they
+# do not change (Eilers & Boelens, 2005). The normal equations
+# (W + lam D^T D) z = W y are pentadiagonal.
+def alsBaseline(ABS,lam=1E5,p=0.01,niter=10):
+    Y   = np.atleast_2d(np.asarray(ABS,dtype=float))
+    m,n = Y.shape
+    if(n < 3):
+        return minBaseline(ABS)
+
+    # D^T D of the second differences
+    d0 = np.full(n,6.0)
+    d0[[0,-1]] = 1.0
+    d0[[1,-2]] = 5.0
+    d1 = np.full(n-1,-4.0)
+    d1[[0,-1]] = -2.0
+    d2 = np.ones(n-2)
+
+    W = np.ones((m,n))
+    for it in range(niter):
+        Z = solvePenta(W+lam*d0,lam*d1,lam*d2,W*Y)
+        NEW = np.where(Y > Z,p,1-p)
+        if np.array_equal(NEW,W):
+            break
+        W = NEW
+    return Z.reshape(np.shape(ABS))
+
+
+# >>> Baseline of a spectrum or a batch of spectra with a given model
+#   order    : order of the 'poly' model
+#   lam, p   : smoothness and asymmetry of the 'als' model
+def estimate(X,ABS,model='min',order=2,lam=1E5,p=0.01):
+    if(model == 'min'):
+        return minBaseline(ABS)
+    if(model == 'poly'):
+        return polyBaseline(X,ABS,order)
+    if(model == 'rubberband'):
+        return rubberBand(X,ABS)
+    if(model == 'als'):
+        return alsBaseline(ABS,lam,p)
+    raise Exception("Unknown baseline model '%s'!" % model)
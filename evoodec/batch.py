@@ -0,0 +1,378 @@
+"""
+EVOODec batch - command line deconvolution of many sample spectra
+
+Deconvolves every .csv/.xls/.xlsx file found in the given directories,
+files or glob patterns across a pool of worker processes and writes one
+consolidated results table (";" separated, one row per sample).
+
+Usage:
+    python evoodec.py -r pigments/pigments.csv spectra/ -j 4 -o results.csv
+    python evoodec.py -r pigments/pigments.csv spectra/ -j 4 --store results.db
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import glob
+import argparse
+
+import numpy as np
+
+import engine
+import baseline
+import archive
+import metrics
+from metrics import METRICS
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+EXTENSIONS = ['.csv','.xls','.xlsx']
+
+# Number of archive samples deconvolved by each task
+ARCHIVE_CHUNK = 256
+
+# Reference data and options of the worker process (set by initWorker)
+_REF  = None
+_OPTS = None
+_WIDE = False
+
+
+# >>> Collect sample files (and spectral archives) from directories, files
+# and glob patterns
+def findSamples(paths):
+    files = []
+    for path in paths:
+        if archive.isArchive(path):
+            found = [path]
+        elif os.path.isdir(path):
+            found = [os.path.join(path,f) for f in os.listdir(path)]
+        elif os.path.isfile(path):
+            found = [path]
+        else:
+            found = glob.glob(path)
+        found = [f for f in sorted(found) if archive.isArchive(f) or
+                 (os.path.isfile(f) and os.path.splitext(f)[1].lower() in EXTENSIONS)]
+        files += [f for f in found if f not in files]
+    return files
+
+
+# >>> Split the work in tasks: one per sample file, archives are split in
+# chunks of consecutive samples
+def makeTasks(files):
+    tasks = []
+    for f in files:
+        if archive.isArchive(f):
+            n = len(archive.Archive(f))
+            tasks += [(f,slice(i,min(i+ARCHIVE_CHUNK,n)))
+                      for i in range(0,n,ARCHIVE_CHUNK)]
+        else:
+            tasks.append((f,None))
+    return tasks
+
+
+# >>> Load the reference data once per worker process
+def initWorker(ref_file,opts,wide=False):
+    global _REF,_OPTS,_WIDE
+    _REF  = engine.loadRef(ref_file)
+    _OPTS = opts
+    _WIDE = wide
+
+
+# >>> Deconvolve one task (runs in the worker process).
+# Returns the rows of the results table and the metrics of the task.
+def processFile(task):
+    filename,select = task
+    with METRICS.collect() as m:
+        try:
+            evoo = engine.loadEVOO(filename,select=select,wide=_WIDE)
+            res  = engine.analyze(_REF,evoo,_OPTS)
+            rows = resultRows(res,files=evoo.files,members=evoo.members)
+        except Exception as e:
+            METRICS.inc('errors_total')
+            rows = errorRows(_REF,filename,e)
+    return rows,m.snapshot()
+
+
+# >>> Rows of the results table for a deconvolution result:
+# (sample id, file, R^2, concentrations over all the pigments of the
+# reference, error message, confidence intervals (low and high limits over
+# all the pigments) or None, (archive, index) of the sample or None). files
+# gives the source file of each sample of a batch (e.g. read from an
+# archive) instead of the file of the result, members the index of each
+# sample in the archive (the file of the result).
+def resultRows(res,name=None,files=None,members=None):
+    conc = res.concppmAll()
+    ci   = None if res.CI is None else res.CI.limitsAll(res.FILTER)
+    if(np.ndim(conc) == 1):
+        if name is None: name = os.path.basename(res.filename)
+        return [(name,res.filename,res.RSQ,conc,'',ci,None)]
+    if files is None: files = [res.filename]*len(res.names)
+    return [(name,files[i],res.RSQ[i],conc[i],'',
+             None if ci is None else (ci[0][i],ci[1][i]),
+             None if members is None else (res.filename,members[i]))
+            for i,name in enumerate(res.names)]
+
+def errorRows(ref,filename,error,name=None):
+    if name is None: name = os.path.basename(filename)
+    return [(name,filename,np.nan,np.full(len(ref.PIGMENTS),np.nan),str(error),None,None)]
+
+
+# >>> Deconvolve all the sample files, n_workers processes in parallel.
+# With wide=True every column of the CSV files is a separate sample.
+# The metrics of the workers are added to METRICS; events (a
+# metrics.EventLog) receives the time spent in each stage for every task.
+def runBatch(ref_file,files,opts,n_workers=None,log=None,wide=False,events=None):
+    tasks = makeTasks(files)
+    if n_workers is None: n_workers = os.cpu_count() or 1
+    n_workers = max(1,min(n_workers,len(tasks)))
+    if(n_workers == 1):
+        initWorker(ref_file,opts,wide)
+        results = [processFile(t) for t in tasks]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1,len(tasks)//(4*n_workers))
+        with ProcessPoolExecutor(max_workers=n_workers,initializer=initWorker,
+                                 initargs=(ref_file,opts,wide)) as pool:
+            results = list(pool.map(processFile,tasks,chunksize=chunksize))
+        for rr,snap in results:
+            METRICS.merge(snap)
+    if events is not None:
+        for (filename,select),(rr,snap) in zip(tasks,results):
+            events.write('task',file=filename,
+                         select=None if select is None else [select.start,select.stop],
+                         samples=len(rr),errors=sum(1 for row in rr if row[4]),
+                         stages=metrics.stageTimes(snap))
+    rows = [row for rr,snap in results for row in rr]
+    nerr = sum(1 for row in rows if row[4])
+    engine._log(log,"%d samples processed (%d files, %d errors, %d workers)\n"
+                % (len(rows),len(files),nerr,n_workers))
+    return rows
+
+
+# >>> Write the consolidated results table (";" separated). With ci=True
+# the low and high limits of the confidence intervals follow the
+# concentrations.
+def writeResults(rows,pigments,out,ci=False):
+    writeHeader(pigments,out,ci)
+    for row in rows:
+        writeRow(row,out,ci)
+
+def writeHeader(pigments,out,ci=False):
+    cols = ['%s (mg/kg)' % p for p in pigments]
+    if ci:
+        cols += ['%s low (mg/kg)' % p for p in pigments]
+        cols += ['%s high (mg/kg)' % p for p in pigments]
+    out.write('#Sample;File;R-square;%s;Error\n' % ';'.join(cols))
+
+def writeRow(row,out,ci=False):
+    name,filename,rsq,conc,err,lim,member = row
+    if ci:
+        if lim is None: lim = (np.full(len(conc),np.nan),)*2
+        conc = np.concatenate([conc,lim[0],lim[1]])
+    out.write('%s;%s;%.6f;%s;%s\n' % (name,filename,rsq,
+              ';'.join('%.4f' % c for c in conc),
+              err.replace(';',',').replace('\n',' ')))
+
+
+# >>> Select the pigments given by name (None means all)
+def pigmentFilter(ref,names):
+    if not names:
+        return None
+    names  = [n.strip() for n in names.split(',')]
+    unknown = [n for n in names if n not in ref.PIGMENTS]
+    if unknown:
+        raise Exception("Unknown pigments: %s" % ', '.join(unknown))
+    return np.array([p in names for p in ref.PIGMENTS])
+
+
+# >>> Command line arguments shared by the batch and the watch modes
+def addOptionArgs(parser):
+    parser.add_argument('-r','--ref',default=os.path.join('pigments','pigments.csv'),
+        help='pigments reference file (default: %(default)s)')
+    parser.add_argument('-o','--output',default='-',
+        help='results table, "-" for standard output (default)')
+    parser.add_argument('--xmin',type=float,default=None,
+        help='start of the spectral window (nm)')
+    parser.add_argument('--xmax',type=float,default=None,
+        help='end of the spectral window (nm)')
+    parser.add_argument('--oplen',type=float,default=1.0,
+        help='optical path length in cm (default: %(default)s)')
+    parser.add_argument('--baseline',action='store_true',
+        help='apply baseline correction')
+    parser.add_argument('--baseline-model',choices=baseline.MODELS,default=None,
+        help='baseline model, implies --baseline (default: min)')
+    parser.add_argument('--baseline-order',type=int,default=2,
+        help='order of the poly baseline (default: %(default)s)')
+    parser.add_argument('--als-lambda',type=float,default=1E5,
+        help='smoothness of the als baseline (default: %(default)s)')
+    parser.add_argument('--als-p',type=float,default=0.01,
+        help='asymmetry of the als baseline (default: %(default)s)')
+    parser.add_argument('--joint-baseline',type=int,default=None,metavar='ORDER',
+        help='fit a polynomial baseline of this order together with the pigments')
+    parser.add_argument('--savgol',type=int,default=None,metavar='POINTS',
+        help='Savitzky-Golay filter of the spectra and of the reference with '
+             'a window of this (odd) number of points (default: none)')
+    parser.add_argument('--savgol-order',type=int,default=2,
+        help='order of the Savitzky-Golay polynomial (default: %(default)s)')
+    parser.add_argument('--savgol-deriv',type=int,default=0,choices=[0,1,2],
+        help='deconvolve the smoothed spectra (0) or their first or second '
+             'derivative (default: %(default)s)')
+    parser.add_argument('--align',action='store_true',
+        help='correct the wavelength shift of every sample against its '
+             'reconstruction')
+    parser.add_argument('--align-max',type=float,default=5.0,
+        help='largest wavelength shift in nm (default: %(default)s)')
+    parser.add_argument('--pigments',default=None,
+        help='comma separated pigments used in the deconvolution (default: all)')
+    parser.add_argument('--nnls',action='store_true',
+        help='constrain concentrations to be non-negative')
+    parser.add_argument('--resample',choices=engine.Resampler.KINDS,default='spline',
+        help='kernel used to resample the samples on the reference x-axis '
+             '(default: %(default)s)')
+    parser.add_argument('--wide',action='store_true',
+        help='CSV files hold one sample per column after the wavelength '
+             '(column headers are the sample ids)')
+    parser.add_argument('--float32',action='store_true',
+        help='project the spectra in single precision (large batches, '
+             'fastest on float32 archives)')
+    parser.add_argument('--select',choices=engine.SELECT_CRITERIA,default=None,
+        help='select the pigments automatically: every subset of the pigments '
+             'is fitted and the best one by this criterion is kept')
+    parser.add_argument('--select-max',type=int,default=None,metavar='N',
+        help='largest number of pigments of the selected subsets (default: all)')
+    parser.add_argument('--ci',type=int,default=0,metavar='N',
+        help='confidence intervals of the concentrations from N replicates '
+             'of every spectrum (default: none)')
+    parser.add_argument('--ci-method',choices=engine.CI_METHODS,default='bootstrap',
+        help='replicates: resampled residuals (bootstrap) or noise and path '
+             'length errors (montecarlo) (default: %(default)s)')
+    parser.add_argument('--ci-level',type=float,default=0.95,
+        help='confidence level (default: %(default)s)')
+    parser.add_argument('--noise',type=float,default=None,
+        help='absorbance noise of the montecarlo replicates '
+             '(default: residual RMS of the fitting)')
+    parser.add_argument('--oplen-sd',type=float,default=0.0,
+        help='relative standard deviation of the optical path length '
+             '(default: %(default)s)')
+    parser.add_argument('--seed',type=int,default=None,
+        help='seed of the replicates, for reproducible intervals')
+    parser.add_argument('--ci-threads',type=int,default=1,
+        help='threads deconvolving the replicates of the samples of a file '
+             '(default: %(default)s)')
+    parser.add_argument('--metrics',default=None,
+        help='write the stage timings and counters to this file (Prometheus text)')
+    parser.add_argument('--metrics-log',default=None,
+        help='append structured (JSON lines) timing events to this file, '
+             '"-" for standard error')
+    parser.add_argument('--timings',action='store_true',
+        help='print the time spent in each stage on standard error')
+
+
+# >>> Command line argument of the results database (see store.py)
+def addStoreArgs(parser):
+    parser.add_argument('--store',default=None,metavar='DB',
+        help='also record the results in this SQLite database (created if missing)')
+
+# >>> Results database and run of the command line arguments: (store, run
+# id), or None if not asked
+def openStore(args,ref,opts,source):
+    if args.store is None:
+        return None
+    import store
+    db = store.ResultStore(args.store)
+    return db,db.addRun(ref,opts,args.ref,source,args.wide)
+
+
+# >>> Deconvolution options from the command line arguments
+def optionsFromArgs(args,ref):
+    return engine.Options(X_SEL_MIN=args.xmin,X_SEL_MAX=args.xmax,
+                          OPLEN=args.oplen,
+                          BASELINE=args.baseline_model or args.baseline,
+                          BASELINE_ORDER=args.baseline_order,
+                          ALS_LAMBDA=args.als_lambda,ALS_P=args.als_p,
+                          JOINT_BASELINE=args.joint_baseline,
+                          SG_WINDOW=args.savgol,SG_ORDER=args.savgol_order,
+                          SG_DERIV=args.savgol_deriv,
+                          ALIGN=args.align,ALIGN_MAX=args.align_max,
+                          FILTER=pigmentFilter(ref,args.pigments),
+                          SOLVER='nnls' if args.nnls else 'unconstrained',
+                          RESAMPLE=args.resample,CI=args.ci,
+                          CI_METHOD=args.ci_method,CI_LEVEL=args.ci_level,
+                          NOISE=args.noise,OPLEN_SD=args.oplen_sd,
+                          SEED=args.seed,CI_WORKERS=args.ci_threads,
+                          SELECT=args.select,SELECT_MAX=args.select_max,
+                          FLOAT32=args.float32)
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec',
+        description='Batch deconvolution of EVOO absorption spectra')
+    parser.add_argument('samples',nargs='+',
+        help='sample files, directories or glob patterns (.csv, .xls, .xlsx)')
+    parser.add_argument('-j','--workers',type=int,default=None,
+        help='number of worker processes (default: number of CPUs)')
+    addStoreArgs(parser)
+    addOptionArgs(parser)
+    return parser.parse_args(argv)
+
+
+# >>> Entry point of the command line batch mode
+def main(argv=None):
+    args = parseArgs(argv)
+    log  = lambda msg: sys.stderr.write(msg)
+
+    files = findSamples(args.samples)
+    if not files:
+        sys.stderr.write("No sample files found!\n")
+        return 1
+
+    ref  = engine.loadRef(args.ref)
+    opts = optionsFromArgs(args,ref)
+
+    events = openEvents(args)
+    db     = openStore(args,ref,opts,'batch')
+    try:
+        rows = runBatch(args.ref,files,opts,args.workers,log,args.wide,events)
+        if(args.output == '-'):
+            writeResults(rows,ref.PIGMENTS,sys.stdout,opts.CI > 0)
+        else:
+            with open(args.output,'w') as out:
+                writeResults(rows,ref.PIGMENTS,out,opts.CI > 0)
+        if db is not None:
+            db[0].insertRows(db[1],rows)
+            log("%d results recorded in %s (run %d)\n" % (len(rows),args.store,db[1]))
+    finally:
+        if db is not None: db[0].close()
+        writeMetrics(args,events,log)
+    return 0
+
+
+# >>> Structured event log of the command line options (None if not asked)
+def openEvents(args):
+    if args.metrics_log is None:
+        return None
+    return metrics.EventLog(sys.stderr if args.metrics_log == '-' else args.metrics_log)
+
+
+# >>> Write the metrics asked on the command line and close the event log
+def writeMetrics(args,events=None,log=None):
+    if events is not None:
+        snap = METRICS.snapshot()
+        events.write('summary',stages=metrics.stageTimes(snap),
+                     counters=snap['counters'])
+        events.close()
+    if args.metrics:
+        METRICS.writePrometheus(args.metrics)
+    if args.timings:
+        engine._log(log,METRICS.report())
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""
+EVOODec bench - benchmark suite of loading, pre-processing, deconvolution
+and plotting
+
+Times the main functions of the engine on data seeded from the shipped
+pigments/pigments.csv and spectra/ files. Every benchmark is scaled along
+one axis at a time (wavelength step, number of pigments, batch size) around
+a default case; the synthetic data come from a seeded random generator, so
+runs are reproducible.
+
+Results are written as JSON (one record per benchmark, times in s per call)
+and can be compared to a previous run: benchmarks slower than the baseline
+by more than the tolerance are reported as regressions (exit status 1).
+
+Usage:
+    python cli.py bench -o results.json
+    python cli.py bench --quick --baseline results.json
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+
+import engine
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REF_FILE  = os.path.join(BENCH_DIR,'pigments','pigments.csv')
+EVOO_DIR  = os.path.join(BENCH_DIR,'spectra')
+
+# Scaling axes: wavelength step (nm), number of pigments, batch size.
+# The first value of each axis is the default case.
+SCALES = {'full'  : {'step'     : [1.0,0.5,0.25,0.1],
+                     'pigments' : [8,16,32,64],
+                     'batch'    : [1,10,100,1000,10000]},
+          'quick' : {'step'     : [1.0,0.25],
+                     'pigments' : [8,32],
+                     'batch'    : [1,100]}}
+
+
+class Case:
+
+    # Synthetic data set of a benchmark case
+    #   ref   : reference with n_pigments sampled every step nm
+    #   evoo  : batch of samples on the reference grid
+    #   fine  : the same samples on a grid shifted by half a step (they
+    #           must be resampled on the reference grid)
+    def __init__(self,ref,step,n_pigments,batch,rng):
+        X   = np.arange(ref.X_LIM[1],ref.X_LIM[0]-step/2,-step)
+        EPS = scaledBasis(ref,X,n_pigments,rng)
+        MW  = np.resize(ref.MW,n_pigments)
+        names = ['%s_%d' % (ref.PIGMENTS[i % len(ref.PIGMENTS)],i//len(ref.PIGMENTS))
+                 for i in range(n_pigments)]
+        self.ref = engine.Reference(X,EPS,names,MW,['gray']*n_pigments)
+
+        # Samples: random mixtures of the pigments plus noise
+        conc = engine.ppmToMol(rng.uniform(0.1,10,(batch,n_pigments)),MW)
+        conc[:,0] = engine.ppmToMol(rng.uniform(1E6,4E6,batch),MW[0])
+        ABS  = np.dot(conc,EPS.T)
+        ABS += rng.normal(0,1E-3*np.abs(ABS).max(),ABS.shape)
+        self.evoo = engine.Spectrum(X,ABS[0] if batch == 1 else ABS,'bench')
+
+        X_FINE = np.arange(ref.X_LIM[1]-step/2,ref.X_LIM[0],-step/2)
+        self.fine = engine.Spectrum(X_FINE,
+            engine.interpolateTo(X,self.evoo.ABS,X_FINE,'linear'),'bench')
+        self.opts = engine.Options(X_SEL_MIN=ref.X_LIM[0]+10,
+                                   X_SEL_MAX=ref.X_LIM[1]-10)
+
+
+# >>> Basis of n_pigments spectra on the x-axis X. The pigments of the
+# reference are repeated, shifted and scaled to get more of them.
+def scaledBasis(ref,X,n_pigments,rng):
+    order = np.argsort(ref.X)
+    EPS   = np.zeros((len(X),n_pigments))
+    for i in range(n_pigments):
+        k     = i % ref.EPS.shape[1]
+        shift = 0 if i < ref.EPS.shape[1] else rng.uniform(-20,20)
+        scale = 1 if i < ref.EPS.shape[1] else rng.uniform(0.5,2)
+        EPS[:,i] = scale*np.interp(X-shift,ref.X[order],ref.EPS[order,k])
+    return EPS
+
+
+# >>> Time a function: the number of calls per run is calibrated to last at
+# least min_time, the run is repeated and the times per call are returned
+def timeCall(func,repeat=5,min_time=0.05):
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number): func()
+        elapsed = time.perf_counter()-t0
+        if(elapsed >= min_time or number >= 1E6):
+            break
+        number *= 2 if elapsed == 0 else max(2,int(min_time/elapsed*1.2))
+    times = [elapsed/number]
+    for _ in range(repeat-1):
+        t0 = time.perf_counter()
+        for _ in range(number): func()
+        times.append((time.perf_counter()-t0)/number)
+    return number,np.array(times)
+
+
+class Suite:
+
+    # Collection of benchmark results
+    def __init__(self,repeat=5,min_time=0.05,select=None,log=None):
+        self.repeat   = repeat
+        self.min_time = min_time
+        self.select   = select
+        self.log      = log
+        self.results  = []
+
+    def run(self,name,func,**params):
+        if self.select and not any(s in name for s in self.select):
+            return
+        number,times = timeCall(func,self.repeat,self.min_time)
+        rec = {'name'   : name,
+               'params' : params,
+               'number' : number,
+               'repeat' : len(times),
+               'min'    : float(times.min()),
+               'median' : float(np.median(times)),
+               'mean'   : float(times.mean())}
+        self.results.append(rec)
+        engine._log(self.log,"%-32s %-36s %12.3f ms\n" %
+                    (name,formatParams(params),rec['min']*1000))
+
+
+# >>> Key identifying a benchmark (name and parameters)
+def benchKey(rec):
+    return rec['name']+' '+formatParams(rec['params'])
+
+def formatParams(params):
+    return ','.join('%s=%s' % (k,params[k]) for k in sorted(params))
+
+
+# >>> Loading benchmarks on the shipped files
+def benchLoading(suite,tmpdir,scales,rng):
+    ref_copy = os.path.join(tmpdir,'pigments.csv')
+    shutil.copy(REF_FILE,ref_copy)
+    engine.loadRef(ref_copy)    # write the sidecar
+    suite.run('loadRef.parse',lambda: engine.loadRef(REF_FILE,sidecar=False))
+    suite.run('loadRef.sidecar',lambda: engine.loadRef(ref_copy))
+
+    csv = os.path.join(EVOO_DIR,'evoo_test.csv')
+    suite.run('loadEVOO.csv',lambda: engine.loadEVOO(csv))
+    xlsx = os.path.join(EVOO_DIR,'evoo_test.xlsx')
+    try:
+        engine.loadEVOO(xlsx)
+        suite.run('loadEVOO.xlsx',lambda: engine.loadEVOO(xlsx))
+    except ImportError:
+        engine._log(suite.log,"loadEVOO.xlsx skipped (no Excel reader)\n")
+
+    # Wide CSV files with one column per sample
+    evoo = engine.loadEVOO(csv)
+    for batch in scales['batch'][1:]:
+        wide = os.path.join(tmpdir,'wide_%d.csv' % batch)
+        ABS  = evoo.ABS*rng.uniform(0.5,1.5,(batch,1))
+        np.savetxt(wide,np.column_stack((evoo.X,ABS.T)),delimiter=';',fmt='%.6g',
+                   header='Wavelength;'+';'.join('S%d' % i for i in range(batch)))
+        suite.run('loadEVOO.csv_wide',lambda: engine.loadEVOO(wide,wide=True),
+                  batch=batch)
+
+
+# >>> Pre-processing, deconvolution and plotting benchmarks of a case
+def benchCase(suite,case,params,plot=True):
+    ref,evoo,fine,opts = case.ref,case.evoo,case.fine,case.opts
+    full = engine.Options()
+
+    suite.run('processSpectra.matched',
+              lambda: engine.processSpectra(ref,evoo,full),**params)
+    suite.run('processSpectra.interpolated',
+              lambda: engine.processSpectra(ref,fine,opts),**params)
+    X_REF = engine.processSpectra(ref,fine,opts)[0]
+    suite.run('resampler.build',
+              lambda: engine.Resampler(fine.X,X_REF),**params)
+
+    proc  = engine.processSpectra(ref,evoo,opts)
+    X,EPS,ABS = proc[0],proc[1],proc[3]
+    cache = engine.FactorizationCache()
+    suite.run('deconvolve.cached',
+              lambda: engine.deconvolve(X,EPS,ABS,cache=cache,key='bench'),**params)
+    suite.run('deconvolve.uncached',
+              lambda: engine.deconvolve(X,EPS,ABS,cache=None),**params)
+    suite.run('deconvolve.nnls',
+              lambda: engine.deconvolve(X,EPS,ABS,cache=cache,key='bench',
+                                        solver='nnls'),**params)
+    suite.run('analyze',lambda: engine.analyze(ref,fine,opts),**params)
+
+    if plot and not evoo.isBatch():
+        benchPlot(suite,engine.analyze(ref,evoo,opts),params)
+
+
+# >>> Plot rendering (off-screen, same artists as the GUI plot): a full
+# redraw and an update of the calculated spectra only (blitting)
+def benchPlot(suite,res,params):
+    try:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+    except ImportError:
+        engine._log(suite.log,"plot skipped (no matplotlib)\n")
+        return
+    fig    = Figure(figsize=(7.0,4.5),dpi=100)
+    canvas = FigureCanvasAgg(fig)
+    ax     = fig.add_subplot(111)
+    evoo   = ax.plot(res.X_REF,res.ABS_EVOO,'-k',linewidth=0.8,label='EVOO')[0]
+    calc   = ax.plot(res.X_REF,res.ABS_CALC,'-g',label='Calculated')[0]
+    contr  = [ax.plot(res.X_REF,res.ABS_CALC_CONTR[:,i],linewidth=0.8,label=p)[0]
+              for i,p in enumerate(res.PIGMENTS)]
+    ax.legend(loc='best')
+
+    def full():
+        evoo.set_data(res.X_REF,res.ABS_EVOO)
+        calc.set_data(res.X_REF,res.ABS_CALC)
+        for i,line in enumerate(contr):
+            line.set_data(res.X_REF,res.ABS_CALC_CONTR[:,i])
+        canvas.draw()
+
+    for line in [calc]+contr: line.set_animated(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    def blit():
+        calc.set_ydata(res.ABS_CALC)
+        for i,line in enumerate(contr):
+            line.set_ydata(res.ABS_CALC_CONTR[:,i])
+        canvas.restore_region(background)
+        for line in [calc]+contr:
+            ax.draw_artist(line)
+
+    suite.run('plot.blit',blit,**params)
+    for line in [calc]+contr: line.set_animated(False)
+    suite.run('plot.full',full,**params)
+
+
+# >>> Run all the benchmarks
+def runSuite(scale='full',repeat=5,min_time=0.05,seed=0,select=None,plot=True,
+    log=None):
+    scales = SCALES[scale]
+    suite  = Suite(repeat,min_time,select,log)
+    rng    = np.random.default_rng(seed)
+    ref    = engine.loadRef(REF_FILE)
+
+    tmpdir = tempfile.mkdtemp(prefix='evoodec_bench_')
+    try:
+        benchLoading(suite,tmpdir,scales,rng)
+    finally:
+        shutil.rmtree(tmpdir,ignore_errors=True)
+
+    default = {k:v[0] for k,v in scales.items()}
+    cases   = [dict(default)]
+    for axis,values in scales.items():
+        for v in values[1:]:
+            cases.append(dict(default,**{axis:v}))
+    for params in cases:
+        case = Case(ref,params['step'],params['pigments'],params['batch'],
+                    np.random.default_rng(seed))
+        params = dict(params,points=len(case.ref.X))
+        benchCase(suite,case,params,plot)
+
+    return {'meta'    : {'python'   : platform.python_version(),
+                         'numpy'    : np.__version__,
+                         'platform' : platform.platform(),
+                         'machine'  : platform.machine(),
+                         'cpus'     : os.cpu_count(),
+                         'date'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'scale'    : scale,
+                         'seed'     : seed},
+            'results' : suite.results}
+
+
+# >>> Compare results to a baseline: returns the rows (key, baseline time,
+# time, ratio) and the number of regressions (ratio > 1+tolerance)
+def compare(results,baseline,tolerance=0.25):
+    base = {benchKey(r):r for r in baseline['results']}
+    rows = []
+    nreg = 0
+    for rec in results['results']:
+        key = benchKey(rec)
+        if key not in base:
+            continue
+        ratio = rec['min']/base[key]['min'] if base[key]['min'] > 0 else np.inf
+        rows.append((key,base[key]['min'],rec['min'],ratio))
+        if(ratio > 1+tolerance):
+            nreg += 1
+    return rows,nreg
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec bench',
+        description='Benchmark suite of EVOODec')
+    parser.add_argument('-o','--output',default='-',
+        help='JSON results, "-" for standard output (default)')
+    parser.add_argument('--quick',action='store_true',
+        help='fewer sizes and shorter runs')
+    parser.add_argument('--repeat',type=int,default=None,
+        help='runs of each benchmark (default: 5, 3 with --quick)')
+    parser.add_argument('--seed',type=int,default=0,
+        help='seed of the synthetic data (default: %(default)s)')
+    parser.add_argument('-k','--select',action='append',default=None,
+        help='run only the benchmarks whose name contains this text (repeatable)')
+    parser.add_argument('--no-plot',action='store_true',
+        help='skip the plot rendering benchmarks')
+    parser.add_argument('--baseline',default=None,
+        help='JSON results of a previous run to compare with')
+    parser.add_argument('--tolerance',type=float,default=0.25,
+        help='allowed slowdown over the baseline (default: %(default)s)')
+    return parser.parse_args(argv)
+
+
+# >>> Entry point of the benchmark suite
+def main(argv=None):
+    args = parseArgs(argv)
+    log  = lambda msg: sys.stderr.write(msg)
+
+    scale  = 'quick' if args.quick else 'full'
+    repeat = args.repeat or (3 if args.quick else 5)
+    results = runSuite(scale,repeat,0.01 if args.quick else 0.05,args.seed,
+                       args.select,not args.no_plot,log)
+
+    if(args.output == '-'):
+        json.dump(results,sys.stdout,indent=1)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output,'w') as out:
+            json.dump(results,out,indent=1)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline,'r') as f:
+        baseline = json.load(f)
+    rows,nreg = compare(results,baseline,args.tolerance)
+    log("\nComparison with %s (tolerance %.0f%%)\n" % (args.baseline,args.tolerance*100))
+    for key,t0,t1,ratio in rows:
+        flag = '  REGRESSION' if ratio > 1+args.tolerance else ''
+        log("%-70s %10.3f %10.3f ms %6.2fx%s\n" % (key,t0*1000,t1*1000,ratio,flag))
+    log("%d benchmarks compared, %d regressions\n" % (len(rows),nreg))
+    return 1 if nreg else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
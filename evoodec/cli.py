@@ -0,0 +1,99 @@
+"""
+EVOODec cli - headless entry point of the command line modes
+
+Starts without the GUI stack: only NumPy and the EVOODec engine are imported
+for the deconvolution of CSV files. Excel readers (openpyxl, xlrd), worker
+pools and the watch/archive/service/store modules are imported only by the
+features that need them.
+
+Usage:
+    python cli.py -r pigments/pigments.csv sample.csv
+    python cli.py watch -r pigments/pigments.csv /path/to/instrument/output
+    python cli.py archive season.evooarc spectra/
+    python cli.py sweep -r pigments/pigments.csv sample.csv --start 390:500:5 --end 450:720:5
+    python cli.py bench -o results.json
+    python cli.py serve -r pigments/pigments.csv --port 8750 -j 2
+    python cli.py query results.db --where "Pheo-a>2" --month 2026-10
+
+With --import-time the import cost of the modules loaded by the run is
+written to the standard error when the program ends.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import sys
+import time
+
+_T0 = time.perf_counter()
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+# Modules whose import is reported by --import-time
+REPORTED = ['numpy','engine','batch','watch','archive','sweep','service',
+            'store','workbook','concurrent.futures','asyncio','sqlite3','openpyxl',
+            'xlrd','scipy','matplotlib','tkinter']
+
+# Import time of the modules imported by timedImport (s)
+_IMPORT_TIME = {}
+
+
+# >>> Import a module, timing it (the time of modules already imported by
+# a previous one is included in the first)
+def timedImport(name):
+    t0 = time.perf_counter()
+    already = name in sys.modules
+    module  = __import__(name)
+    if not already:
+        _IMPORT_TIME[name] = time.perf_counter()-t0
+    return module
+
+
+# >>> Report of the import times and of the heavy modules loaded
+def importReport(out=None):
+    if out is None: out = sys.stderr
+    out.write("Import time report\n")
+    for name in REPORTED:
+        if name in _IMPORT_TIME:
+            out.write("  %-20s %8.1f ms\n" % (name,_IMPORT_TIME[name]*1000))
+        elif name in sys.modules:
+            out.write("  %-20s   loaded\n" % name)
+        else:
+            out.write("  %-20s   not loaded\n" % name)
+    out.write("  %-20s %8.1f ms\n" % ('total run',(time.perf_counter()-_T0)*1000))
+
+
+# >>> Entry point: dispatch to the watch, archive, sweep, bench, serve,
+# query or batch mode
+def main(argv=None):
+    if argv is None: argv = sys.argv[1:]
+    report = '--import-time' in argv
+    argv   = [a for a in argv if a != '--import-time']
+
+    timedImport('numpy')
+    timedImport('engine')
+    try:
+        if argv and argv[0] == 'watch':
+            return timedImport('watch').main(argv[1:])
+        if argv and argv[0] == 'archive':
+            return timedImport('archive').main(argv[1:])
+        if argv and argv[0] == 'sweep':
+            return timedImport('sweep').main(argv[1:])
+        if argv and argv[0] == 'bench':
+            return timedImport('bench').main(argv[1:])
+        if argv and argv[0] == 'serve':
+            return timedImport('service').main(argv[1:])
+        if argv and argv[0] == 'query':
+            return timedImport('store').main(argv[1:])
+        return timedImport('batch').main(argv)
+    finally:
+        if report: importReport()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1969 @@
+"""
+EVOODec engine - headless loading, pre-processing and deconvolution of
+EVOO absorption spectra
+
+This module has no GUI dependencies (no Tkinter, no matplotlib) and only
+needs NumPy: it can be imported on machines without a display and starts
+quickly in short-lived processes. The EvooDec GUI (evoodec.py) is a thin
+client on top of these functions.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+
+from metrics import METRICS
+import baseline
+import savgol
+import align
+
+
+# -----------------------------------------------------------------------------
+# CONSTANTS
+#
+
+EVOO_DENSITY = 0.91   # Density of EVOO (g/ml)
+CONC_MAX_PPM = 1E4    # Concentrations above this value are not meaningful
+COND_MAX     = 1E10   # Condition number above which the basis is solved by QR
+
+# Binary sidecar of the reference files (<reference file>.npz)
+SIDECAR_EXT     = '.npz'
+SIDECAR_VERSION = 1
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+class Reference:
+
+    # Spectra of pure pigments as loaded from the reference file
+    #   X        : wavelength (nm), shape (n_points,)
+    #   EPS      : molar extinsion coefficients (M^-1cm-1), shape (n_points, n_pigments)
+    #   PIGMENTS : pigment names
+    #   MW       : molecular weights (g/mol)
+    #   COLORS   : colors used for plotting
+    #   digest   : content hash of X and EPS (used as factorization cache key,
+    #              X and EPS must not be modified in place)
+    def __init__(self,X,EPS,PIGMENTS,MW,COLORS,filename='',comments='',
+        digest=None):
+        self.X        = np.asarray(X,dtype=float)
+        self.EPS      = np.asarray(EPS,dtype=float)
+        self.PIGMENTS = list(PIGMENTS)
+        self.MW       = np.asarray(MW,dtype=float)
+        self.COLORS   = list(COLORS)
+        self.filename = filename
+        self.comments = comments
+        self.X_LIM    = np.array([np.min(self.X),np.max(self.X)])
+        self.digest   = digest or arrayDigest(self.X,self.EPS)
+
+
+class Spectrum:
+
+    # Absorption spectrum of a sample, or a batch of samples sharing the x-axis
+    #   X     : wavelength (nm), shape (n_points,)
+    #   ABS   : absorbance (a.u.), shape (n_points,) or (n_samples, n_points),
+    #           float64 or float32 (kept as given, e.g. by a float32 archive)
+    #   names : sample ids (batch only)
+    #   OPLEN : optical path length (cm) of each sample when known from the
+    #           data source (e.g. an archive), it replaces Options.OPLEN
+    #   skipped : cells of the source file that could not be read
+    #   files : source file of each sample when it is not filename (batch
+    #           read from an archive), None otherwise
+    #   members : index of each sample in the archive filename (batch read
+    #           from an archive), None otherwise
+    def __init__(self,X,ABS,filename='',names=None,OPLEN=None,skipped=None,
+        files=None,members=None):
+        self.X        = np.asarray(X,dtype=float)
+        self.ABS      = np.asarray(ABS)
+        if(self.ABS.dtype != np.float32):
+            self.ABS  = self.ABS.astype(float,copy=False)
+        self.filename = filename
+        self.X_LIM    = np.array([np.min(self.X),np.max(self.X)])
+        if self.ABS.shape[-1] != len(self.X):
+            raise Exception("Absorbance has %d points, wavelength has %d!"
+                            % (self.ABS.shape[-1],len(self.X)))
+        if names is None and self.ABS.ndim == 2:
+            names = ['%s:%d' % (os.path.basename(filename),i)
+                     for i in range(self.ABS.shape[0])]
+        self.names    = names
+        self.OPLEN    = OPLEN
+        self.skipped  = [] if skipped is None else skipped
+        self.files    = files
+        self.members  = members
+
+    def isBatch(self):
+        return self.ABS.ndim == 2
+
+    # Single spectrum of the i-th sample of a batch
+    def sample(self,i):
+        if not self.isBatch():
+            return self
+        OPLEN = None if self.OPLEN is None else np.asarray(self.OPLEN)[i]
+        return Spectrum(self.X,self.ABS[i],self.filename if self.files is None
+                        else self.files[i],OPLEN=OPLEN)
+
+
+class Options:
+
+    # Options for pre-processing and deconvolution
+    #   X_SEL_MIN, X_SEL_MAX : spectral window (nm), None means the sample limits
+    #   OPLEN                : optical path length (cm)
+    #   BASELINE             : baseline correction: False (none), True or
+    #                          'min' (shift to the minimum), 'poly',
+    #                          'rubberband' or 'als' (see baseline.py)
+    #   BASELINE_ORDER       : order of the 'poly' baseline
+    #   ALS_LAMBDA, ALS_P    : smoothness and asymmetry of the 'als' baseline
+    #   JOINT_BASELINE       : order of a polynomial baseline fitted together
+    #                          with the pigments, None means none
+    #   SG_WINDOW            : points of the Savitzky-Golay filter applied to
+    #                          the spectra and to EPS_REF after the baseline
+    #                          correction, None means no filter
+    #   SG_ORDER, SG_DERIV   : order of its polynomial and derivative taken
+    #                          (with SG_DERIV > 0 the deconvolution and R^2
+    #                          are computed on the derivative spectra)
+    #   ALIGN                : align the samples to their reconstruction
+    #                          (wavelength shift, see alignSpectra)
+    #   ALIGN_MAX            : largest shift (nm)
+    #   FILTER               : boolean mask of the pigments used in the
+    #                          deconvolution, None means all the pigments
+    #   SOLVER               : 'unconstrained' or 'nnls' (non-negative
+    #                          concentrations)
+    #   RESAMPLE             : kernel used to resample the sample on the
+    #                          reference x-axis ('linear', 'cubic' or 'spline')
+    #   FLOAT32              : project the spectra in single precision
+    #                          (large batches, about 1e-6 relative accuracy)
+    #   SELECT               : criterion for the automatic selection of the
+    #                          pigments among the FILTER ones ('aic', 'aicc'
+    #                          or 'bic'), None means no selection
+    #   SELECT_MAX           : largest number of pigments selected (None
+    #                          means no limit)
+    #   CI                   : number of replicates for the confidence
+    #                          intervals of the concentrations, 0 means none
+    #                          (see confidenceIntervals for the other CI_*,
+    #                          NOISE, OPLEN_SD and SEED options)
+    def __init__(self,X_SEL_MIN=None,X_SEL_MAX=None,OPLEN=1.0,BASELINE=False,
+        FILTER=None,SOLVER='unconstrained',RESAMPLE='spline',CI=0,
+        CI_METHOD='bootstrap',CI_LEVEL=0.95,NOISE=None,OPLEN_SD=0.0,SEED=None,
+        CI_WORKERS=1,SELECT=None,SELECT_MAX=None,FLOAT32=False,BASELINE_ORDER=2,
+        ALS_LAMBDA=1E5,ALS_P=0.01,JOINT_BASELINE=None,SG_WINDOW=None,SG_ORDER=2,
+        SG_DERIV=0,ALIGN=False,ALIGN_MAX=5.0):
+        self.X_SEL_MIN  = X_SEL_MIN
+        self.X_SEL_MAX  = X_SEL_MAX
+        self.OPLEN      = OPLEN
+        self.BASELINE   = BASELINE
+        self.FILTER     = FILTER
+        self.SOLVER     = SOLVER
+        self.RESAMPLE   = RESAMPLE
+        self.CI         = CI
+        self.CI_METHOD  = CI_METHOD
+        self.CI_LEVEL   = CI_LEVEL
+        self.NOISE      = NOISE
+        self.OPLEN_SD   = OPLEN_SD
+        self.SEED       = SEED
+        self.CI_WORKERS = CI_WORKERS
+        self.SELECT     = SELECT
+        self.SELECT_MAX = SELECT_MAX
+        self.FLOAT32    = FLOAT32
+        self.BASELINE_ORDER = BASELINE_ORDER
+        self.ALS_LAMBDA = ALS_LAMBDA
+        self.ALS_P      = ALS_P
+        self.JOINT_BASELINE = JOINT_BASELINE
+        self.SG_WINDOW  = SG_WINDOW
+        self.SG_ORDER   = SG_ORDER
+        self.SG_DERIV   = SG_DERIV
+        self.ALIGN      = ALIGN
+        self.ALIGN_MAX  = ALIGN_MAX
+
+    def mask(self,n_pigments):
+        if self.FILTER is None:
+            return np.ones(n_pigments,dtype=bool)
+        FILTER = np.asarray(self.FILTER,dtype=bool)
+        if len(FILTER) != n_pigments:
+            raise Exception("Pigment filter has %d entries, %d pigments loaded!"
+                            % (len(FILTER),n_pigments))
+        return FILTER
+
+    # Baseline model, None for no baseline correction
+    def baselineModel(self):
+        if self.BASELINE is False or self.BASELINE is None:
+            return None
+        if self.BASELINE is True:
+            return 'min'
+        if self.BASELINE not in baseline.MODELS:
+            raise Exception("Unknown baseline model '%s'!" % self.BASELINE)
+        return self.BASELINE
+
+
+class Result:
+
+    # Result of the deconvolution of a sample
+    #   PIGMENTS, MW       : pigments used in the deconvolution (FILTER applied)
+    #   FILTER             : boolean mask over the pigments of the reference
+    #   concmol            : concentrations (M) of the selected pigments
+    #   concppm            : concentrations (mg/kg) of the selected pigments
+    #   X_REF, EPS_REF     : processed reference data (FILTER applied)
+    #   X_EVOO, ABS_EVOO   : windowed sample data / processed sample absorbance
+    #   ABS_CALC           : reconstructed spectrum
+    #   ABS_CALC_CONTR     : contribution of each pigment to ABS_CALC
+    #                        (single spectrum only, None for a batch)
+    #   RSQ                : R^2 of the fitting
+    #   X_SEL_LIM          : spectral window actually used
+    #   warn               : warnings raised during pre-processing
+    #   solver, key        : solver and cache key of the factorization used
+    #   CI                 : confidence intervals of the concentrations
+    #                        (Intervals), None if not asked
+    #   SELECTION          : automatic selection of the pigments
+    #                        (Selection), None if not asked
+    #   EPS_FIT            : basis of the deconvolution, EPS_REF projected
+    #                        out of the joint baseline (EPS_REF without it)
+    #   ABS_BASE           : joint baseline, included in ABS_CALC (None
+    #                        without joint baseline)
+    #   BASE_COEF          : Legendre coefficients of ABS_BASE
+    #   SHIFT              : wavelength shift (nm) of the sample, already
+    #                        corrected in ABS_EVOO (None if not aligned)
+    # For a batch of samples concmol, concppm, ABS_EVOO, ABS_CALC and RSQ
+    # have one leading row per sample.
+    def __init__(self,**kwargs):
+        self.__dict__.update(kwargs)
+
+    # Concentrations (mg/kg) over all the pigments of the reference,
+    # zero for the pigments excluded by FILTER
+    def concppmAll(self):
+        conc = np.zeros(np.shape(self.concppm)[:-1]+(len(self.FILTER),))
+        conc[...,self.FILTER] = self.concppm
+        return conc
+
+
+# >>> Content hash of a set of arrays
+def arrayDigest(*arrays):
+    h = hashlib.sha1()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str((a.dtype.str,a.shape)).encode())
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+# >>> Send a message to the logger (if any)
+def _log(log,msg):
+    if log is not None:
+        log(msg)
+
+
+# >>> Load file for pure compounds
+# The parsed data are saved in a binary sidecar (<filename>.npz) together
+# with the hash of the file content: later loads reuse it as long as the
+# reference file is unchanged. Pass sidecar=False to always parse the file.
+def loadRef(filename,log=None,sidecar=True):
+
+    _log(log,'\nLoading reference file: %s' % os.path.basename(filename))
+
+    with METRICS.span('parse',source='reference'):
+        with open(filename,'rb') as f:
+            raw = f.read()
+        source_hash = hashlib.sha1(raw).hexdigest()
+
+        ref = _loadSidecar(filename,source_hash) if sidecar else None
+        if ref is None:
+            ref = parseRef(_decode(raw),filename)
+            if sidecar: _saveSidecar(ref,source_hash)
+        else:
+            METRICS.inc('sidecar_hits_total')
+
+    _log(log,"\nReference file correctly loaded!")
+    return ref
+
+
+# >>> Parse the content of a reference file
+def parseRef(text,filename=''):
+
+    # Load absorption spectra from CSV file ";" separated
+    # First column  : wavelength(nm)
+    # Other columns : molar extinsion coefficient (M^-1cm-1)
+    # First line    : Pigment name
+    # Second line   : molecular weight
+    # Third line    : colors
+    # Lines starting with '#' will be treated as comments
+    #
+    lines    = text.splitlines()
+    comments = ''.join(l.strip('#')+'\n' for l in lines if l.startswith('#'))
+    lines    = [l for l in lines if l.strip() and not l.startswith('#')]
+    if len(lines) < 4:
+        raise Exception("Check consistency of reference file!")
+
+    # 1st line -> pigment names, 2nd line -> molecular weights,
+    # 3rd line -> labels' color
+    pigments = [xx.strip(' \n\t\r') for xx in lines[0].split(';')[1:]]
+    MW       = np.array(lines[1].split(';')[1:],dtype=float)
+    COLORS   = [xx.strip(' \n\t\r') for xx in lines[2].split(';')[1:]]
+
+    # Data lines are converted all at once: check first that every line
+    # has the same number of columns
+    rows   = lines[3:]
+    nc_dat = rows[0].count(';')+1
+    if (np.char.count(np.array(rows),';') != nc_dat-1).any():
+        raise Exception("Check consistency of reference file!")
+    data = np.fromstring(';'.join(rows),dtype=float,sep=';')
+    if(data.size != len(rows)*nc_dat):
+        raise Exception("Check consistency of reference file!")
+    data = data.reshape(len(rows),nc_dat)
+
+    # Check the file consistency: the number of cols must be the same
+    # for all the data
+    nc_pig = len(pigments)
+    nc_mw  = len(MW)
+    nc_col = len(COLORS)
+    if len(set([nc_pig,nc_mw,nc_col,nc_dat-1])) > 1:
+        raise Exception("Check consistency of reference file!")
+
+    # First column is wavelength, other columns are epsilon
+    return Reference(data[:,0],data[:,1:],pigments,MW,COLORS,filename,comments)
+
+
+# >>> Decode the bytes of a text file
+def _decode(raw):
+    try:
+        return raw.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return raw.decode('latin-1')
+
+
+# >>> Load the binary sidecar of a reference file (None if missing or stale)
+def _loadSidecar(filename,source_hash):
+    try:
+        with np.load(filename+SIDECAR_EXT,allow_pickle=False) as npz:
+            if(int(npz['version']) != SIDECAR_VERSION or
+               str(npz['source_hash']) != source_hash):
+                return None
+            return Reference(npz['X'],npz['EPS'],npz['PIGMENTS'].tolist(),
+                             npz['MW'],npz['COLORS'].tolist(),filename,
+                             str(npz['comments']),str(npz['digest']))
+    except Exception:
+        return None
+
+
+# >>> Save the binary sidecar of a reference file (silently skipped if the
+# directory is not writable)
+def _saveSidecar(ref,source_hash):
+    path = ref.filename+SIDECAR_EXT
+    tmp  = '%s.%d.tmp' % (path,os.getpid())
+    try:
+        with open(tmp,'wb') as f:
+            np.savez(f,version=SIDECAR_VERSION,source_hash=source_hash,
+                     X=ref.X,EPS=ref.EPS,PIGMENTS=np.array(ref.PIGMENTS),
+                     MW=ref.MW,COLORS=np.array(ref.COLORS),
+                     comments=ref.comments,digest=ref.digest)
+        os.replace(tmp,path)
+    except OSError:
+        if os.path.exists(tmp): os.remove(tmp)
+
+
+# >>> Load file for EVOO
+# For a spectral archive (see archive.py) select picks the samples to read:
+# an index, a slice, a sample id or a list of them (None reads all of them).
+# For CSV files wide=True reads every column as a separate sample.
+def loadEVOO(filename,log=None,select=None,wide=False):
+
+    ext = os.path.splitext(filename.rstrip('/\\'))[1]
+    _log(log,'\nLoading sample    file: %s' % os.path.basename(filename))
+
+    with METRICS.span('parse',source=ext.lower().lstrip('.')):
+        return _loadEVOO(filename,ext,log,select,wide)
+
+def _loadEVOO(filename,ext,log,select,wide):
+    if(ext.lower() == '.evooarc'):
+        import archive
+        return archive.Archive(filename).read(select)
+
+    elif(ext.lower() in ['.xlsx','.xls']):
+
+        # Every sheet and every absorbance column of the workbook
+        # File structure:
+        # 1st col  : wavelength (nm)
+        # other cols: absorbance of the samples
+        import workbook
+        evoo = workbook.loadWorkbook(filename,log)
+        if(len(evoo.names) == 1):
+            return Spectrum(evoo.X,evoo.ABS[0],filename,skipped=evoo.skipped)
+        return evoo
+
+    elif(ext.lower() in ['.csv']):
+        return parseCSV(filename,filename,log,wide)
+
+    else:
+        raise Exception('Only .csv, .xls or .xlsx file can be loaded!')
+
+
+# >>> Parse an EVOO spectrum in CSV format
+# source is a file name, a file object or a list of lines.
+# With wide=True every column after the wavelength is a separate sample and
+# a batch of spectra is returned, the column headers being the sample ids.
+def parseCSV(source,filename='',log=None,wide=False):
+
+    # File structure: csv file ; separated
+    # 1st col: wavelength (nm)
+    # 2nd col: absorbance (other cols: absorbance of other samples)
+    # Lines before the data (starting with '#' or not numeric) are headers
+    if isinstance(source,str):
+        with open(source,'rb') as f:
+            lines = _decode(f.read()).splitlines()
+    else:
+        lines = [l.decode('utf-8-sig') if isinstance(l,bytes) else l for l in source]
+    header = ''
+    rows   = []
+    for line in lines:
+        line = line.split('#',1)[0] if rows else line
+        if not line.strip():
+            continue
+        if not rows and (line.lstrip().startswith('#') or not _isNumber(line.split(';',1)[0])):
+            header = line.lstrip('#\ufeff')
+            continue
+        rows.append(line.rstrip())
+    evoo_data = _parseTable(rows)
+
+    # Check file integrity
+    if(len(evoo_data) == 0):
+        raise Exception("No data found in EVOO file!")
+    if(np.shape(evoo_data)[1] < 2):
+        raise Exception("EVOO file must contain at least two columns!")
+    dim = np.shape(evoo_data)[1]
+    if(dim > 2 and wide):
+        _log(log,"\nEVOO file contains %d samples!" % (dim-1))
+        names = [h.strip() for h in header.split(';')[1:]]
+        if(len(names) != dim-1 or not all(names)):
+            names = ['%s:%d' % (os.path.basename(filename),i+1) for i in range(dim-1)]
+        return Spectrum(evoo_data[:,0],evoo_data[:,1:].T,filename,names=names)
+    if(dim > 2):
+        _log(log,"\nEVOO file contains %d columns!\n"
+                 "Only the first two cols will be considered" % dim)
+    else:
+        _log(log,"\nEVOO file correctly loaded!")
+
+    return Spectrum(evoo_data[:,0],evoo_data[:,1],filename)
+
+
+# >>> Check if a string is a number
+def _isNumber(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+# >>> Convert ";" separated data lines to a 2D array. All the values are
+# converted at once when every line has the same number of columns, lines
+# with missing values fall back to np.genfromtxt (missing values are NaN).
+def _parseTable(rows):
+    if not rows:
+        return np.zeros((0,0))
+    ncols = rows[0].rstrip(';').count(';')+1
+    rows  = [r.rstrip(';') for r in rows]
+    if (np.char.count(np.array(rows),';') == ncols-1).all():
+        try:
+            data = np.fromstring(';'.join(rows),dtype=float,sep=';')
+            if(data.size == len(rows)*ncols):
+                return data.reshape(len(rows),ncols)
+        except ValueError:
+            pass
+    METRICS.inc('parse_fallbacks_total')
+    return np.atleast_2d(np.genfromtxt(rows,delimiter=';'))
+
+
+# >>> Select spectral window and match the sample to the reference x-axis
+def processSpectra(ref,evoo,opts=None,log=None):
+
+    if opts is None: opts = Options()
+    warn   = ''
+    t0     = time.perf_counter()
+
+    # Spectrum pre-processing
+    _log(log,'\nSpectrum pre-processing\n')
+    X_SEL_MIN = evoo.X_LIM[0] if opts.X_SEL_MIN is None else opts.X_SEL_MIN
+    X_SEL_MAX = evoo.X_LIM[1] if opts.X_SEL_MAX is None else opts.X_SEL_MAX
+
+    # Check consistency of selected EVOO spectrum limits
+    if(X_SEL_MIN > X_SEL_MAX):
+        warn += "X_EVOO_MIN %4d > X_EVOO_MAX %d\n" % (X_SEL_MIN,X_SEL_MAX)
+        X_SEL_MIN = evoo.X_LIM[0]
+    if(X_SEL_MAX < X_SEL_MIN):
+        warn += "X_EVOO_MAX %4d < X_EVOO_MIN %d\n" % (X_SEL_MAX,X_SEL_MIN)
+        X_SEL_MAX = evoo.X_LIM[1]
+
+    ind = np.flatnonzero((evoo.X >= X_SEL_MIN) & (evoo.X <= X_SEL_MAX))
+
+    X_EVOO   = evoo.X[ind]
+    ABS_EVOO = evoo.ABS[...,ind]
+
+    X_REF    = ref.X
+    EPS_REF  = ref.EPS
+
+    # Extract number of points (x-axis)
+    NPT_EVOO = np.shape(ABS_EVOO)[-1]
+    NPT_REF  = np.shape(EPS_REF)[0]
+    if(NPT_EVOO < 2):
+        raise Exception("Less than two sample points in the selected window!")
+
+    # Compute steps
+    X_EVOO_STEP = (X_SEL_MAX-X_SEL_MIN)/(NPT_EVOO-1)
+    X_REF_STEP  = (ref.X_LIM[1]-ref.X_LIM[0])/(NPT_REF-1)
+
+    table  =  '\n'
+    table += '\n                PURE  EVOO\n'
+    table += '     ---------------------\n'
+    table += '     X_MIN    = %4d  %4d\n' % (ref.X_LIM[0],X_SEL_MIN)
+    table += '     X_MAX    = %4d  %4d\n' % (ref.X_LIM[1],X_SEL_MAX)
+    table += '     X_POINTS = %4d  %4d\n' % (NPT_REF,NPT_EVOO)
+    table += '     DELTA_X  = %4.1f  %4.1f\n' % (X_REF_STEP,X_EVOO_STEP)
+    table += '     ---------------------\n'
+    _log(log,table)
+
+    if(X_REF_STEP != X_EVOO_STEP):
+        warn += "Different resolution between reference pigments and EVOO files\n"
+
+    # Check on minimum
+    if(X_SEL_MIN < ref.X_LIM[0]):
+        warn += "X_EVOO_MIN %4d < X_REF_MIN %4d\n" % (X_SEL_MIN,ref.X_LIM[0])
+        ind = np.argwhere(X_EVOO >= ref.X_LIM[0]).flatten()
+        X_EVOO   = X_EVOO[ind]
+        ABS_EVOO = ABS_EVOO[...,ind]
+        X_SEL_MIN = ref.X_LIM[0]
+    elif(X_SEL_MIN > ref.X_LIM[0]):
+        warn += "X_EVOO_MIN %4d > X_REF_MIN %4d\n" % (X_SEL_MIN,ref.X_LIM[0])
+        ind = np.argwhere(X_REF >= X_SEL_MIN).flatten()
+        X_REF    = X_REF[ind]
+        EPS_REF  = EPS_REF[ind]
+
+    # Check on maximum
+    if(X_SEL_MAX > ref.X_LIM[1]):
+        warn += "X_EVOO_MAX %4d > X_REF_MAX %4d\n" % (X_SEL_MAX,ref.X_LIM[1])
+        ind = np.argwhere(X_EVOO <= X_SEL_MAX).flatten()
+        X_EVOO   = X_EVOO[ind]
+        ABS_EVOO = ABS_EVOO[...,ind]
+        X_SEL_MAX = ref.X_LIM[1]
+    elif(X_SEL_MAX < ref.X_LIM[1]):
+        warn += "X_EVOO_MAX %4d < X_REF_MAX %4d\n" % (X_SEL_MAX,ref.X_LIM[1])
+        ind = np.argwhere(X_REF <= X_SEL_MAX).flatten()
+        X_REF    = X_REF[ind]
+        EPS_REF  = EPS_REF[ind]
+
+    METRICS.observe('window',time.perf_counter()-t0)
+
+    # Interpolate EVOO spectrum if needed
+    if(warn != ''):
+        _log(log,'Warning!\n'+warn)
+        with METRICS.span('resample',kind=opts.RESAMPLE):
+            ABS_EVOO = interpolateTo(X_EVOO,ABS_EVOO,X_REF,opts.RESAMPLE)
+        METRICS.inc('resampled_spectra_total',len(np.atleast_2d(ABS_EVOO)),
+                    kind=opts.RESAMPLE)
+    else:
+        _log(log,'Spectra are OK!\n')
+
+    with METRICS.span('baseline'):
+
+        # Correct the absorbance for the optical path length (a single value
+        # or one value per sample)
+        OPLEN = opts.OPLEN if evoo.OPLEN is None else evoo.OPLEN
+        if(np.ndim(OPLEN) == 0):
+            _log(log,' ... optical path length %3.1f cm\n' % OPLEN)
+            if(OPLEN != 1.0):
+                _log(log,'     -> normalize to 1.0\n')
+                ABS_EVOO = ABS_EVOO/OPLEN
+        else:
+            _log(log,' ... optical path length of each sample\n')
+            ABS_EVOO = ABS_EVOO/np.asarray(OPLEN,dtype=ABS_EVOO.dtype)[:,None]
+
+        # Apply baseline correction
+        ABS_EVOO = correctBaseline(X_REF if warn != '' else X_EVOO,ABS_EVOO,opts,log)
+
+    # Savitzky-Golay smoothing or derivatives of the sample and the reference
+    ABS_EVOO,EPS_REF = filterSpectra(X_REF,ABS_EVOO,EPS_REF,opts,log)
+
+    X_SEL_LIM = np.array([X_SEL_MIN,X_SEL_MAX])
+    return(X_REF,EPS_REF,X_EVOO,ABS_EVOO,X_SEL_LIM,warn)
+
+
+# >>> Subtract the baseline of opts (Options.baselineModel) from a spectrum
+# or a batch of spectra on the x-axis X
+def correctBaseline(X,ABS_EVOO,opts,log=None):
+    model = opts.baselineModel()
+    if model is None:
+        return ABS_EVOO
+    BASE = baseline.estimate(X,ABS_EVOO,model,opts.BASELINE_ORDER,opts.ALS_LAMBDA,
+                             opts.ALS_P)
+    _log(log,"Apply baseline correction\n")
+    if(model == 'min' and np.ndim(ABS_EVOO) == 1):
+        _log(log,"EVOO spectrum will be shifted by %6.2f ABS unit\n" % BASE[0])
+    elif(model != 'min'):
+        _log(log," ... %s baseline\n" % model)
+    METRICS.inc('baselines_total',len(np.atleast_2d(ABS_EVOO)),model=model)
+    return (ABS_EVOO-BASE).astype(ABS_EVOO.dtype,copy=False)
+
+
+# >>> Step of an evenly spaced x-axis (signed), what needs it
+def gridStep(X,what='This stage'):
+    X    = np.asarray(X,dtype=float)
+    step = X[1]-X[0] if len(X) > 1 else 1.0
+    if not np.allclose(np.diff(X),step,rtol=1E-6,atol=0):
+        raise Exception("%s needs an evenly spaced x-axis!" % what)
+    return step
+
+
+# >>> Savitzky-Golay filter of opts applied to the spectra ABS_EVOO (last
+# axis) and to the reference EPS_REF (first axis) on the evenly spaced
+# x-axis X. The filter kernel is reused from cache.
+def filterSpectra(X,ABS_EVOO,EPS_REF,opts,log=None,cache=None):
+    if opts.SG_WINDOW is None:
+        return ABS_EVOO,EPS_REF
+    if cache is None: cache = FILTERS
+    with METRICS.span('smooth'):
+        sg = cache.get(opts.SG_WINDOW,opts.SG_ORDER,opts.SG_DERIV,
+                       gridStep(X,"Savitzky-Golay filter"))
+        _log(log," ... Savitzky-Golay filter (%d points, order %d, derivative %d)\n"
+                 % (sg.window,sg.order,sg.deriv))
+        ABS_EVOO = sg.apply(ABS_EVOO)
+        EPS_REF  = sg.apply(EPS_REF,axis=0)
+    METRICS.inc('filtered_spectra_total',len(np.atleast_2d(ABS_EVOO)))
+    return ABS_EVOO,EPS_REF
+
+
+class Resampler:
+
+    # Resampling of spectra from the x-axis X to the x-axis X_NEW as a sparse
+    # linear operator, shape (len(X_NEW), len(X)), stored by rows: row i has
+    # the weights W[i] of the source points cols[i] (ABS_NEW = ABS[cols] . W)
+    # X must be strictly monotonic (increasing or decreasing); points
+    # outside X are extrapolated. Kernels:
+    #   'linear' : piecewise linear (2 points per row)
+    #   'cubic'  : local cubic Lagrange interpolation on the 4 nearest
+    #              points (4 points per row)
+    #   'spline' : not-a-knot cubic spline, same as interp1d(kind='cubic');
+    #              its weights decay quickly away from the target point and
+    #              the negligible ones are dropped
+    KINDS = ('linear','cubic','spline')
+    CHUNK = 256     # Spectra resampled at once (bounds the memory of a batch)
+    MIN_POINTS = {'linear':2,'cubic':4,'spline':4}  # Points of X needed by a kernel
+
+    def __init__(self,X,X_NEW,kind='spline'):
+        X     = np.asarray(X,dtype=float)
+        X_NEW = np.asarray(X_NEW,dtype=float)
+        if kind not in self.KINDS:
+            raise Exception("Unknown resampling kernel '%s'!" % kind)
+        n = len(X)
+        if(n < self.MIN_POINTS[kind]):
+            raise Exception("Not enough points for %s resampling!" % kind)
+        dx = np.diff(X)
+        if not (np.all(dx > 0) or np.all(dx < 0)):
+            raise Exception("Wavelengths must be strictly increasing or decreasing "
+                            "for resampling (repeated or unordered points)!")
+        self.kind  = kind
+        self.shape = (len(X_NEW),n)
+
+        # Build the operator on the sorted x-axis, then restore the order
+        order = np.argsort(X,kind='stable')
+        XS    = X[order]
+        if(kind == 'spline'):
+            cols,W = _splineWeights(XS,X_NEW)
+        else:
+            npt  = 2 if kind == 'linear' else 4
+            i    = np.clip(np.searchsorted(XS,X_NEW)-npt//2,0,n-npt)
+            cols = i[:,None]+np.arange(npt)
+            XC   = XS[cols]
+            W    = np.ones(cols.shape)
+            for j in range(npt):
+                for k in range(npt):
+                    if(j != k):
+                        W[:,j] *= (X_NEW-XC[:,k])/(XC[:,j]-XC[:,k])
+        self.cols = order[cols]
+        self.W    = W
+
+    @property
+    def nbytes(self):
+        return self.cols.nbytes+self.W.nbytes
+
+    # Dense matrix of the operator
+    def toarray(self):
+        M = np.zeros(self.shape)
+        np.add.at(M,(np.arange(self.shape[0])[:,None],self.cols),self.W)
+        return M
+
+    # Resample a spectrum (n_points,) or a batch of spectra
+    # (n_samples, n_points)
+    def apply(self,ABS):
+        ABS = np.asarray(ABS,dtype=float)
+        if(ABS.shape[-1] != self.shape[1]):
+            raise Exception("Spectrum has %d points, the resampler expects %d!"
+                            % (ABS.shape[-1],self.shape[1]))
+        if(ABS.ndim == 1):
+            return np.einsum('ij,ij->i',ABS[self.cols],self.W)
+        out = np.empty((len(ABS),self.shape[0]))
+        for i in range(0,len(ABS),self.CHUNK):
+            out[i:i+self.CHUNK] = np.einsum('kij,ij->ki',
+                ABS[i:i+self.CHUNK][:,self.cols],self.W)
+        return out
+
+
+# >>> Weights of the not-a-knot cubic spline through the points XS (sorted)
+# evaluated at X_NEW, in row-band form (cols, W) with shape (len(X_NEW), w).
+# The second derivatives of the spline are linear in the data, D2 = T^-1 R,
+# and on [x_i, x_i+1]
+#   S(t) = a y_i + b y_i+1 + ((a^3-a) D2_i + (b^3-b) D2_i+1) h^2/6
+# with h = x_i+1 - x_i, a = (x_i+1 - t)/h and b = 1-a (t outside XS uses
+# the first or the last interval). The weights of a data point decay
+# geometrically away from it: D2 is computed for blocks of data points on a
+# window of margin points around them, so time and memory stay linear in
+# the number of points. Weights below tol (relative to the largest weight
+# of the row) are dropped.
+def _splineWeights(XS,X_NEW,tol=1E-13,block=256,margin=64):
+    n = len(XS)
+    h = np.diff(XS)
+
+    # Interior equations, tridiagonal in D2_1 ... D2_n-2:
+    #   lo D2_i-1 + di D2_i + up D2_i+1 = R_i . y
+    # where R_i has the entries r0, r1, r2 on the columns i-1, i, i+1
+    lo = h[:-1].copy()
+    di = 2*(h[:-1]+h[1:])
+    up = h[1:].copy()
+    r  = (6/h[:-1],-6/h[:-1]-6/h[1:],6/h[1:])
+
+    # Not-a-knot (continuous third derivative at the second and the
+    # second-last points) gives D2_0 and D2_n-1 from their neighbours,
+    # substituted in the first and the last interior equations
+    c0 = np.array([(h[0]+h[1])/h[1],-h[0]/h[1]])        # D2_0 = c0 . D2_1,2
+    c1 = np.array([-h[-1]/h[-2],(h[-2]+h[-1])/h[-2]])   # D2_n-1 = c1 . D2_n-3,n-2
+    di[0]  += lo[0]*c0[0]
+    up[0]  += lo[0]*c0[1]
+    di[-1] += up[-1]*c1[1]
+    lo[-1] += up[-1]*c1[0]
+    m = n-2
+
+    # Interval and coefficients of each new point
+    k  = np.clip(np.searchsorted(XS,X_NEW)-1,0,n-2)
+    hk = h[k]
+    a  = (XS[k+1]-X_NEW)/hk
+    b  = 1-a
+    ca = (a**3-a)*hk**2/6
+    cb = (b**3-b)*hk**2/6
+    j  = np.arange(len(X_NEW))
+    ROWS,COLS,VALS = [j,j],[k,k+1],[a,b]
+
+    for p0 in range(0,n,block):
+        p1 = min(n,p0+block)
+        e0 = max(0,p0-2-margin)
+        e1 = min(m,p1+margin)
+
+        # Right-hand sides of the equations e0 ... e1-1 for the data
+        # points p0 ... p1-1, solved with the Thomas algorithm
+        RHS = np.zeros((e1-e0,p1-p0))
+        for d in range(3):
+            e  = np.arange(e0,e1)
+            ok = (e+d >= p0) & (e+d < p1)
+            RHS[e[ok]-e0,e[ok]+d-p0] = r[d][e[ok]]
+        dd = di[e0:e1].copy()
+        for q in range(1,e1-e0):
+            f       = lo[e0+q]/dd[q-1]
+            dd[q]  -= f*up[e0+q-1]
+            RHS[q] -= f*RHS[q-1]
+
+        # D holds D2_e0 ... D2_e1+1 (zero outside the window)
+        D = np.zeros((e1-e0+2,p1-p0))
+        D[e1-e0] = RHS[-1]/dd[-1]
+        for q in range(e1-e0-2,-1,-1):
+            D[q+1] = (RHS[q]-up[e0+q]*D[q+2])/dd[q]
+        if(e0 == 0): D[0]  = c0[0]*D[1]+c0[1]*D[2]
+        if(e1 == m): D[-1] = c1[0]*D[-3]+c1[1]*D[-2]
+
+        sel = np.flatnonzero((k >= e0) & (k <= e1))
+        WB  = ca[sel,None]*D[k[sel]-e0]+cb[sel,None]*D[k[sel]+1-e0]
+        i,c = np.nonzero(np.abs(WB) > tol*1E-3)
+        ROWS.append(sel[i])
+        COLS.append(c+p0)
+        VALS.append(WB[i,c])
+
+    # Sum the entries of the same point and pack them by rows
+    rows  = np.concatenate(ROWS)
+    cols  = np.concatenate(COLS)
+    vals  = np.concatenate(VALS)
+    order = np.lexsort((cols,rows))
+    rows,cols,vals = rows[order],cols[order],vals[order]
+    first = np.flatnonzero(np.r_[True,(np.diff(rows) != 0) | (np.diff(cols) != 0)])
+    rows,cols,vals = rows[first],cols[first],np.add.reduceat(vals,first)
+    vmax  = np.zeros(len(X_NEW))
+    np.maximum.at(vmax,rows,np.abs(vals))
+    keep  = np.abs(vals) >= tol*vmax[rows]
+    rows,cols,vals = rows[keep],cols[keep],vals[keep]
+
+    count = np.bincount(rows,minlength=len(X_NEW))
+    start = np.r_[0,np.cumsum(count)[:-1]]
+    pos   = np.arange(len(rows))-start[rows]
+    CB    = np.zeros((len(X_NEW),max(1,count.max())),dtype=int)
+    WB    = np.zeros(CB.shape)
+    CB[rows,pos] = cols
+    WB[rows,pos] = vals
+    return CB,WB
+
+
+# >>> Weights of the trapezoidal rule: trapz(y,X) == np.dot(weights,y)
+def trapzWeights(X):
+    dx = np.diff(X)
+    w  = np.zeros(len(X))
+    w[:-1] += dx/2
+    w[1:]  += dx/2
+    return w
+
+
+# >>> Quadrature weights of a monotonic x-axis of any order or spacing: the
+# integral of y over the range of X is np.dot(weights,y)
+def quadWeights(X):
+    return np.abs(trapzWeights(np.asarray(X,dtype=float)))
+
+
+class Factorization:
+
+    # Factorization of the overlap matrix of a pigment basis on a given x-axis.
+    # It depends only on X and EPS_REF, so it is computed once and then
+    # applied to any number of spectra sampled on the same x-axis:
+    #   concmol = ABS @ proj.T
+    #   weights  : quadrature weights W of the points (any grid order or
+    #              spacing)
+    #   wrhs     : weighted basis EPS^T W, right-hand sides are
+    #              rhs = ABS @ wrhs.T
+    #   ovlp     : overlap matrix G = EPS^T W EPS, shape (n_pigments, n_pigments)
+    #   cond     : condition number of G scaled to unit diagonal (pigments
+    #              absorb on very different scales, the scaling removes
+    #              that part of the conditioning)
+    #   method   : 'cholesky' (normal equations), or 'qr' (weighted basis)
+    #              when cond > COND_MAX
+    #   proj     : projection operator G^-1 EPS^T W, shape
+    #              (n_pigments, n_points)
+    #   singular : rank deficiency of the basis (deconvolution not possible)
+    # Spectra given in float32 are projected in float32 (large batches).
+    def __init__(self,X,EPS_REF):
+        X       = np.asarray(X,dtype=float)
+        EPS_REF = np.asarray(EPS_REF,dtype=float)
+        N_PIGMENTS = np.shape(EPS_REF)[1]
+        self.N_PIGMENTS = N_PIGMENTS
+        self.N_POINTS   = len(X)
+        self.proj32     = None
+
+        # Overlap matrix and right-hand side operator: one weighted product
+        with METRICS.span('gram'):
+            self.weights = quadWeights(X)
+            self.wrhs    = EPS_REF.T*self.weights
+            self.ovlp    = np.dot(self.wrhs,EPS_REF)
+
+        with METRICS.span('factorize'):
+
+            # Scale to unit diagonal (a pigment without absorbance in the
+            # window makes the basis singular)
+            diag = np.diag(self.ovlp)
+            self.singular = int(np.count_nonzero(diag <= 0))
+            self.cond     = np.inf
+            self.method   = None
+            self.proj     = np.zeros((N_PIGMENTS,len(X)))
+            if(self.singular > 0):
+                return
+            d = 1/np.sqrt(diag)
+            S = self.ovlp*d[:,None]*d[None,:]
+            eig = np.linalg.eigvalsh(S)
+            if(eig[0] > 0): self.cond = eig[-1]/eig[0]
+
+            if(self.cond <= COND_MAX):
+                # Cholesky S = L L^T: proj = D L^-T L^-1 D EPS^T W
+                self.method = 'cholesky'
+                LINV = np.linalg.inv(np.linalg.cholesky(S))
+                self.proj = d[:,None]*np.dot(LINV.T,np.dot(LINV,self.wrhs*d[:,None]))
+            else:
+                # QR of the weighted, scaled basis W^1/2 EPS D = Q R, which
+                # does not square the condition number:
+                # proj = D R^-1 Q^T W^1/2
+                self.method = 'qr'
+                sw  = np.sqrt(self.weights)
+                Q,R = np.linalg.qr(EPS_REF*sw[:,None]*d[None,:])
+                rdiag = np.abs(np.diag(R))
+                self.singular = int(np.count_nonzero(
+                    rdiag <= max(np.shape(EPS_REF))*np.finfo(float).eps*rdiag.max()))
+                if(self.singular > 0):
+                    return
+                self.proj = d[:,None]*np.linalg.solve(R,(Q*sw[:,None]).T)
+
+    @property
+    def nbytes(self):
+        return (self.ovlp.nbytes+self.proj.nbytes+self.wrhs.nbytes+self.weights.nbytes+
+                (0 if self.proj32 is None else self.proj32.nbytes))
+
+    # Projection operator in the precision of the spectra
+    def _proj(self,dtype):
+        if(dtype != np.float32):
+            return self.proj
+        if self.proj32 is None:
+            self.proj32 = self.proj.astype(np.float32)
+        return self.proj32
+
+    # Concentrations (M) for a spectrum (n_points,) or a batch of
+    # spectra (n_samples, n_points)
+    def solve(self,ABS_EVOO):
+        ABS_EVOO = np.asarray(ABS_EVOO)
+        if(ABS_EVOO.dtype != np.float32):
+            ABS_EVOO = ABS_EVOO.astype(float,copy=False)
+        if(ABS_EVOO.shape[-1] != self.N_POINTS):
+            raise Exception("Spectrum has %d points, the basis has %d!"
+                            % (ABS_EVOO.shape[-1],self.N_POINTS))
+        return np.dot(ABS_EVOO,self._proj(ABS_EVOO.dtype).T)
+
+    # Non-negative concentrations (M) for a spectrum or a batch of spectra.
+    # The problem is solved on the overlap (Gram) matrix, so its cost does not
+    # depend on the number of points. Spectra whose unconstrained solution is
+    # already non-negative are solved by the matrix product only; the others
+    # go through the active-set solver, warm started from x0 (e.g. the
+    # previous solution) or from the unconstrained solution, and checked
+    # (see nnlsChecked).
+    def solveNonNeg(self,ABS_EVOO,x0=None):
+        conc     = self.solve(ABS_EVOO)
+        if(self.singular > 0):
+            return conc
+        single = conc.ndim == 1
+        conc   = np.atleast_2d(conc)
+        start  = conc if x0 is None else np.atleast_2d(np.asarray(x0,dtype=float))
+        start  = np.broadcast_to(start,conc.shape)
+        rhs    = np.dot(np.atleast_2d(np.asarray(ABS_EVOO,dtype=float)),self.wrhs.T)
+
+        bad = np.flatnonzero((conc < 0).any(axis=1))
+        if len(bad):
+            METRICS.inc('nnls_active_set_total',len(bad))
+            conc[bad] = nnlsChecked(self.ovlp,rhs[bad],start[bad])
+        return conc[0] if single else conc
+
+
+# >>> Inverse of the sub-block of G on the passive set P (cached in subinv)
+def _subInverse(G,P,subinv):
+    k = P.tobytes()
+    if k not in subinv:
+        idx = np.flatnonzero(P)
+        try:
+            subinv[k] = (idx,np.linalg.inv(G[np.ix_(idx,idx)]))
+        except np.linalg.LinAlgError:
+            subinv[k] = (idx,np.linalg.pinv(G[np.ix_(idx,idx)]))
+    return subinv[k]
+
+
+# >>> Tolerance on the gradient for the NNLS optimality check (G scaled to
+# unit diagonal, see _nnlsScale)
+def _nnlsTol(G,b):
+    n = np.shape(G)[0]
+    return 10*np.finfo(float).eps*np.abs(G).max()*np.maximum(1.0,np.abs(b).max(axis=-1))*n
+
+
+# >>> Scale of the NNLS variables giving G a unit diagonal. Pigments absorb
+# on very different scales (the diagonal of G goes from ~1 to ~1E12): a
+# single gradient tolerance fits all the columns only on the scaled problem.
+def _nnlsScale(G):
+    diag = np.diag(G)
+    with np.errstate(divide='ignore'):
+        return np.where(diag > 0,1/np.sqrt(np.abs(diag)),1.0)
+
+
+# >>> Active-set non-negative least squares on the normal equations:
+# minimize x.G.x - 2 b.x subject to x >= 0, for one or many right-hand sides.
+# Block principal pivoting (Kim & Park, 2011): at each iteration all the
+# infeasible variables are exchanged between the passive and the active set
+# (with a single-variable backup rule to guarantee termination). Right-hand
+# sides sharing the same passive set are solved together by a matrix product.
+# The problem is solved on the columns scaled to unit diagonal.
+#   G      : Gram matrix, shape (n, n)
+#   B      : right-hand sides, shape (n,) or (m, n)
+#   x0     : warm start, its positive entries are the initial passive set
+#   subinv : dict used to cache the inverse of the (scaled) G sub-blocks
+def nnlsGram(G,B,x0=None,subinv=None,maxiter=None):
+
+    single = np.ndim(B) == 1
+    B      = np.atleast_2d(np.asarray(B,dtype=float))
+    m,n    = B.shape
+    d      = _nnlsScale(G)
+    G      = np.asarray(G,dtype=float)*d[:,None]*d[None,:]
+    B      = B*d
+    if subinv is None: subinv = {}
+    if maxiter is None: maxiter = 10*n+10
+    if x0 is None:
+        F = np.zeros((m,n),dtype=bool)
+    else:
+        F = np.broadcast_to(np.atleast_2d(np.asarray(x0)) > 0,(m,n)).copy()
+
+    X     = np.zeros((m,n))
+    tol   = _nnlsTol(G,B)[:,None]
+    alpha = np.full(m,3)
+    ninf  = np.full(m,n+1)
+    todo  = np.arange(m)
+
+    for it in range(maxiter):
+
+        # Solve the unconstrained problem on the passive sets
+        patterns,group = np.unique(F[todo],axis=0,return_inverse=True)
+        group = np.ravel(group)
+        for k,P in enumerate(patterns):
+            rows = todo[group == k]
+            idx,inv = _subInverse(G,P,subinv)
+            x = np.zeros((len(rows),n))
+            x[:,idx] = np.dot(B[rows][:,idx],inv)
+            X[rows] = x
+
+        # Infeasible variables: negative in the passive set or with a
+        # negative gradient in the active set
+        Ft = F[todo]
+        Y  = np.dot(X[todo],G)-B[todo]
+        V  = (Ft & (X[todo] < 0)) | (~Ft & (Y < -tol[todo]))
+        nv = V.sum(axis=1)
+
+        keep = nv > 0
+        todo,V,nv = todo[keep],V[keep],nv[keep]
+        if not len(todo): break
+
+        # Full exchange while the number of infeasible variables decreases
+        # (or for up to 3 more iterations), then exchange only the last one
+        better = nv < ninf[todo]
+        a      = alpha[todo]
+        full   = better | (a >= 1)
+        ninf[todo]  = np.where(better,nv,ninf[todo])
+        alpha[todo] = np.where(better,3,np.where(a >= 1,a-1,a))
+        if (~full).any():
+            last = n-1-np.argmax(V[~full][:,::-1],axis=1)
+            V[~full] = False
+            V[np.flatnonzero(~full),last] = True
+        F[todo] ^= V
+
+    X = np.maximum(X,0.0)*d
+    return X[0] if single else X
+
+
+# >>> Optimality of NNLS solutions X of nnlsGram(G,B) (one flag per
+# right-hand side): KKT conditions on the scaled problem, X >= 0 with a
+# non-negative gradient, zero where X > 0 (rtol relative to the scaled
+# right-hand side)
+def nnlsOptimal(G,B,X,rtol=1E-8):
+    d    = _nnlsScale(G)
+    GS   = np.asarray(G,dtype=float)*d[:,None]*d[None,:]
+    BS   = np.atleast_2d(np.asarray(B,dtype=float))*d
+    Y    = np.atleast_2d(np.asarray(X,dtype=float))/d
+    grad = np.dot(Y,GS)-BS
+    tol  = rtol*np.maximum(1.0,np.abs(BS).max(axis=1))[:,None]
+    return np.all((Y >= 0) & (grad >= -tol) & ((Y == 0) | (np.abs(grad) <= tol)),axis=1)
+
+
+# >>> NNLS objective x.G.x - 2 b.x of the solutions X (one per row of B)
+def nnlsObjective(G,B,X):
+    X = np.atleast_2d(X)
+    return np.einsum('mi,ij,mj->m',X,G,X)-2*np.sum(np.atleast_2d(B)*X,axis=1)
+
+
+# >>> nnlsGram warm started from x0, with the optimality of the solutions
+# checked: the right-hand sides failing the check (e.g. maxiter reached)
+# are counted in nnls_suboptimal_total and solved again from a cold start,
+# the lower objective is kept
+def nnlsChecked(G,B,x0=None):
+    single = np.ndim(B) == 1
+    B      = np.atleast_2d(np.asarray(B,dtype=float))
+    subinv = {}
+    X      = nnlsGram(G,B,x0,subinv)
+    fail   = np.flatnonzero(~nnlsOptimal(G,B,X))
+    if len(fail):
+        METRICS.inc('nnls_suboptimal_total',len(fail))
+        if x0 is not None:
+            cold  = nnlsGram(G,B[fail],subinv=subinv)
+            lower = nnlsObjective(G,B[fail],cold) < nnlsObjective(G,B[fail],X[fail])
+            X[fail[lower]] = cold[lower]
+    return X[0] if single else X
+
+
+# >>> Factorize the overlap matrix of the pigment basis
+def factorize(X,EPS_REF,log=None):
+    fact = Factorization(X,EPS_REF)
+    if(fact.singular > 0):
+        msg = "\nError!\nPigment basis is singular (rank deficiency %d)\nDeconvolution is not possibile!\n" % fact.singular
+        _log(log,msg)
+    elif(fact.method == 'qr'):
+        _log(log,"\nWarning!\nIll-conditioned pigment basis (condition number %.1e), "
+                 "solved by QR\n" % fact.cond)
+    return fact
+
+
+class OperatorCache:
+
+    # Bounded LRU cache of operators built from arrays (anything with an
+    # nbytes attribute). Entries are evicted (least recently used first)
+    # when there are more than maxsize of them or when they take more than
+    # maxbytes of memory. NAME labels the cache in the metrics.
+    NAME = 'operator'
+
+    def __init__(self,maxsize=32,maxbytes=64*1024**2):
+        self.maxsize   = maxsize
+        self.maxbytes  = maxbytes
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.nbytes    = 0
+        self._data     = OrderedDict()
+        self._lock     = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    # Operator stored under key, built by build() if it is not cached
+    def lookup(self,key,build,log=None,msg=None):
+        with self._lock:
+            op = self._data.get(key)
+            if op is not None:
+                self._data.move_to_end(key)
+                self.hits += 1
+                METRICS.inc('cache_hits_total',cache=self.NAME)
+                if msg: _log(log,msg)
+                return op
+            self.misses += 1
+            METRICS.inc('cache_misses_total',cache=self.NAME)
+
+        op = build()
+
+        with self._lock:
+            if key in self._data or op.nbytes > self.maxbytes or self.maxsize < 1:
+                return op
+            self._data[key] = op
+            self.nbytes    += op.nbytes
+            while len(self._data) > self.maxsize or self.nbytes > self.maxbytes:
+                old_key,old = self._data.popitem(last=False)
+                self.nbytes    -= old.nbytes
+                self.evictions += 1
+                METRICS.inc('cache_evictions_total',cache=self.NAME)
+        return op
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'hits'      : self.hits,
+                    'misses'    : self.misses,
+                    'evictions' : self.evictions,
+                    'entries'   : len(self._data),
+                    'nbytes'    : self.nbytes,
+                    'maxsize'   : self.maxsize,
+                    'maxbytes'  : self.maxbytes}
+
+
+class FactorizationCache(OperatorCache):
+
+    # Cache of overlap-matrix factorizations.
+    # The key is a content hash of X and EPS_REF, or any hashable value
+    # identifying them (analyze uses the reference digest, the spectral
+    # window and the pigment mask).
+    NAME = 'factorization'
+
+    def get(self,X,EPS_REF,key=None,log=None):
+        if key is None: key = arrayDigest(X,EPS_REF)
+        return self.lookup(key,lambda: factorize(X,EPS_REF,log),log,
+                           "Using cached factorization of the overlap matrix\n")
+
+
+class ResamplerCache(OperatorCache):
+
+    # Cache of resampling operators, keyed by the source and target x-axes
+    # and the kernel
+    NAME = 'resampler'
+
+    def get(self,X,X_NEW,kind='spline'):
+        key = (arrayDigest(X),arrayDigest(X_NEW),kind)
+        return self.lookup(key,lambda: Resampler(X,X_NEW,kind))
+
+
+class FilterCache(OperatorCache):
+
+    # Cache of Savitzky-Golay filters, keyed by the window, the order, the
+    # derivative and the grid step
+    NAME = 'savgol'
+
+    def get(self,window,order=2,deriv=0,step=1.0):
+        key = (int(window),int(order),int(deriv),float(step))
+        return self.lookup(key,lambda: savgol.SavitzkyGolay(*key))
+
+
+# Default caches shared by deconvolve, interpolateTo and analyze
+CACHE      = FactorizationCache()
+RESAMPLERS = ResamplerCache()
+FILTERS    = FilterCache()
+
+
+# >>> Interpolation of spectra (n_points,) or (n_samples, n_points) on a
+# new x-axis. The resampling operator of the two grids is reused from cache
+# (pass cache=None to disable it).
+def interpolateTo(X,ABS,X_NEW,kind='spline',cache=RESAMPLERS):
+    if cache is None:
+        return Resampler(X,X_NEW,kind).apply(ABS)
+    return cache.get(X,X_NEW,kind).apply(ABS)
+
+
+# >>> Deconvolution function
+# ABS_EVOO can be a single spectrum (n_points,) or a batch of spectra
+# (n_samples, n_points) sharing the x-axis: the overlap matrix is factorized
+# once and all the concentrations come from a single matrix product.
+# Factorizations are reused from cache (pass cache=None to disable it).
+# solver is 'unconstrained' (projection on the pigment basis) or 'nnls'
+# (non-negative concentrations, x0 is an optional warm start).
+def deconvolve(X,EPS_REF,ABS_EVOO,log=None,cache=CACHE,key=None,
+    solver='unconstrained',x0=None):
+
+    _log(log,"Executing deconvolution...\n")
+    if cache is None:
+        fact = factorize(X,EPS_REF,log)
+    else:
+        fact = cache.get(X,EPS_REF,key,log)
+    if solver not in ['nnls','unconstrained']:
+        raise Exception("Unknown solver '%s'!" % solver)
+    with METRICS.span('solve',solver=solver):
+        if(solver == 'nnls'):
+            return fact.solveNonNeg(ABS_EVOO,x0)
+        return fact.solve(ABS_EVOO)
+
+
+ALIGN_ITER = 5       # Fits and shifts of the alignment
+ALIGN_TOL  = 1E-3    # Convergence of the shifts (nm)
+
+
+# >>> Wavelength shift of the spectra ABS_EVOO on the evenly spaced x-axis
+# X against their reconstruction on EPS_REF (factorization fact): the
+# spectra are fitted, shifted by the FFT cross-correlation against the
+# reconstruction, then refitted and shifted by Gauss-Newton steps until the
+# shifts change by less than ALIGN_TOL. All the spectra of a batch are
+# fitted and shifted at once. project (optional) is applied to the spectra
+# before comparing them with the reconstruction (e.g. to remove a joint
+# baseline). Returns the aligned spectra and the shifts (nm).
+def alignSpectra(X,EPS_REF,ABS_EVOO,fact,max_shift=5.0,log=None,project=None):
+    step  = gridStep(X,"Alignment")
+    ABS   = np.atleast_2d(np.asarray(ABS_EVOO,dtype=float))
+    SHIFT = np.zeros(len(ABS))
+    ALIGNED = ABS
+    with METRICS.span('align'):
+        for it in range(ALIGN_ITER):
+            Y     = ALIGNED if project is None else project(ALIGNED)
+            MODEL = np.dot(fact.solve(Y),EPS_REF.T)
+            if(it == 0):
+                delta = align.xcorrShift(Y,MODEL,step,max_shift)
+            else:
+                delta = align.newtonShift(Y,MODEL,step)
+            SHIFT   = np.clip(SHIFT+delta,-max_shift,max_shift)
+            ALIGNED = align.shiftSpectra(ABS,SHIFT,step)
+            if(np.max(np.abs(delta)) < ALIGN_TOL):
+                break
+    METRICS.inc('aligned_spectra_total',len(ABS))
+    if(np.ndim(ABS_EVOO) == 1):
+        _log(log,"Wavelength shift of the sample %+.3f nm\n" % SHIFT[0])
+        return ALIGNED[0].astype(ABS_EVOO.dtype,copy=False),SHIFT[0]
+    _log(log,"Wavelength shifts of the samples %+.3f to %+.3f nm\n"
+             % (SHIFT.min(),SHIFT.max()))
+    return ALIGNED.astype(ABS_EVOO.dtype,copy=False),SHIFT
+
+
+SELECT_CRITERIA = ('aic','aicc','bic')
+SELECT_MAX_PIGMENTS = 20    # 2^20 subsets
+
+
+class Selection:
+
+    # Exhaustive selection of the pigment subset (see selectSubsets)
+    #   criterion : 'aic', 'aicc' or 'bic'
+    #   PIGMENTS  : candidate pigments
+    #   SUBSETS   : boolean masks over the candidates of the subsets
+    #               evaluated, shape (n_subsets, n_candidates)
+    #   CRIT      : criterion of every subset (lower is better)
+    #   RSS       : mean squared residual of every subset
+    #   BEST      : mask of the best subset
+    # For a batch of samples CRIT, RSS and BEST have one leading row per
+    # sample.
+    def __init__(self,**kwargs):
+        self.__dict__.update(kwargs)
+
+    # The top best subsets of a sample: (criterion, pigments) pairs
+    def ranking(self,top=10,sample=None):
+        CRIT = self.CRIT if sample is None else self.CRIT[sample]
+        order = np.argsort(CRIT,kind='stable')[:top]
+        return [(CRIT[i],[p for p,f in zip(self.PIGMENTS,self.SUBSETS[i]) if f])
+                for i in order]
+
+
+# >>> Criterion of a model with k parameters, n points and mean squared
+# residual rss
+def infoCriterion(rss,k,n,criterion='bic'):
+    if criterion not in SELECT_CRITERIA:
+        raise Exception("Unknown selection criterion '%s'!" % criterion)
+    fit = n*np.log(np.maximum(rss,np.finfo(float).tiny))
+    if(criterion == 'bic'):
+        return fit+k*np.log(n)
+    aic = fit+2*k
+    if(criterion == 'aicc'):
+        return aic+2*k*(k+1)/np.maximum(n-k-1,1)
+    return aic
+
+
+# >>> Least squares fit of every subset of the pigments from the Gram matrix
+# of the full basis: minimize |y - EPS c|^2 with
+#   G  = EPS^T EPS, shape (n, n)
+#   B  = EPS^T y, shape (n,) or (m, n) for m spectra
+#   yy = y^T y, scalar or (m,)
+# (the weighted sums of the quadrature, normalized by the sum of the weights,
+# so the residual is a mean square). The subsets are visited depth first,
+# each one is its parent plus a pigment, and the inverse Cholesky factor
+# L^-1 of G on the subset grows by one row:
+#   l = L^-1 g, d = sqrt(G_jj - l.l), new row [-l.L^-1/d, 1/d]
+# while z = L^-1 b grows by (b_j - l.z)/d, so b.G^-1.b = z.z costs O(k^2) per
+# subset; going back to the parent drops the last row. All the children of
+# a subset are computed together by a matrix product. A pigment linearly
+# dependent on the subset (d^2 <= tol G_jj) ends its branch.
+# Returns the subset masks, shape (n_subsets, n), and the mean squared
+# residuals, shape (n_subsets,) or (m, n_subsets).
+def fitSubsets(G,B,yy,max_size=None,tol=1E-10):
+
+    G    = np.asarray(G,dtype=float)
+    n    = len(G)
+    if(n > SELECT_MAX_PIGMENTS):
+        raise Exception("Too many pigments for an exhaustive selection (%d > %d)!"
+                        % (n,SELECT_MAX_PIGMENTS))
+    single = np.ndim(B) == 1
+    B    = np.atleast_2d(np.asarray(B,dtype=float))
+    yy   = np.atleast_1d(np.asarray(yy,dtype=float))
+    GD   = np.diag(G)
+    if max_size is None: max_size = n
+
+    LINV  = np.zeros((n,n))
+    Z     = np.zeros((len(B),n))
+    SUB   = np.zeros(n,dtype=int)
+    CODES = []
+    EXPL  = []
+
+    def visit(k,start,code,expl):
+        L  = np.dot(LINV[:k,:k],G[SUB[:k],start:])
+        d2 = GD[start:]-np.sum(L*L,axis=0)
+        ok = d2 > tol*GD[start:]
+        d  = np.sqrt(np.where(ok,d2,1.0))
+        ZN = (B[:,start:]-np.dot(Z[:,:k],L))/d
+        E  = expl[:,None]+ZN**2
+        for c in np.flatnonzero(ok):
+            j = start+c
+            CODES.append(code | 1 << j)
+            EXPL.append(E[:,c])
+            if(k+1 < max_size and j+1 < n):
+                SUB[k]     = j
+                LINV[k,:k] = -np.dot(L[:,c],LINV[:k,:k])/d[c]
+                LINV[k,k]  = 1/d[c]
+                Z[:,k]     = ZN[:,c]
+                visit(k+1,j+1,code | 1 << j,E[:,c])
+
+    visit(0,0,0,np.zeros(len(B)))
+    SUBSETS = (np.array(CODES)[:,None] >> np.arange(n)) & 1 == 1
+    RSS = np.maximum(yy[:,None]-np.array(EXPL).T,0.0)
+    return SUBSETS,(RSS[0] if single else RSS)
+
+
+# >>> Deconvolution with automatic selection of the pigments: every subset
+# of the pigments is fitted (fitSubsets) on the Gram matrix of the cached
+# factorization, ranked by criterion ('aic', 'aicc' or 'bic') and the
+# concentrations of the best subset (one per sample for a batch) are
+# computed with solver. Pigments out of the best subset get a zero
+# concentration. Returns the concentrations (M) and the Selection.
+def deconvolveSelect(X,EPS_REF,ABS_EVOO,criterion='bic',log=None,cache=CACHE,
+    key=None,solver='unconstrained',max_size=None,PIGMENTS=None):
+
+    _log(log,"Executing deconvolution with pigment selection (%s)...\n" % criterion)
+    if cache is None:
+        fact = factorize(X,EPS_REF,log)
+    else:
+        fact = cache.get(X,EPS_REF,key,log)
+    if solver not in ['nnls','unconstrained']:
+        raise Exception("Unknown solver '%s'!" % solver)
+    if criterion not in SELECT_CRITERIA:
+        raise Exception("Unknown selection criterion '%s'!" % criterion)
+
+    with METRICS.span('select',criterion=criterion):
+        ABS  = np.atleast_2d(np.asarray(ABS_EVOO,dtype=float))
+        wsum = np.sum(fact.weights)
+        rhs  = np.dot(ABS,fact.wrhs.T)
+        SUBSETS,RSS = fitSubsets(fact.ovlp/wsum,rhs/wsum,np.dot(ABS**2,fact.weights)/wsum,
+                                 max_size)
+        CRIT = infoCriterion(RSS,SUBSETS.sum(axis=1),ABS.shape[1],criterion)
+        BEST = SUBSETS[np.argmin(CRIT,axis=1)]
+
+    # Concentrations on the best subsets, samples sharing a subset together
+    with METRICS.span('solve',solver=solver):
+        concmol  = np.zeros((len(ABS),fact.N_PIGMENTS))
+        patterns,group = np.unique(BEST,axis=0,return_inverse=True)
+        group = np.ravel(group)
+        for k,P in enumerate(patterns):
+            rows = np.flatnonzero(group == k)
+            idx  = np.flatnonzero(P)
+            G    = fact.ovlp[np.ix_(idx,idx)]
+            B    = rhs[rows][:,idx]
+            conc = np.linalg.solve(G,B.T).T
+            if(solver == 'nnls'):
+                # Active set warm started from the unconstrained solution
+                # and checked (as Factorization.solveNonNeg): the selection
+                # never ends worse than plain nnls on the same pigments.
+                bad = np.flatnonzero((conc < 0).any(axis=1))
+                if len(bad):
+                    conc[bad] = nnlsChecked(G,B[bad],conc[bad])
+            concmol[np.ix_(rows,idx)] = conc
+    METRICS.inc('subsets_total',SUBSETS.shape[0]*len(ABS))
+
+    if(np.ndim(ABS_EVOO) == 1):
+        concmol,CRIT,RSS,BEST = concmol[0],CRIT[0],RSS[0],BEST[0]
+    sel = Selection(criterion=criterion,PIGMENTS=PIGMENTS,SUBSETS=SUBSETS,
+                    CRIT=CRIT,RSS=RSS,BEST=BEST)
+    return concmol,sel
+
+
+# >>> Format the ranking of the pigment subsets as text
+def formatSelection(sel,top=5,sample=None):
+    ranking = sel.ranking(top,sample)
+    out  = 'Pigment selection (%s, %d subsets)\n' % (sel.criterion.upper(),len(sel.SUBSETS))
+    out += '   DELTA  PIGMENTS\n'
+    out += '-------------------------------\n'
+    for crit,pigments in ranking:
+        out += '%8.2f  %s\n' % (crit-ranking[0][0],', '.join(pigments))
+    out += '-------------------------------\n'
+    return out
+
+
+# >>> Convert concentrations between mol/L and mg/kg
+def molToPpm(concmol,MW):
+    return concmol*MW*1000/EVOO_DENSITY
+
+def ppmToMol(concppm,MW):
+    return concppm*EVOO_DENSITY/(MW*1000)
+
+
+# >>> Reconstruct the spectrum from pigment concentrations (mol/L)
+# For a batch of concentrations (n_samples, n_pigments) the contributions
+# of the single pigments are not computed
+def reconstruct(EPS_REF,concmol):
+    ABS_CALC = np.dot(concmol,EPS_REF.T)
+    if(np.ndim(concmol) > 1):
+        return(ABS_CALC,None)
+    ABS_CALC_CONTR = EPS_REF*concmol
+    return(ABS_CALC,ABS_CALC_CONTR)
+
+
+# >>> R^2 of the fitting (one value per spectrum for a batch)
+def rsquare(ABS_EVOO,ABS_CALC):
+    ave = np.average(ABS_EVOO,axis=-1)[...,None]
+    return 1-np.sum((ABS_EVOO-ABS_CALC)**2,axis=-1)/np.sum((ABS_EVOO-ave)**2,axis=-1)
+
+
+# >>> Full pipeline: pre-processing, deconvolution and reconstruction
+# (evoo can hold a single spectrum or a batch of spectra)
+# x0 is an optional warm start for the 'nnls' solver (concentrations in M
+# of the selected pigments)
+def analyze(ref,evoo,opts=None,log=None,cache=CACHE,x0=None):
+
+    if opts is None: opts = Options()
+    proc = processSpectra(ref,evoo,opts,log)
+    return fitSpectra(ref,proc,opts,log,cache,x0,evoo.filename,evoo.names)
+
+
+# >>> Deconvolution and reconstruction of pre-processed spectra
+# proc is the tuple returned by processSpectra
+def fitSpectra(ref,proc,opts=None,log=None,cache=CACHE,x0=None,filename='',
+    names=None):
+
+    if opts is None: opts = Options()
+    X_REF,EPS_REF,X_EVOO,ABS_EVOO,X_SEL_LIM,warn = proc
+
+    # Apply pigment filter
+    FILTER   = opts.mask(len(ref.PIGMENTS))
+    PIGMENTS = [p for p,f in zip(ref.PIGMENTS,FILTER) if f]
+    MW       = ref.MW[FILTER]
+    EPS_REF  = EPS_REF[:,FILTER]
+
+    # Cache key of the factorization (the window is a contiguous slice of
+    # the reference x-axis, so its limits and size identify it, with the
+    # filter applied to EPS_REF)
+    key = (ref.digest,X_REF[0],X_REF[-1],len(X_REF),FILTER.tobytes())
+    if opts.SG_WINDOW is not None:
+        key += (('savgol',int(opts.SG_WINDOW),int(opts.SG_ORDER),int(opts.SG_DERIV)),)
+
+    # Joint baseline: the pigments are fitted on EPS_REF projected out of
+    # the Legendre polynomials (orthogonal complement for the quadrature
+    # weights), which gives the same concentrations as fitting the
+    # polynomials as extra columns of the basis
+    EPS_FIT = EPS_REF
+    if opts.JOINT_BASELINE is not None:
+        BASIS = baseline.legendre(X_REF,int(opts.JOINT_BASELINE))
+        WB    = BASIS.T*quadWeights(X_REF)
+        HAT   = np.linalg.solve(np.dot(WB,BASIS),WB)
+        EPS_FIT = EPS_REF-np.dot(BASIS,np.dot(HAT,EPS_REF))
+        key  += (('joint',int(opts.JOINT_BASELINE)),)
+        _log(log,"Fit baseline of order %d with the pigments\n" % opts.JOINT_BASELINE)
+    project = None
+    if opts.JOINT_BASELINE is not None:
+        project = lambda Y: Y-np.dot(np.dot(Y,HAT.T),BASIS.T)
+
+    # Align the sample to its reconstruction
+    SHIFT = None
+    if opts.ALIGN:
+        fact = factorize(X_REF,EPS_FIT,log) if cache is None else cache.get(X_REF,EPS_FIT,key,log)
+        ABS_EVOO,SHIFT = alignSpectra(X_REF,EPS_FIT,ABS_EVOO,fact,opts.ALIGN_MAX,log,project)
+
+    # Execute deconvolution
+    if opts.SELECT is None:
+        sel     = None
+        ABS_IN  = ABS_EVOO.astype(np.float32 if opts.FLOAT32 else float,copy=False)
+        concmol = deconvolve(X_REF,EPS_FIT,ABS_IN,log,cache,key,opts.SOLVER,x0)
+        concmol = concmol.astype(float,copy=False)
+    elif(opts.CI > 0):
+        raise Exception("Confidence intervals are not available with pigment selection!")
+    else:
+        ABS_IN  = ABS_EVOO if project is None else project(ABS_EVOO)
+        concmol,sel = deconvolveSelect(X_REF,EPS_FIT,ABS_IN,opts.SELECT,log,cache,
+                                       key,opts.SOLVER,opts.SELECT_MAX,PIGMENTS)
+    concppm = molToPpm(concmol,MW)
+
+    # Compute deconvolved spectrum (joint baseline included) and residues
+    with METRICS.span('reconstruct'):
+        ABS_CALC,ABS_CALC_CONTR = reconstruct(EPS_REF,concmol)
+        ABS_BASE = BASE_COEF = None
+        if opts.JOINT_BASELINE is not None:
+            BASE_COEF = np.dot(ABS_EVOO-ABS_CALC,HAT.T)
+            ABS_BASE  = np.dot(BASE_COEF,BASIS.T)
+            ABS_CALC  = ABS_CALC+ABS_BASE
+        RSQ = rsquare(ABS_EVOO,ABS_CALC)
+    METRICS.inc('spectra_total',len(np.atleast_2d(ABS_EVOO)))
+
+    res = Result(PIGMENTS=PIGMENTS,MW=MW,FILTER=FILTER,concmol=concmol,
+                 concppm=concppm,X_REF=X_REF,EPS_REF=EPS_REF,X_EVOO=X_EVOO,
+                 ABS_EVOO=ABS_EVOO,ABS_CALC=ABS_CALC,
+                 ABS_CALC_CONTR=ABS_CALC_CONTR,RSQ=RSQ,X_SEL_LIM=X_SEL_LIM,
+                 warn=warn,filename=filename,names=names,solver=opts.SOLVER,
+                 key=key,CI=None,SELECTION=sel,EPS_FIT=EPS_FIT,
+                 ABS_BASE=ABS_BASE,BASE_COEF=BASE_COEF,SHIFT=SHIFT)
+    if(opts.CI > 0):
+        res.CI = confidenceIntervals(res,opts.CI,opts.CI_METHOD,opts.CI_LEVEL,
+                                     opts.NOISE,opts.OPLEN_SD,opts.SEED,
+                                     opts.CI_WORKERS,cache)
+    return res
+
+
+class Intervals:
+
+    # Confidence intervals of the concentrations (see confidenceIntervals)
+    #   method    : 'bootstrap' or 'montecarlo'
+    #   n         : number of replicates
+    #   level     : confidence level
+    #   low, high : limits of the intervals (mg/kg)
+    #   std       : standard deviation of the replicates (mg/kg)
+    # For a batch of samples low, high and std have one leading row per
+    # sample.
+    def __init__(self,**kwargs):
+        self.__dict__.update(kwargs)
+
+    # Limits over all the pigments of the reference (NaN for the pigments
+    # excluded by FILTER)
+    def limitsAll(self,FILTER):
+        out = []
+        for lim in [self.low,self.high]:
+            conc = np.full(np.shape(lim)[:-1]+(len(FILTER),),np.nan)
+            conc[...,FILTER] = lim
+            out.append(conc)
+        return out
+
+
+CI_METHODS = ('bootstrap','montecarlo')
+CI_CHUNK   = 512     # Replicates deconvolved by each matrix product
+
+
+# >>> Confidence intervals of the concentrations of a deconvolution result
+# (Result of fitSpectra) from n perturbed replicates of every spectrum:
+#   bootstrap  : fitted spectrum plus residuals resampled with replacement
+#   montecarlo : measured spectrum plus gaussian noise of standard deviation
+#                noise (default: the residual RMS)
+# With oplen_sd > 0 every replicate is also divided by a random relative
+# error of the optical path length. The replicates are deconvolved in blocks
+# of CI_CHUNK spectra by the (cached) factorization of the fitting, a single
+# matrix product per block ('nnls' goes through the batched active-set
+# solver, warm started from the fitted concentrations). Samples of a batch
+# are spread over workers threads; each sample has its own random stream
+# derived from seed, so the intervals do not depend on workers.
+def confidenceIntervals(res,n=2000,method='bootstrap',level=0.95,noise=None,
+    oplen_sd=0.0,seed=None,workers=1,cache=CACHE):
+
+    if method not in CI_METHODS:
+        raise Exception("Unknown uncertainty method '%s'!" % method)
+    if not 0 < level < 1:
+        raise Exception("Confidence level must be between 0 and 1!")
+    n = int(n)
+    if(n < 2):
+        raise Exception("At least two replicates are needed!")
+    if cache is None:
+        fact = factorize(res.X_REF,res.EPS_FIT)
+    else:
+        fact = cache.get(res.X_REF,res.EPS_FIT,res.key)
+
+    ABS_EVOO = np.atleast_2d(res.ABS_EVOO)
+    ABS_CALC = np.atleast_2d(res.ABS_CALC)
+    concmol  = np.atleast_2d(res.concmol)
+    N_POINTS = ABS_EVOO.shape[1]
+    N_PIGMENTS = concmol.shape[1]
+    N_PARAMS = N_PIGMENTS if res.BASE_COEF is None else N_PIGMENTS+np.shape(res.BASE_COEF)[-1]
+
+    # Centered residuals, inflated for the degrees of freedom of the fitting
+    RES  = ABS_EVOO-ABS_CALC
+    RES  = (RES-RES.mean(axis=1,keepdims=True))*np.sqrt(N_POINTS/max(N_POINTS-N_PARAMS,1))
+    RMS  = np.sqrt(np.mean(RES**2,axis=1))
+    prob = [(1-level)/2,(1+level)/2]
+    streams = np.random.SeedSequence(seed).spawn(len(ABS_EVOO))
+
+    # Replicates of sample k: low, high and std of the concentrations
+    def sample(k):
+        rng  = np.random.default_rng(streams[k])
+        conc = np.empty((n,N_PIGMENTS))
+        for i in range(0,n,CI_CHUNK):
+            size = min(CI_CHUNK,n-i)
+            if(method == 'bootstrap'):
+                REP = ABS_CALC[k]+RES[k][rng.integers(0,N_POINTS,(size,N_POINTS))]
+            else:
+                sd  = RMS[k] if noise is None else noise
+                REP = ABS_EVOO[k]+sd*rng.standard_normal((size,N_POINTS))
+            if(oplen_sd > 0):
+                REP /= 1+oplen_sd*rng.standard_normal((size,1))
+            if(res.solver == 'nnls'):
+                conc[i:i+size] = fact.solveNonNeg(REP,concmol[k])
+            else:
+                conc[i:i+size] = fact.solve(REP)
+        conc = molToPpm(conc,res.MW)
+        low,high = np.quantile(conc,prob,axis=0)
+        return low,high,conc.std(axis=0,ddof=1)
+
+    with METRICS.span('uncertainty',method=method):
+        if(workers > 1 and len(ABS_EVOO) > 1):
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(min(workers,len(ABS_EVOO))) as pool:
+                out = list(pool.map(sample,range(len(ABS_EVOO))))
+        else:
+            out = [sample(k) for k in range(len(ABS_EVOO))]
+    METRICS.inc('replicates_total',n*len(ABS_EVOO),method=method)
+
+    low,high,std = [np.array(v) for v in zip(*out)]
+    if(np.ndim(res.ABS_EVOO) == 1):
+        low,high,std = low[0],high[0],std[0]
+    return Intervals(method=method,n=n,level=level,low=low,high=high,std=std)
+
+
+class Sweep:
+
+    # Deconvolution over a grid of spectral windows (see sweepWindows)
+    #   PIGMENTS        : pigments used in the deconvolution (FILTER applied)
+    #   X_START, X_END  : first and last wavelength of the windows (nm), the
+    #                     window (i, j) goes from X_START[i] to X_END[j]
+    #   NPT             : number of points of every window, shape
+    #                     (n_start, n_end), 0 for the windows not evaluated
+    #   concppm         : concentrations (mg/kg), shape
+    #                     (n_start, n_end, n_pigments), NaN out of the windows
+    #                     evaluated
+    #   RSQ             : R^2, shape (n_start, n_end)
+    #   names           : sample ids (batch only)
+    # For a batch of samples concppm and RSQ have an extra axis before the
+    # pigments: (n_start, n_end, n_samples, ...).
+    def __init__(self,**kwargs):
+        self.__dict__.update(kwargs)
+
+    # Stability of the concentrations over the windows evaluated: mean,
+    # standard deviation and relative standard deviation of every pigment
+    # (one row per sample for a batch)
+    def stability(self):
+        valid = self.NPT > 0
+        conc  = self.concppm[valid]
+        ave   = conc.mean(axis=0)
+        std   = conc.std(axis=0)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            rsd = np.abs(std/ave)
+        return ave,std,rsd
+
+    # Window of highest R^2 (of sample k for a batch): start, end (nm)
+    def best(self,k=None):
+        RSQ = self.RSQ if k is None else self.RSQ[...,k]
+        RSQ = np.where(self.NPT > 0,RSQ,-np.inf)
+        i,j = np.unravel_index(np.argmax(RSQ),RSQ.shape)
+        return self.X_START[i],self.X_END[j]
+
+
+# >>> Cumulative trapezoidal integrals of F (first axis over X):
+# integral of F from X[i] to X[j] = C[j]-C[i]
+def cumTrapz(X,F):
+    dx = np.abs(np.diff(X)).reshape((-1,)+(1,)*(np.ndim(F)-1))
+    C  = np.zeros(np.shape(F))
+    np.cumsum((F[1:]+F[:-1])*dx/2,axis=0,out=C[1:])
+    return C
+
+
+# >>> Deconvolution over the grid of spectral windows from X_START[i] to
+# X_END[j] (nm), the same as analyze on every window (opts is used as
+# given, apart from the window and the pigment selection). Without baseline
+# or with the 'min' baseline correction the sample is resampled once on the
+# widest window, then every quadrature the deconvolution and R^2 need is a
+# difference of prefix sums over the reference x-axis:
+#   overlap matrix   : cumulative integrals of EPS_a*EPS_b
+#   right-hand sides : cumulative integrals of EPS_a*ABS
+#   R^2              : cumulative sums of ABS, ABS^2, EPS_a, EPS_a*ABS and
+#                      EPS_a*EPS_b
+# so the cost of a window does not depend on its number of points, and the
+# linear systems of all the windows are solved by a single batched call
+# (per window with the 'nnls' solver). The 'min' baseline correction
+# (minimum of the window) enters as a shift of the same sums. The other
+# baseline models and the Savitzky-Golay filter depend on the whole window:
+# those sweeps deconvolve every window on its own (see _sweepEach), which
+# costs a full deconvolution per window. Windows with fewer than min_points
+# points (default: number of pigments + 1) are not evaluated.
+def sweepWindows(ref,evoo,X_START,X_END,opts=None,log=None,min_points=None):
+
+    if opts is None: opts = Options()
+    if opts.JOINT_BASELINE is not None:
+        raise Exception("Joint baseline is not available in window sweeps!")
+    X_START = np.atleast_1d(np.asarray(X_START,dtype=float))
+    X_END   = np.atleast_1d(np.asarray(X_END,dtype=float))
+    shifted = opts.baselineModel() == 'min'
+    each    = opts.SG_WINDOW is not None or opts.baselineModel() not in [None,'min']
+    full    = Options(**dict(opts.__dict__,X_SEL_MIN=X_START.min(),
+                             X_SEL_MAX=X_END.max(),SG_WINDOW=None,BASELINE=False))
+    X_REF,EPS_REF,X_EVOO,ABS_EVOO,X_SEL_LIM,warn = processSpectra(ref,evoo,full,log)
+    RAW = ABS_EVOO
+
+    FILTER   = opts.mask(len(ref.PIGMENTS))
+    PIGMENTS = [p for p,f in zip(ref.PIGMENTS,FILTER) if f]
+    MW       = ref.MW[FILTER]
+    EPS      = EPS_REF[:,FILTER]
+    if min_points is None: min_points = len(PIGMENTS)+1
+    if each:
+        return _sweepEach(ref,evoo,X_REF,X_START,X_END,opts,PIGMENTS,min_points,log)
+
+    # Alignment on the widest window (the 'min' shifts follow it)
+    if opts.ALIGN:
+        ABS_EVOO,SHIFT = alignSpectra(X_REF,EPS,ABS_EVOO,factorize(X_REF,EPS),
+                                      opts.ALIGN_MAX,log)
+        RAW = align.shiftSpectra(RAW,SHIFT,gridStep(X_REF))
+    if opts.SOLVER not in ['nnls','unconstrained']:
+        raise Exception("Unknown solver '%s'!" % opts.SOLVER)
+    _log(log,"Sweeping %d x %d spectral windows...\n" % (len(X_START),len(X_END)))
+
+    with METRICS.span('sweep'):
+
+        # Ascending x-axis, samples on the last axis
+        order = np.argsort(X_REF)
+        X     = X_REF[order]
+        EPS   = EPS[order]
+        Y     = np.atleast_2d(ABS_EVOO)[:,order].T
+        RAW   = np.atleast_2d(RAW)[:,order].T
+        N,M   = Y.shape
+
+        # Prefix sums (cumulative integrals and plain sums)
+        EE  = EPS[:,:,None]*EPS[:,None,:]
+        EY  = EPS[:,:,None]*Y[:,None,:]
+        CEE = cumTrapz(X,EE)
+        CEY = cumTrapz(X,EY)
+        CE  = cumTrapz(X,EPS)
+        SEE = np.cumsum(np.concatenate([np.zeros((1,)+EE.shape[1:]),EE]),axis=0)
+        SEY = np.cumsum(np.concatenate([np.zeros((1,)+EY.shape[1:]),EY]),axis=0)
+        SE  = np.cumsum(np.concatenate([np.zeros((1,)+EPS.shape[1:]),EPS]),axis=0)
+        SY  = np.cumsum(np.concatenate([np.zeros((1,M)),Y]),axis=0)
+        SYY = np.cumsum(np.concatenate([np.zeros((1,M)),Y**2]),axis=0)
+
+        # Windows: first point i, last point j
+        II,JJ,NPT = _sweepGrid(X,X_START,X_END,min_points)
+        valid = NPT > 0
+        i,j,n = II[valid],JJ[valid],NPT[valid]
+
+        # Baseline correction: minimum of every window
+        shift = np.zeros((len(i),M))
+        if shifted:
+            for a in np.unique(i):
+                run = np.minimum.accumulate(RAW[a:],axis=0)
+                sel = i == a
+                shift[sel] = run[j[sel]-a]
+
+        # Overlap matrices and right-hand sides of the windows
+        G = CEE[j]-CEE[i]
+        B = CEY[j]-CEY[i]-(CE[j]-CE[i])[:,:,None]*shift[:,None,:]
+        try:
+            C = np.linalg.solve(G,B).transpose(0,2,1)
+        except np.linalg.LinAlgError:
+            C = np.full((len(i),M,len(PIGMENTS)),np.nan)
+            for w in range(len(i)):
+                try:
+                    C[w] = np.linalg.solve(G[w],B[w]).T
+                except np.linalg.LinAlgError:
+                    pass
+        if(opts.SOLVER == 'nnls'):
+            for w in np.flatnonzero((C < 0).any(axis=(1,2))):
+                C[w] = nnlsChecked(G[w],B[w].T,C[w])
+
+        # R^2 (plain sums, as rsquare)
+        GS = SEE[j+1]-SEE[i]
+        BS = SEY[j+1]-SEY[i]-(SE[j+1]-SE[i])[:,:,None]*shift[:,None,:]
+        SY_  = SY[j+1]-SY[i]-n[:,None]*shift
+        SYY_ = SYY[j+1]-SYY[i]-2*shift*(SY[j+1]-SY[i])+n[:,None]*shift**2
+        RSS = (SYY_-2*np.einsum('wmp,wpm->wm',C,BS)+
+               np.einsum('wmp,wpq,wmq->wm',C,GS,C))
+        TSS = SYY_-SY_**2/n[:,None]
+        RSQ_W = 1-np.maximum(RSS,0.0)/TSS
+
+    # Singular windows (a pigment without absorbance) are not evaluated
+    singular = np.isnan(C).any(axis=(1,2))
+    if singular.any():
+        NPT[tuple(np.argwhere(valid)[singular].T)] = 0
+        valid = NPT > 0
+        C,RSQ_W = C[~singular],RSQ_W[~singular]
+    METRICS.inc('windows_total',len(C))
+    concppm = np.full(NPT.shape+(M,len(PIGMENTS)),np.nan)
+    RSQ     = np.full(NPT.shape+(M,),np.nan)
+    concppm[valid] = molToPpm(C,MW)
+    RSQ[valid]     = RSQ_W
+    if(np.ndim(ABS_EVOO) == 1):
+        concppm,RSQ = concppm[:,:,0],RSQ[:,:,0]
+    return Sweep(PIGMENTS=PIGMENTS,X_START=X_START,X_END=X_END,NPT=NPT,
+                 concppm=concppm,RSQ=RSQ,filename=evoo.filename,names=evoo.names)
+
+
+# >>> Windows of a sweep on the ascending x-axis X: first point II[i,j],
+# last point JJ[i,j] and number of points NPT[i,j] of the window from
+# X_START[i] to X_END[j] (0 for the windows not evaluated)
+def _sweepGrid(X,X_START,X_END,min_points):
+    I   = np.searchsorted(X,X_START,'left')
+    J   = np.searchsorted(X,X_END,'right')-1
+    II,JJ = np.meshgrid(I,J,indexing='ij')
+    NPT = np.maximum(JJ-II+1,0)
+    NPT[(NPT < min_points) | (II >= len(X)) | (JJ < 0)] = 0
+    return II,JJ,NPT
+
+
+# >>> Window sweep deconvolving every window on its own (analyze), for the
+# pre-processing that depends on the whole window (baseline models other
+# than 'min', Savitzky-Golay filter). X_REF is the reference x-axis of the
+# widest window; windows that cannot be deconvolved are not evaluated.
+def _sweepEach(ref,evoo,X_REF,X_START,X_END,opts,PIGMENTS,min_points,log):
+    II,JJ,NPT = _sweepGrid(np.sort(X_REF),X_START,X_END,min_points)
+    M       = len(np.atleast_2d(evoo.ABS))
+    concppm = np.full(NPT.shape+(M,len(PIGMENTS)),np.nan)
+    RSQ     = np.full(NPT.shape+(M,),np.nan)
+    base    = dict(opts.__dict__,CI=0,SELECT=None)
+    _log(log,"Sweeping %d x %d spectral windows (pre-processing of every window)...\n"
+             % (len(X_START),len(X_END)))
+    for i,j in np.argwhere(NPT > 0):
+        try:
+            res = analyze(ref,evoo,Options(**dict(base,X_SEL_MIN=X_START[i],
+                                                  X_SEL_MAX=X_END[j])))
+        except Exception:
+            NPT[i,j] = 0
+            continue
+        if np.isnan(res.concppm).any():
+            NPT[i,j] = 0
+            continue
+        concppm[i,j] = np.reshape(res.concppm,(M,len(PIGMENTS)))
+        RSQ[i,j]     = res.RSQ
+    METRICS.inc('windows_total',int((NPT > 0).sum()))
+    if not evoo.isBatch():
+        concppm,RSQ = concppm[:,:,0],RSQ[:,:,0]
+    return Sweep(PIGMENTS=PIGMENTS,X_START=X_START,X_END=X_END,NPT=NPT,
+                 concppm=concppm,RSQ=RSQ,filename=evoo.filename,names=evoo.names)
+
+
+class ManualFit:
+
+    # Manual fitting of a processed spectrum: pigment concentrations are
+    # changed one at a time and the reconstructed spectrum and R^2 are
+    # updated incrementally.
+    #   ABS_CALC       : reconstructed spectrum (running total)
+    #   ABS_CALC_CONTR : contribution of each pigment
+    #   concmol        : concentrations (M)
+    # R^2 comes from the residual sum of squares
+    #   |ABS-ABS_CALC|^2 = ABS.ABS - 2 b.c + c.G.c
+    # with G = EPS^T EPS, b = EPS^T ABS and the gradient G.c kept up to date,
+    # so a change costs O(n_points) for the spectra and O(n_pigments) for R^2.
+    def __init__(self,X_REF,EPS_REF,ABS_EVOO,MW,concppm=None):
+        self.X_REF    = np.asarray(X_REF,dtype=float)
+        self.EPS_REF  = np.asarray(EPS_REF,dtype=float)
+        self.ABS_EVOO = np.asarray(ABS_EVOO,dtype=float)
+        self.MW       = np.asarray(MW,dtype=float)
+        N_PIGMENTS    = np.shape(self.EPS_REF)[1]
+
+        self._G   = np.dot(self.EPS_REF.T,self.EPS_REF)
+        self._b   = np.dot(self.ABS_EVOO,self.EPS_REF)
+        self._yy  = np.dot(self.ABS_EVOO,self.ABS_EVOO)
+        self._tss = np.sum((self.ABS_EVOO-np.average(self.ABS_EVOO))**2)
+
+        self.concmol        = np.zeros(N_PIGMENTS)
+        self._grad          = np.zeros(N_PIGMENTS)
+        self.ABS_CALC       = np.zeros(len(self.ABS_EVOO))
+        self.ABS_CALC_CONTR = np.zeros(np.shape(self.EPS_REF))
+        if concppm is not None:
+            self.setAll(concppm)
+
+    # Concentrations (mg/kg)
+    @property
+    def concppm(self):
+        return molToPpm(self.concmol,self.MW)
+
+    # Set the concentration (mg/kg) of pigment k, returns True if it changed
+    def set(self,k,concppm):
+        conc  = ppmToMol(float(concppm),self.MW[k])
+        delta = conc-self.concmol[k]
+        if(delta == 0):
+            return False
+        self.concmol[k]           = conc
+        self._grad               += delta*self._G[:,k]
+        self.ABS_CALC            += delta*self.EPS_REF[:,k]
+        self.ABS_CALC_CONTR[:,k]  = conc*self.EPS_REF[:,k]
+        return True
+
+    # Set all the concentrations (mg/kg) and rebuild the totals from scratch
+    def setAll(self,concppm):
+        self.concmol = ppmToMol(np.asarray(concppm,dtype=float),self.MW)
+        self._grad   = np.dot(self._G,self.concmol)
+        self.ABS_CALC,self.ABS_CALC_CONTR = reconstruct(self.EPS_REF,self.concmol)
+
+    # R^2 of the fitting
+    def rsquare(self):
+        rss = self._yy-2*np.dot(self._b,self.concmol)+np.dot(self.concmol,self._grad)
+        return 1-max(rss,0.0)/self._tss
+
+
+# >>> Format final results as text (with the confidence intervals ci, an
+# Intervals of a single spectrum, if given)
+def formatResults(PIGMENTS,concppm,Rsq,txt,ci=None):
+    out  = 'Final results:   '+txt+'\n'
+    out += 'R-square      = %9.6f\n' % Rsq
+    line = '-------------------------------'
+    if ci is None:
+        out += '    PIGMENT CONCENTRATION\n'
+    else:
+        line += '-'*24
+        out  += '    PIGMENT CONCENTRATION        %2g%% CONFIDENCE\n' % (100*ci.level)
+    out += line+'\n'
+
+    for i in range(len(PIGMENTS)):
+        if (concppm[i] > CONC_MAX_PPM):
+            out += '%-12s  = ********* mg/kg' % (PIGMENTS[i])
+        else:
+            out += '%-12s  = %9.3f mg/kg' % (PIGMENTS[i],concppm[i])
+        if ci is not None:
+            if (max(abs(ci.low[i]),abs(ci.high[i])) > CONC_MAX_PPM):
+                out += '  [********* *********]'
+            else:
+                out += '  [%9.3f %9.3f]' % (ci.low[i],ci.high[i])
+        out += '\n'
+    out += line+'\n'
+    sumindex = np.argwhere(concppm<CONC_MAX_PPM).flatten()
+    out += 'PIGMENT TOTAL = %9.3f mg/kg\n' % np.sum(concppm[sumindex])
+    return out
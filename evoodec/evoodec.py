@@ -14,12 +14,26 @@ Date    : 02/16/2021
 
 # Import Python modules
 import os, sys
-import xlrd
+
+# Command line modes (batch, watch, archive) do not need the GUI: they are
+# dispatched before the GUI stack (Tkinter, matplotlib) is imported, e.g.:
+#   python evoodec.py -r pigments/pigments.csv spectra/ -j 4 -o results.csv
+#   python evoodec.py watch -r pigments/pigments.csv /path/to/instrument/output
+#   python evoodec.py archive season.evooarc spectra/
+#   python evoodec.py serve -r pigments/pigments.csv --port 8750
+#   python evoodec.py query results.db --where "Pheo-a>2" --month 2026-10
+if __name__ == "__main__" and len(sys.argv) > 1:
+    import cli
+    sys.exit(cli.main(sys.argv[1:]))
+
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import interpolate
 from functools import partial
 
+# Import EVOODec engine (loading, pre-processing and deconvolution)
+import engine
+import baseline
+from metrics import METRICS
+
 # Import Tkinter module for GUI
 import tkinter as tk
 from tkinter import filedialog
@@ -35,6 +49,117 @@ from matplotlib.figure import Figure
 # CLASSES AND FUNCTIONS
 #
 
+class SpectrumPlot:
+
+    # Persistent plot of the spectra. Figure, canvas and toolbar are created
+    # once, line artists are updated in place (set_data) and hidden when not
+    # needed. During manual fitting the calculated spectra are blitted on a
+    # cached background, then the plot goes back to a normal draw.
+    SETTLE_MS = 300     # Full redraw after the last blitted update (ms)
+
+    def __init__(self,frame):
+        self.fig    = Figure(figsize=(7.0,4.5),dpi=100)
+        self.ax     = self.fig.add_subplot(111)
+        self.canvas = FigureCanvasTkAgg(self.fig,frame)
+        self.canvas.get_tk_widget().grid(row=7,column=0)
+        toolbar_frame = tk.Frame(frame)
+        toolbar_frame.grid(row=9,column=0)
+        self.toolbar = NavigationToolbar2Tk(self.canvas,toolbar_frame)
+        self.toolbar.update()
+
+        self.ax.set_xlabel('Wavelength (nm)')
+        self.ax.set_ylabel('Absorbance')
+        self.ax.set_title('EVOO Deconvolution')
+        self.exp   = self.ax.plot([],[],'.',markersize=3,color='gray')[0]
+        self.evoo  = self.ax.plot([],[],'-k',linewidth=0.8,label='EVOO')[0]
+        self.calc  = self.ax.plot([],[],'-g',label='Calculated')[0]
+        self.contr = []     # Contributions of the pigments
+
+        self.background = None
+        self._settle    = None
+        self.canvas.mpl_connect('draw_event',self.onDraw)
+
+    # Lines of the calculated spectra (redrawn while blitting)
+    def fitLines(self):
+        return [self.calc]+[l for l in self.contr if l.get_visible()]
+
+    # Update all the lines and redraw (data not given are hidden)
+    def update(self,XLIM,YLIM,X_EXP,EXP,X_REF=[],ABS_EVOO=[],ABS_CALC=[],
+        ABS_CALC_CONTR=[],PIGMENTS=[],COLORS=[]):
+        with METRICS.span('render',mode='full'):
+            self._update(XLIM,YLIM,X_EXP,EXP,X_REF,ABS_EVOO,ABS_CALC,
+                         ABS_CALC_CONTR,PIGMENTS,COLORS)
+
+    def _update(self,XLIM,YLIM,X_EXP,EXP,X_REF,ABS_EVOO,ABS_CALC,ABS_CALC_CONTR,
+        PIGMENTS,COLORS):
+        self.stopBlit()
+        self.exp.set_data(X_EXP,EXP)
+        self.evoo.set_data(X_REF,ABS_EVOO)
+        self.evoo.set_visible(len(X_REF) > 0)
+        self.calc.set_visible(len(ABS_CALC) > 0)
+        if len(ABS_CALC):
+            self.calc.set_data(X_REF,ABS_CALC)
+
+        # Reuse the contribution lines, add the missing ones
+        while len(self.contr) < len(PIGMENTS):
+            self.contr.append(self.ax.plot([],[],linewidth=0.8)[0])
+        for i,line in enumerate(self.contr):
+            if i < len(PIGMENTS) and len(ABS_CALC):
+                line.set_data(X_REF,ABS_CALC_CONTR[:,i])
+                line.set_color(COLORS[i])
+                line.set_label(PIGMENTS[i])
+                line.set_visible(True)
+            else:
+                line.set_visible(False)
+                line.set_label('_hidden')
+
+        self.ax.set_xlim(*XLIM)
+        self.ax.set_ylim(*YLIM)
+        self.ax.legend(loc='best')
+        self.toolbar.update()       # New home view for the toolbar
+        self.canvas.draw()
+
+    # Update the calculated spectra only, blitting them on the background
+    def updateFit(self,ABS_CALC,ABS_CALC_CONTR):
+        with METRICS.span('render',mode='blit'):
+            self._updateFit(ABS_CALC,ABS_CALC_CONTR)
+
+    def _updateFit(self,ABS_CALC,ABS_CALC_CONTR):
+        self.calc.set_ydata(ABS_CALC)
+        for i,line in enumerate(self.contr):
+            if line.get_visible(): line.set_ydata(ABS_CALC_CONTR[:,i])
+        if self.background is None:
+            for line in self.fitLines(): line.set_animated(True)
+            self.canvas.draw()      # Draw the background, then the lines
+        else:
+            self.canvas.restore_region(self.background)
+            self.drawFit()
+        widget = self.canvas.get_tk_widget()
+        if self._settle is not None: widget.after_cancel(self._settle)
+        self._settle = widget.after(self.SETTLE_MS,self.stopBlit)
+
+    def drawFit(self):
+        for line in self.fitLines():
+            self.ax.draw_artist(line)
+        self.canvas.blit(self.fig.bbox)
+
+    # Cache the background when the lines are animated (blitting)
+    def onDraw(self,event):
+        if self.calc.get_animated():
+            self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+            self.drawFit()
+
+    # Back to normal drawing (the lines are part of the figure again)
+    def stopBlit(self):
+        if self._settle is not None:
+            self.canvas.get_tk_widget().after_cancel(self._settle)
+            self._settle = None
+        if self.calc.get_animated():
+            for line in [self.calc]+self.contr: line.set_animated(False)
+            self.background = None
+            self.canvas.draw_idle()
+
+
 class EvooDec:
 
     # Properties of EvooDec class
@@ -54,7 +179,7 @@ class EvooDec:
     CURDIR           = os.getcwd()
     PIGMENTS         = []
     ACTIVE_PIGMENTS  = []
-    EVOO_DENSITY     = 0.91  # Density of EVOO (g/ml)
+    EVOO_DENSITY     = engine.EVOO_DENSITY  # Density of EVOO (g/ml)
     
     # Flags
     VALID            = True  # Deconvolution
@@ -76,6 +201,14 @@ class EvooDec:
     X_REF_LIM        = []
     X_EVOO_LIM       = []
     X_SEL_LIM        = []   # Selected limits for x-axis
+    REF              = None # Reference data (engine.Reference)
+    EVOO             = None # EVOO spectrum (engine.Spectrum)
+    FIT              = None # Manual fitting state (engine.ManualFit)
+    FIT_KEY          = None # Data and options FIT was built for
+    PLOT             = None # Spectra plot (SpectrumPlot)
+    PLOT_FIT         = None # Manual fitting shown in PLOT
+    RESULT           = None # Last automatic fitting (engine.Result, Options)
+    DB_FILE          = ''   # Results database (see store.py)
     COLORS           = ['gray','cyan', 'blue', 'orange', 'red', 'yellow',
                         'pink','brown']
     filename         = ''
@@ -146,6 +279,11 @@ class EvooDec:
         self.LBL_EVOO_MAX = tk.DoubleVar()
         self.LBL_EVOO_PTS = tk.IntVar()
         self.BASELINE     = tk.BooleanVar()
+        self.BASE_MODEL   = tk.StringVar(value='min')
+        self.JOINT_BASE   = tk.BooleanVar()
+        self.NONNEG       = tk.BooleanVar()
+        self.UNCERTAINTY  = tk.BooleanVar()
+        self.SELECT       = tk.BooleanVar()
         
         # Button for selecting reference spectra
         self.btnBrwPure()
@@ -167,6 +305,8 @@ class EvooDec:
         # Create sliders in selPigments panel
         self.slider = []
         self.CONC_PPM_VAL = []
+        self._setting = False      # sliders moved by the program
+        self._redraw  = None       # pending redraw of the manual fitting
         row = 1
         # Here we always consider TRIOLEIN as a first spectrum of the list
         for i,p in enumerate(self.PIGMENTS):
@@ -174,13 +314,14 @@ class EvooDec:
             self.CONC_PPM_VAL.append(tk.DoubleVar())
             if(i==0):
                 slider = tk.Scale(self.pig_frame,orient=tk.HORIZONTAL,
-                length=200, from_=0, to=8E6,resolution=2E4,variable=self.CONC_PPM_VAL[i])
+                length=200, from_=0, to=8E6,resolution=2E4,variable=self.CONC_PPM_VAL[i],
+                command=partial(self.changeConc,i))
             else:
                 slider = tk.Scale(self.pig_frame,orient=tk.HORIZONTAL,
-                length=200, from_=0, to=20,resolution=0.1,variable=self.CONC_PPM_VAL[i])
+                length=200, from_=0, to=20,resolution=0.1,variable=self.CONC_PPM_VAL[i],
+                command=partial(self.changeConc,i))
             slider.grid(column=2,row=row)
             self.slider.append(slider)
-            self.slider[i].bind("<ButtonRelease-1>", self.changeConc)
             
 
         # Textarea
@@ -197,18 +338,59 @@ class EvooDec:
             tk.Button(self.pig_frame,width=2,command=partial(self.btnSelectColor,i),bg=self.COLORS[i]).grid(column = 1,row=i+2)
 
 
-    # >>> Event handler for sliders
-    def changeConc(self,event):
-        concppm = []
-        for i,p in enumerate(self.PIGMENTS):
-            concppm.append(float(self.slider[i].get()))
-        concppm = np.array(concppm)
-        X_REF,EPS_REF,X_EVOO,ABS_EVOO = self.processSpectra()
-        ABS_CALC_CONTR = EPS_REF * (concppm*self.EVOO_DENSITY/(self.MW*1000))
-        ABS_CALC       = np.sum(ABS_CALC_CONTR,axis=1)
+    # >>> Event handler for sliders (called while dragging)
+    # The processed spectra are kept in self.FIT as long as data and options
+    # do not change: moving a slider only updates the contribution of its
+    # pigment, the calculated spectrum and R^2. Redraws are coalesced and
+    # done when Tk is idle, so dragging does not queue up plots.
+    def changeConc(self,i,value):
+        if self._setting or self.REF is None or self.EVOO is None:
+            return
+        old = self.FIT
+        fit = self.manualFit()
+        if not fit.set(i,value) and fit is old:
+            return
+        self.printResults(fit.ABS_EVOO,fit.ABS_CALC,self.PIGMENTS,fit.concppm,
+                          'MANUAL FITTING',fit.rsquare())
+        if self._redraw is None:
+            self._redraw = self.master.after_idle(self.plotManualFit)
+
+    # >>> Manual fitting state, rebuilt when data or options change
+    def manualFit(self):
+        opts = self.options()
+        key  = (id(self.REF),id(self.EVOO),opts.X_SEL_MIN,opts.X_SEL_MAX,
+                opts.OPLEN,opts.BASELINE,opts.RESAMPLE)
+        if self.FIT is None or self.FIT_KEY != key:
+            X_REF,EPS_REF,X_EVOO,ABS_EVOO = self.processSpectra()
+            self.FIT_KEY = key
+            self.FIT     = engine.ManualFit(X_REF,EPS_REF,ABS_EVOO,self.MW,
+                [float(s.get()) for s in self.slider])
+            self.FIT_X   = X_EVOO
+        return self.FIT
+
+    # The full plot is drawn when the manual fitting starts, then only the
+    # calculated spectra are updated
+    def plotManualFit(self):
+        self._redraw = None
+        fit    = self.FIT
         FILTER = np.ones(len(self.PIGMENTS),dtype=bool)
-        self.printResults(ABS_EVOO,ABS_CALC,self.PIGMENTS,concppm,'MANUAL FITTING')
-        self.plot(X_EVOO,ABS_EVOO,FILTER,X_REF,EPS_REF,ABS_CALC,ABS_CALC_CONTR)
+        if self.PLOT_FIT is fit:
+            self.PLOT.updateFit(fit.ABS_CALC,fit.ABS_CALC_CONTR)
+            return
+        self.plot(self.FIT_X,fit.ABS_EVOO,FILTER,fit.X_REF,fit.EPS_REF,
+                  fit.ABS_CALC,fit.ABS_CALC_CONTR)
+        self.PLOT_FIT = fit
+
+    # >>> Move the sliders without triggering the manual fitting
+    def setSliders(self,concppm):
+        self._setting = True
+        try:
+            for i,conc in enumerate(concppm):
+                self.slider[i].set(conc)
+            self.master.update_idletasks()
+        finally:
+            self._setting = False
+        self.FIT = None
 
 
     # >>> Close window
@@ -287,75 +469,28 @@ class EvooDec:
         pass
 
 
+    # >>> Print a message on the output panel (and on the terminal)
+    def log(self,msg):
+        print(msg)
+        self.out_text.insert(tk.END,msg)
+        self.out_text.see(tk.END)
+
+
     # >>> Load file for pure compounds
     def loadRef(self):
-        out = '\nLoading reference file: %s' % os.path.basename(self.REF_FILE)
-        print(out)
-        self.out_text.insert(tk.END,out)
-        self.out_text.see(tk.END)
-        
-        # Load absorption spectra from CSV file ";" separated
-        # First column  : wavelength(nm)
-        # Other columns : molar extinsion coefficient (M^-1cm-1)
-        # First line    : Pigment name
-        # Second line   : molecular weight
-        # Lines starting with '#' will be treated as comments
-        #
-        ind      = 0
-        comments = ''
-        data     = []
-        with open(self.REF_FILE,'r') as f:
-            while(True):
-                line = f.readline()
-                if not line: break
-                # Skip comment lines
-                if(line[0] != '#'):
-                    # 1st line -> pigment names
-                    if(ind==0):
-                        pigments = line.split(';')[1:]
-                        pigments = [xx.strip(' \n\t\r') for xx in pigments]
-                        ind += 1
-                        continue
-                    # 2nd line -> molecular weights
-                    if(ind==1):
-                        MW = line.split(';')[1:]
-                        MW = np.array([float(x) for x in MW])
-                        ind += 1
-                        continue
-                    # 3rd line -> labels' color
-                    if(ind==2):
-                        COLORS = line.split(';')[1:]
-                        COLORS = [xx.strip(' \n\t\r') for xx in COLORS]
-                        ind += 1
-                        continue
-                    # Read data lines
-                    data += [line.split(';')]
-                else:
-                    comments += line.strip("#")
-        data = np.array(data,dtype=float)
-
-        # Check the file consistency: the number of cols must be the same
-        # for all the data
-        nc_pig = len(pigments)
-        nc_mw  = len(MW)
-        nc_col = len(COLORS)
-        nc_dat = np.shape(data)[1]
-        if len(set([nc_pig,nc_mw,nc_col,nc_dat-1])) > 1:
-            raise Exception("Check consistency of reference file!")
-        
-        msg = "\nReference file correctly loaded!"
-        
-        self.X_REF    = data[:,0]    # First column is wavelength
-        self.EPS_REF  = data[:,1:]   # Other column are epsilon
-        self.PIGMENTS = pigments
-        self.MW       = MW
-        self.COLORS   = COLORS
-        
-        self.X_REF_LIM = np.array([np.min(data[:,0]),np.max(data[:,0])])
-        
+        self.REF = engine.loadRef(self.REF_FILE,log=self.log)
+
+        self.X_REF    = self.REF.X      # First column is wavelength
+        self.EPS_REF  = self.REF.EPS    # Other column are epsilon
+        self.PIGMENTS = self.REF.PIGMENTS
+        self.MW       = self.REF.MW
+        self.COLORS   = self.REF.COLORS
+
+        self.X_REF_LIM = self.REF.X_LIM
+
         self.LBL_REF_MIN.set(round(self.X_REF_LIM[0],1))
         self.LBL_REF_MAX.set(round(self.X_REF_LIM[1],1))
-        
+
         self.LBL_REF_PTS.set(len(self.X_REF))
 
         # Reload pigment checkbox
@@ -365,85 +500,29 @@ class EvooDec:
 
     # >>> Load file for EVOO
     def loadEVOO(self):
+        self.EVOO = engine.loadEVOO(self.EVOO_FILE,log=self.log)
+        if self.EVOO.isBatch():
+            self.log("\nFile contains %d samples, only %s will be considered"
+                     % (len(self.EVOO.names),self.EVOO.names[0]))
+            self.EVOO = self.EVOO.sample(0)
 
-        ext = os.path.splitext(self.EVOO_FILE)[1]
-        out = '\nLoading sample    file: %s' % os.path.basename(self.EVOO_FILE)
-        print(out)
-        self.out_text.insert(tk.END,out)
-        self.out_text.see(tk.END)
-
-        if(ext.lower() in ['.xlsx','.xls']):
+        self.X_EVOO   = self.EVOO.X
+        self.ABS_EVOO = self.EVOO.ABS
 
-            # Load file using xlrd function (excel file)
-            # File structure:
-            # 1st col: wavelength (nm)
-            # 2nd col: absorbance
+        self.X_EVOO_LIM = self.EVOO.X_LIM
 
-            # Read file by using xlrd (both .xls and .xlsx)
-            wb = xlrd.open_workbook(self.EVOO_FILE)
-            sheet = wb.sheet_by_index(0)
-        
-            # Extracting number of columns
-            ncols = sheet.ncols
-            print("Number of columns     : %d" % ncols)
-            if(ncols == 2):
-                print(" ... detected 2 colums, we assume: | wavelength (nm) | Absorbance (a.u.) |")
-            elif(ncols > 2):
-                print(" ... detected >2 colums, we assume that the first two are: | wavelength (nm) | Absorbance (a.u.) |")
-                print("     all the other columns will be ignored!")
-
-            # Looking for the first row containing wavelength | absorbance data
-            evoo_data = []
-            for i in range(sheet.nrows):
-                row = sheet.row_values(i)
-                if(len(row) >= 2):
-                    try:
-                        evoo_data.append([float(row[0]),float(row[1])])
-                    except:
-                        pass
-            evoo_data = np.array(evoo_data,dtype=float) 
-
-        elif(ext.lower() in ['.csv']):       
-        
-            # Load file using np.genfromtxt function
-            # File structure: csv file ; separated
-            # 1st col: wavelength (nm)
-            # 2nd col: absorbance
-            evoo_data = np.genfromtxt(self.EVOO_FILE,delimiter=';',
-                comments='#',encoding='utf-8-sig')
-             
-            # Check file integrity
-            dim = np.shape(evoo_data)[1]
-            if(dim < 2):
-                msg = "\nEVOO file must contain at least two columns!"
-                self.VALID = False
-            elif(dim > 2):
-                msg =  "\nEVOO file contains %d columns!\n" % dim
-                msg += "Only the first two cols will be considered"
-            
-            else:
-                msg = "\nEVOO file correctly loaded!"
-
-        else:
-            raise Exception('Only .csv, .xls or .xlsx file can be loaded!')
-        
-        self.X_EVOO   = evoo_data[:,0]
-        self.ABS_EVOO = evoo_data[:,1]
-        
-        self.X_EVOO_LIM = np.array([np.min(evoo_data[:,0]),np.max(evoo_data[:,0])])
-        
         self.X_SEL_MIN.set(round(self.X_EVOO_LIM[0],1))
         self.X_SEL_MAX.set(round(self.X_EVOO_LIM[1],1))
-        
+
         self.LBL_EVOO_MIN.set(round(self.X_EVOO_LIM[0],1))
         self.LBL_EVOO_MAX.set(round(self.X_EVOO_LIM[1],1))
-        
+
         self.LBL_EVOO_PTS.set(len(self.X_EVOO))
-        
+
         self.plot(self.X_EVOO,self.ABS_EVOO)
-        
-        pass        
-    
+
+        pass
+
 
     # >>> optPanel
     def optPanel(self):
@@ -456,6 +535,7 @@ class EvooDec:
         # Checkbox for baseline correction
         tk.Label(self.opt_frame,text="Apply baseline correction").grid(row=1,column=0,sticky='W')
         tk.Checkbutton(self.opt_frame,variable=self.BASELINE).grid(row=1,column=2,sticky="W")
+        tk.OptionMenu(self.opt_frame,self.BASE_MODEL,*baseline.MODELS).grid(row=1,column=3,sticky="W")
 
         # Table for spectral window
         tk.Label(self.opt_frame,text="Start (nm)").grid(row=3,column=0,sticky='W')
@@ -500,8 +580,7 @@ class EvooDec:
         self.X_SEL_MIN.set(round(self.X_EVOO_LIM[0],1))
         self.X_SEL_MAX.set(round(self.X_EVOO_LIM[1],1))
         self.btnProcSpec()
-        for i,p in enumerate(self.PIGMENTS):
-            self.slider[i].set(0)
+        self.setSliders(np.zeros(len(self.PIGMENTS)))
         self.textarea.delete('1.0', tk.END)
         self.textarea.insert(tk.END,self.VERSION)
         pass  
@@ -514,114 +593,35 @@ class EvooDec:
         pass  
     
 
-    # >>> Function to check integrety of spectra
-    def processSpectra(self):
-        
-        warn   = ''
-
-        # Spectrum pre-processing
-        print("\n\nSpectrum pre-processing ...")
-        self.out_text.insert(tk.END, '\nSpectrum pre-processing\n')
-        X_SEL_MIN = self.X_SEL_MIN.get()
-        X_SEL_MAX = self.X_SEL_MAX.get()
-        
-        # Check consistency of selected EVOO spectrum limits
-        if(X_SEL_MIN > X_SEL_MAX):
-            warn += "X_EVOO_MIN %4d > X_EVOO_MAX %d\n" % (X_SEL_MIN,X_SEL_MAX)
-            self.X_SEL_MIN.set(self.X_EVOO_LIM[0])
-            X_SEL_MIN = self.X_EVOO_LIM[0]
-        if(X_SEL_MAX < X_SEL_MIN):
-            warn += "X_EVOO_MAX %4d < X_EVOO_MIN %d\n" % (X_SEL_MAX,X_SEL_MIN)
-            self.X_SEL_MAX.set(self.X_EVOO_LIM[1])
-            X_SEL_MAX = self.X_EVOO_LIM[1]
-
-        ind1 = np.argwhere(self.X_EVOO >= X_SEL_MIN).flatten()
-        ind2 = np.argwhere(self.X_EVOO <= X_SEL_MAX).flatten()
-        ind  = np.intersect1d(ind1,ind2)        
-
-        X_EVOO   = self.X_EVOO[ind]
-        ABS_EVOO = self.ABS_EVOO[ind]
-
-        X_REF    = self.X_REF
-        EPS_REF  = self.EPS_REF
-
-        # Extract number of points (x-axis)
-        NPT_EVOO = np.shape(ABS_EVOO)[0]
-        NPT_REF  = np.shape(EPS_REF)[0]
+    # >>> Collect pre-processing and deconvolution options from the GUI
+    def options(self):
+        FILTER = np.ones(len(self.PIGMENTS),dtype=bool)
+        for i,p in enumerate(self.PIGMENTS):
+            FILTER[i] = self.ACTIVE_PIGMENTS[i].get()
+        return engine.Options(X_SEL_MIN=self.X_SEL_MIN.get(),
+                              X_SEL_MAX=self.X_SEL_MAX.get(),
+                              OPLEN=self.OPLEN_SEL.get(),
+                              BASELINE=self.BASELINE.get() and self.BASE_MODEL.get(),
+                              JOINT_BASELINE=1 if self.JOINT_BASE.get() else None,
+                              SOLVER='nnls' if self.NONNEG.get() else 'unconstrained',
+                              CI=2000 if self.UNCERTAINTY.get() else 0,
+                              SELECT='bic' if self.SELECT.get() else None,
+                              FILTER=FILTER)
+
+
+    # >>> Update the spectral window with the limits actually used
+    def setWindow(self,X_SEL_LIM,NPT_EVOO):
+        self.X_SEL_LIM = X_SEL_LIM
+        if(self.X_SEL_MIN.get() != X_SEL_LIM[0]): self.X_SEL_MIN.set(X_SEL_LIM[0])
+        if(self.X_SEL_MAX.get() != X_SEL_LIM[1]): self.X_SEL_MAX.set(X_SEL_LIM[1])
         self.LBL_EVOO_PTS.set(NPT_EVOO)
 
-        # Compute steps
-        X_EVOO_STEP = (X_SEL_MAX-X_SEL_MIN)/(NPT_EVOO-1)
-        X_REF_STEP  = (self.X_REF_LIM[1]-self.X_REF_LIM[0])/(NPT_REF-1)
-        
-        table  =  '\n'
-        table += '\n                PURE  EVOO\n'
-        table += '     ---------------------\n'
-        table += '     X_MIN    = %4d  %4d\n' % (self.X_REF_LIM[0],X_SEL_MIN)
-        table += '     X_MAX    = %4d  %4d\n' % (self.X_REF_LIM[1],X_SEL_MAX)
-        table += '     X_POINTS = %4d  %4d\n' % (NPT_REF,NPT_EVOO)
-        table += '     DELTA_X  = %4.1f  %4.1f\n' % (X_REF_STEP,X_EVOO_STEP)
-        table += '     ---------------------\n'
-        
-        print(table)
-
-        if(X_REF_STEP != X_EVOO_STEP):
-            warn += "Different resolution between reference pigments and EVOO files\n"
-        
-        # Check on minimum
-        if(X_SEL_MIN < self.X_REF_LIM[0]):
-            warn += "X_EVOO_MIN %4d < X_REF_MIN %4d\n" % (X_SEL_MIN,self.X_REF_LIM[0])
-            ind = np.argwhere(X_EVOO >= self.X_REF_LIM[0]).flatten()
-            X_EVOO   = X_EVOO[ind]
-            ABS_EVOO = ABS_EVOO[ind]
-            self.X_SEL_MIN.set(self.X_REF_LIM[0]) 
-        elif(X_SEL_MIN > self.X_REF_LIM[0]):
-            warn += "X_EVOO_MIN %4d > X_REF_MIN %4d\n" % (X_SEL_MIN,self.X_REF_LIM[0])
-            ind = np.argwhere(X_REF >= X_SEL_MIN).flatten()
-            X_REF    = X_REF[ind]
-            EPS_REF  = EPS_REF[ind]
-        
-        # Check on maximum
-        if(X_SEL_MAX > self.X_REF_LIM[1]):
-            warn += "X_EVOO_MAX %4d > X_REF_MAX %4d\n" % (X_SEL_MAX,self.X_REF_LIM[1])
-            ind = np.argwhere(X_EVOO <= X_SEL_MAX).flatten()
-            X_EVOO   = X_EVOO[ind]
-            ABS_EVOO = ABS_EVOO[ind]
-            self.X_SEL_MAX.set(self.X_REF_LIM[1])
-        elif(X_SEL_MAX < self.X_REF_LIM[1]):
-            warn += "X_EVOO_MAX %4d < X_REF_MAX %4d\n" % (X_SEL_MAX,self.X_REF_LIM[1])
-            ind = np.argwhere(X_REF <= X_SEL_MAX).flatten()
-            X_REF    = X_REF[ind]
-            EPS_REF  = EPS_REF[ind]
-        
-        # Interpolate EVOO spectrum if needed
-        if(warn != ''):
-            print(warn)
-            print("\nInterpolating EVOO spectrum to match the pure compound x-axis ...")
-            f = interpolate.interp1d(X_EVOO, ABS_EVOO,fill_value='extrapolate',kind='cubic')
-            ABS_EVOO = f(X_REF)
-            self.out_text.insert(tk.END, 'Warning!\n'+warn)
-            self.out_text.see(tk.END)
-        else:
-            print("Spectra are OK")
-            self.out_text.insert(tk.END, 'Spectra are OK!\n')
-            self.out_text.see(tk.END)
-
-        # Correct the absorbance for the optical path length
-        self.out_text.insert(tk.END, ' ... optical path length %3.1f cm\n' % self.OPLEN_SEL.get())
-        if(self.OPLEN_SEL.get() != 1.0):
-            self.out_text.insert(tk.END, '     -> normalize to 1.0\n')
-            ABS_EVOO = ABS_EVOO/self.OPLEN_SEL.get()
-
-        # Apply baseline correction
-        if(self.BASELINE.get() is True):
-            print("Apply baseline correction")
-            print("Minimum value found: %6.2f" % np.min(ABS_EVOO) )
-            ABS_EVOO -= np.min(ABS_EVOO)
-            self.out_text.insert(tk.END, "Apply baseline correction\n")
-            self.out_text.insert(tk.END, "EVOO spectrum will be shifted by %6.2f ABS unit" %  np.min(ABS_EVOO))
-            self.out_text.see(tk.END)
 
+    # >>> Function to check integrety of spectra
+    def processSpectra(self):
+        X_REF,EPS_REF,X_EVOO,ABS_EVOO,X_SEL_LIM,warn = engine.processSpectra(
+            self.REF,self.EVOO,self.options(),log=self.log)
+        self.setWindow(X_SEL_LIM,len(X_EVOO))
         return(X_REF,EPS_REF,X_EVOO,ABS_EVOO)
 
 
@@ -659,175 +659,109 @@ class EvooDec:
                            command=self.exeDec2,width=30)
         button.grid(column=0,row=0,pady=10,padx=10)
 
+        # Checkbox for non-negative concentrations
+        tk.Checkbutton(self.dec_frame,text="Non-negative concentrations",
+                       variable=self.NONNEG).grid(column=0,row=1,sticky="W")
+
+        # Checkbox for the confidence intervals (residual bootstrap)
+        tk.Checkbutton(self.dec_frame,text="Confidence intervals (bootstrap)",
+                       variable=self.UNCERTAINTY).grid(column=0,row=2,sticky="W")
+
+        # Checkbox for the automatic selection of the pigments (among the
+        # checked ones)
+        tk.Checkbutton(self.dec_frame,text="Automatic pigment selection (BIC)",
+                       variable=self.SELECT).grid(column=0,row=3,sticky="W")
+
+        # Checkbox for a linear baseline fitted together with the pigments
+        tk.Checkbutton(self.dec_frame,text="Fit linear baseline with the pigments",
+                       variable=self.JOINT_BASE).grid(column=0,row=4,sticky="W")
+
+        # Button for recording the results in the results database
+        tk.Button(self.dec_frame,text="Save results to database",
+                  command=self.saveResults,width=30).grid(column=0,row=5,pady=10,padx=10)
+
 
     # >>> TEST Execute Deconvolution 2
     def exeDec2(self):
-        
-        print("Check spectra...")
-        X_REF,EPS_REF,X_EVOO,ABS_EVOO = self.processSpectra()
-        #self.plot(X_EVOO,ABS_EVOO)
-        
-        print("Appply pigment filter...")
-        FILTER = np.ones(len(self.PIGMENTS),dtype=bool)
-        for i,p in enumerate(self.PIGMENTS):
-            print(p,self.ACTIVE_PIGMENTS[i].get())
-            FILTER[i] = self.ACTIVE_PIGMENTS[i].get()
-        
-        # Apply Filter
-        print("Call deconvolution function...")
-        PIGMENTS = np.array(self.PIGMENTS)[FILTER]
-        MW       = np.array(self.MW)[FILTER]
-        EPS_REF  = EPS_REF[:,FILTER]
-        
-        # Execute deconvolution
-        #deconvolution = Deconvolution(self,X_REF,EPS_REF,ABS_EVOO,MW)
-        concmol = self.deconvolve(X_REF,EPS_REF,ABS_EVOO,MW)
-        concppm = concmol*MW*1000/self.EVOO_DENSITY
+
+        # Pre-processing, deconvolution and reconstruction
+        opts = self.options()
+        res  = engine.analyze(self.REF,self.EVOO,opts,log=self.log)
+        self.RESULT = (res,opts)
+        self.setWindow(res.X_SEL_LIM,len(res.X_EVOO))
 
         # Set sliders values
-        j = 0
-        for i,p in enumerate(self.PIGMENTS):
-            if(FILTER[i]):
-                self.slider[i].set(concppm[j])
-                j += 1
-            else:
-                self.slider[i].set(0)
-                
-        # Compute and plot deconvolved spectrum
-        print("\nReconstructing deconvolved spectrum and calculating residues ...")
-        ABS_CALC_CONTR = EPS_REF*concmol
-        ABS_CALC       = np.einsum('ik,k->i',EPS_REF,concmol)
+        self.setSliders(res.concppmAll())
 
-        self.printResults(ABS_EVOO,ABS_CALC,PIGMENTS,concppm,'AUTO FITTING')
-        self.plot(X_EVOO,ABS_EVOO,FILTER,X_REF,EPS_REF,ABS_CALC,ABS_CALC_CONTR)
+        self.printResults(res.ABS_EVOO,res.ABS_CALC,res.PIGMENTS,res.concppm,'AUTO FITTING',
+                          res.RSQ,res.CI)
+        if res.SELECTION is not None:
+            self.textarea.insert(tk.END,'\n'+engine.formatSelection(res.SELECTION))
+        self.plot(res.X_EVOO,res.ABS_EVOO,res.FILTER,res.X_REF,res.EPS_REF,
+                  res.ABS_CALC,res.ABS_CALC_CONTR)
 
 
     # >>> Plot spectra
     def plot(self,X_EVOO,ABS_EVOO,FILTER=None,X_REF=[],EPS_REF=[],ABS_CALC=[],
         ABS_CALC_CONTR=[]):
-        
-        # Graph configuration
-        fig = plt.figure(figsize=(7.0,4.5), dpi=100) 
-        canvas = FigureCanvasTkAgg(fig,self.plt_frame) 
-        canvas.draw() 
-        canvas.get_tk_widget().grid(row=7,column=0) 
-        toolbar_frame = tk.Frame(self.plt_frame)
-        toolbar_frame.grid(row=9,column=0)
-        toolbar = NavigationToolbar2Tk(canvas, toolbar_frame) 
-        toolbar.update() 
-        
-        # Adding features to graph
-        plt.xlabel('Wavelength (nm)')
-        plt.ylabel('Absorbance')
-        plt.title('EVOO Deconvolution')
-        plt.xlim(np.min(X_EVOO),np.max(X_EVOO))
-        plt.ylim(0,np.max(ABS_EVOO)+np.max(ABS_EVOO)*0.05)
-        
-        # Process experimental EVOO spectrum for plot
-        EXP = self.ABS_EVOO                 # as loaded by inpute (no data processing)
-
-        # Correct experimental points if option is checked
-        if(self.BASELINE.get()):
-            EXP = EXP - np.min(self.ABS_EVOO)   # corrected for baseline
-
-        EXP = EXP/self.OPLEN_SEL.get()      # corrected for optical path length (normalization to 1.0 cm)
-        
-        # Plot EVOO spectrum (as Loaded by input and corrected for baseline and optical path length)
-        plt.plot(self.X_EVOO,EXP,'.',markersize=3,color = 'gray')
-        if len(X_REF): plt.plot(X_REF,ABS_EVOO,'-k',linewidth=0.8,label='EVOO')
 
+        # The figure is created once and then updated
+        if self.PLOT is None:
+            self.PLOT = SpectrumPlot(self.plt_frame)
+        self.PLOT_FIT = None
+
+        # Process experimental EVOO spectrum for plot: corrected for optical
+        # path length (normalization to 1.0 cm) and for baseline, if the
+        # option is checked, as in the deconvolution
+        EXP = np.asarray(self.ABS_EVOO)/self.OPLEN_SEL.get()
+        EXP = engine.correctBaseline(self.X_EVOO,EXP,self.options())
+
+        # Plot EVOO spectrum (as Loaded by input and corrected for baseline and
+        # optical path length), the calculated one and the contributions
+        PIGMENTS = []
+        COLORS   = []
         if len(ABS_CALC):
-            plt.plot(X_REF,ABS_CALC,'-g',label='Calculated')
-            PIGMENTS = np.array(self.PIGMENTS)[FILTER]
-            COLORS   = np.array(self.COLORS[0:len(FILTER)])[FILTER]
-            for i in range(len(PIGMENTS)):
-                plt.plot(X_REF,ABS_CALC_CONTR[:,i],'-k',
-                         color=COLORS[i],linewidth=0.8,
-                         label='{i}'.format(i=PIGMENTS[i]))
-
-        plt.legend(loc='best')
-
-        # Save data in txt files (to be done...)
-        #if(len(ABS_CALC_CONTR) > 0):
-        #    out = np.column_stack((X_REF,ABS_CALC_CONTR,ABS_CALC))
-        #    np.savetxt('deconvolution.csv',out,fmt="%16.8E",delimiter=";")
+            PIGMENTS = list(np.array(self.PIGMENTS)[FILTER])
+            COLORS   = list(np.array(self.COLORS[0:len(FILTER)])[FILTER])
+        self.PLOT.update((np.min(X_EVOO),np.max(X_EVOO)),
+                         (0,np.max(ABS_EVOO)+np.max(ABS_EVOO)*0.05),
+                         self.X_EVOO,EXP,X_REF,ABS_EVOO if len(X_REF) else [],
+                         ABS_CALC,ABS_CALC_CONTR,PIGMENTS,COLORS)
 
         pass
     
 
-    # >>> Deconvolution function
-    def deconvolve(self,X,EPS_REF,ABS_EVOO,MW):
-
-        self.out_text.insert(tk.END,"Executing deconvolution...\n")
-        self.out_text.see(tk.END)
-
-        # Determine number of pigments
-        N_PIGMENTS   = np.shape(EPS_REF)[1]
-
-        # Compute the overlap matrix
-        print("Computing the overlap matrix...")
-        ovlp = np.zeros((N_PIGMENTS,N_PIGMENTS))
-        for i in range(N_PIGMENTS):
-            for j in range(i,N_PIGMENTS):
-                prod = np.multiply(EPS_REF[:,i],EPS_REF[:,j])
-                ovlp[i,j] = np.trapz(prod,X[::-1])
-        ovlp = ovlp+ovlp.T-np.eye(N_PIGMENTS)*np.diag(ovlp)
-
-        # Diagonalize overlap matrix
-        print("Diagonalizing the overlap matrix...")
-        eigval,eigvec = np.linalg.eigh(ovlp,UPLO='U')
-
-        # Check eigval zero
-        check = np.where(eigval==0)[0]
-        if(len(check)>0):
-            msg = "\nError!\n%d eigenvalues are zero\nDeconvolution is not possibile!\n" % len(check)
-            print(msg)
-            self.out_text.insert(tk.END, msg)
-            self.out_text.see(tk.END)
-            return np.zeros(N_PIGMENTS)
-
-        # Compute base for spectra deconvolution
-        print("Computing eigenvectors for the new base ...")
-        print(np.shape(EPS_REF))
-        base = np.einsum('ri,jr->ji',eigvec,EPS_REF)
-
-        # Compute SV coefficient
-        print("Computing SV coefficients...")
-        gamma = np.zeros(N_PIGMENTS)
-        for i in range(N_PIGMENTS):
-            gamma[i] = -np.trapz(base[:,i]*ABS_EVOO/eigval[i],X)
-        
-        # Compute concentration
-        print("Computing pigments' concentrations...")
-        concmol = np.einsum('k,ik->i',gamma,eigvec)
-        
-        return concmol
+    # >>> Record the last automatic fitting in the results database (the
+    # database file is asked once, then reused)
+    def saveResults(self):
+        if self.RESULT is None:
+            tk.messagebox.showinfo("Save results","Execute the deconvolution first!")
+            return
+        if(self.DB_FILE == ''):
+            self.DB_FILE = filedialog.asksaveasfilename(
+                initialdir = self.CURDIR+"/", title = "Results database",
+                initialfile = "results.db", confirmoverwrite = False,
+                filetypes = (("SQLite database","*.db"),("all files","*.*")))
+            if not self.DB_FILE:
+                self.DB_FILE = ''
+                return
+        import store
+        res,opts = self.RESULT
+        with store.ResultStore(self.DB_FILE) as db:
+            run = db.addRun(self.REF,opts,self.REF_FILE,'gui')
+            ids = db.insertResult(run,res)
+        self.textarea.insert(tk.END,'\nSaved in %s (result %d)\n'
+                             % (os.path.basename(self.DB_FILE),ids[0]))
 
 
     # >>> Print final results
-    def printResults(self,ABS_EVOO,ABS_CALC,PIGMENTS,concppm,txt):
-        # +++ R^2 fitting
-        ave = np.average(ABS_EVOO)
-        Rsq = 1-np.sum((ABS_EVOO-ABS_CALC)**2)/np.sum((ABS_EVOO-ave)**2)
-        
-        # +++ Output printing
-        out  = 'Final results:   '+txt+'\n'
-        out += 'R-square      = %9.6f\n' % Rsq
-        out += '    PIGMENT CONCENTRATION\n'
-        out += '-------------------------------\n'
-
-        for i in range(len(PIGMENTS)):
-            if (concppm[i] > 1E4):
-                out += '%-12s  = ********* mg/kg\n' % (PIGMENTS[i])
-            else:
-                out += '%-12s  = %9.3f mg/kg\n' % (PIGMENTS[i],concppm[i])
-        out += '-------------------------------\n'
-        sumindex = np.argwhere(concppm<1E4).flatten()
-        out += 'PIGMENT TOTAL = %9.3f mg/kg\n' % np.sum(concppm[sumindex])
+    def printResults(self,ABS_EVOO,ABS_CALC,PIGMENTS,concppm,txt,Rsq=None,ci=None):
+        if Rsq is None: Rsq = engine.rsquare(ABS_EVOO,ABS_CALC)
+        out = engine.formatResults(PIGMENTS,concppm,Rsq,txt,ci)
         self.textarea.delete("1.0",tk.END)
         self.textarea.insert(tk.END,out)
         pass
-        
+
 
 # -----------------------------------------------------------------------------
 # MAIN PROGRAM
@@ -0,0 +1,357 @@
+"""
+EVOODec metrics - timing of the processing stages and counters
+
+The engine wraps each stage of the pipeline in a timing span:
+
+    parse        reading of reference and sample files
+    window       selection of the spectral window
+    resample     resampling of the samples on the reference x-axis
+    baseline     optical path length and baseline corrections
+    smooth       Savitzky-Golay smoothing and derivatives
+    align        wavelength shift alignment of the samples
+    gram         overlap (Gram) matrix of the pigment basis
+    factorize    diagonalization of the overlap matrix
+    select       automatic selection of the pigments
+    solve        concentrations from the absorbances
+    reconstruct  reconstructed spectra and R^2
+    uncertainty  confidence intervals of the concentrations
+    sweep        deconvolution over a grid of spectral windows
+    render       plot drawing (GUI)
+    request      HTTP requests of the service mode (whole request)
+
+and counts events such as cache hits and resampled spectra. Spans and
+counters are accumulated in METRICS (thread-safe) and can be exported as
+Prometheus text or written as structured (JSON lines) logs.
+
+A collector gathers the spans and counters of a single task (e.g. the
+sample file processed by a batch worker) on top of METRICS:
+
+    with metrics.METRICS.collect() as task:
+        engine.analyze(ref,evoo,opts)
+    task.snapshot()
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os
+import json
+import time
+import weakref
+import threading
+from contextlib import contextmanager
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+STAGES = ['parse','window','resample','baseline','smooth','align','gram',
+          'factorize','select','solve','reconstruct','uncertainty','sweep',
+          'render','request']
+
+
+# >>> Hashable key of a metric (name and sorted labels)
+def _key(name,labels):
+    if not labels:
+        return (name,())
+    return (name,tuple(sorted(labels.items())))
+
+
+class _Span:
+
+    # Timing span of a stage (see Metrics.span)
+    __slots__ = ('metrics','key','t0')
+
+    def __init__(self,metrics,key):
+        self.metrics = metrics
+        self.key     = key
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        self.metrics._record(self.key,time.perf_counter()-self.t0)
+
+
+class _NoSpan:
+
+    # Span of disabled metrics
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        pass
+
+_NOSPAN = _NoSpan()
+
+
+class _Shard:
+
+    # Spans and counters recorded by one thread (see Metrics), gen is the
+    # generation of Metrics.reset they belong to
+    __slots__ = ('spans','counters','gen')
+
+    def __init__(self,gen):
+        self.spans    = {}
+        self.counters = {}
+        self.gen      = gen
+
+
+class _Holder:
+
+    # Thread-local reference to the shard of a thread: it is released when
+    # the thread ends, which retires the shard (see Metrics._retire)
+    __slots__ = ('shard','__weakref__')
+
+    def __init__(self,shard):
+        self.shard = shard
+
+
+# >>> Add spans and counters to the ones of a shard
+def _add(shard,spans,counters):
+    for k,v in spans.items():
+        old = shard.spans.get(k)
+        shard.spans[k] = list(v) if old is None else [old[0]+v[0],old[1]+v[1],max(old[2],v[2])]
+    for k,v in counters.items():
+        shard.counters[k] = shard.counters.get(k,0)+v
+
+
+class Metrics:
+
+    # Accumulator of timing spans and counters
+    #   enabled  : set to False to turn off the instrumentation
+    # Every thread updates its own shard of the metrics, so recording needs
+    # no lock; snapshots add up the shards of all the threads:
+    #   spans    : {(stage, labels): [count, total time (s), max time (s)]}
+    #   counters : {(name, labels): value}
+    # When a thread ends its shard is folded into the retired one, so there
+    # is one live shard per running thread (executors created per call do
+    # not pile up shards). reset() starts a new generation: the shards of
+    # the previous one are cleared by their own thread before its next
+    # record and ignored by the snapshots until then.
+    def __init__(self,enabled=True):
+        self.enabled   = enabled
+        self._shards   = []
+        self._gen      = 0
+        self._retired  = _Shard(0)
+        self._lock     = threading.Lock()
+        self._local    = threading.local()
+
+    # Spans and counters of the current thread
+    def _shard(self):
+        try:
+            shard = self._local.holder.shard
+        except AttributeError:
+            shard  = _Shard(self._gen)
+            holder = _Holder(shard)
+            with self._lock:
+                self._shards.append(shard)
+            weakref.finalize(holder,Metrics._retire,weakref.ref(self),shard)
+            self._local.holder = holder
+            return shard
+        if(shard.gen != self._gen):
+            shard.spans.clear()
+            shard.counters.clear()
+            shard.gen = self._gen
+        return shard
+
+    # Fold the shard of an ended thread into the retired one
+    @staticmethod
+    def _retire(ref,shard):
+        self = ref()
+        if self is None:
+            return
+        with self._lock:
+            try:
+                self._shards.remove(shard)
+            except ValueError:
+                return
+            if(shard.gen == self._gen):
+                _add(self._retired,shard.spans,shard.counters)
+
+    # Time the code in the with block as a span of stage
+    def span(self,stage,**labels):
+        if not self.enabled:
+            return _NOSPAN
+        return _Span(self,_key(stage,labels))
+
+    # Add a timing (s) to stage
+    def observe(self,stage,seconds,**labels):
+        if not self.enabled: return
+        self._record(_key(stage,labels),seconds)
+
+    def _record(self,key,seconds):
+        self._observe(key,seconds)
+        collectors = getattr(self._local,'collectors',None)
+        if collectors:
+            for m in collectors: m._observe(key,seconds)
+
+    def _observe(self,key,seconds):
+        spans = self._shard().spans
+        s = spans.get(key)
+        if s is None:
+            spans[key] = [1,seconds,seconds]
+        else:
+            s[0] += 1
+            s[1] += seconds
+            if(seconds > s[2]): s[2] = seconds
+
+    # Increment a counter
+    def inc(self,name,value=1,**labels):
+        if not self.enabled: return
+        key = _key(name,labels)
+        self._inc(key,value)
+        collectors = getattr(self._local,'collectors',None)
+        if collectors:
+            for m in collectors: m._inc(key,value)
+
+    def _inc(self,key,value):
+        counters = self._shard().counters
+        counters[key] = counters.get(key,0)+value
+
+    # Collect the spans and counters of the with block (current thread only)
+    # in a separate Metrics, besides this one
+    @contextmanager
+    def collect(self):
+        task = Metrics()
+        self._collectors().append(task)
+        try:
+            yield task
+        finally:
+            self._collectors().remove(task)
+
+    def _collectors(self):
+        if not hasattr(self._local,'collectors'):
+            self._local.collectors = []
+        return self._local.collectors
+
+    # Plain (picklable, JSON friendly) copy of the metrics
+    def snapshot(self):
+        total = _Shard(0)
+        with self._lock:
+            gen    = self._gen
+            shards = [s for s in self._shards if s.gen == gen]
+            _add(total,self._retired.spans,self._retired.counters)
+        for shard in shards:
+            _add(total,shard.spans.copy(),shard.counters.copy())
+        spans,counters = total.spans,total.counters
+        return {'spans'    : [{'stage'  : k[0],
+                               'labels' : dict(k[1]),
+                               'count'  : v[0],
+                               'sum'    : v[1],
+                               'max'    : v[2]}
+                              for k,v in sorted(spans.items())],
+                'counters' : [{'name'   : k[0],
+                               'labels' : dict(k[1]),
+                               'value'  : v}
+                              for k,v in sorted(counters.items())]}
+
+    # Add a snapshot (e.g. from a worker process)
+    def merge(self,snap):
+        shard = self._shard()
+        spans,counters = shard.spans,shard.counters
+        for s in snap['spans']:
+            key = _key(s['stage'],s['labels'])
+            old = spans.get(key,[0,0.0,0.0])
+            spans[key] = [old[0]+s['count'],old[1]+s['sum'],max(old[2],s['max'])]
+        for c in snap['counters']:
+            key = _key(c['name'],c['labels'])
+            counters[key] = counters.get(key,0)+c['value']
+
+    def reset(self):
+        with self._lock:
+            self._gen    += 1
+            self._retired = _Shard(self._gen)
+
+    # Total time (s) of each stage, all labels summed
+    def stageTimes(self):
+        return stageTimes(self.snapshot())
+
+    # Prometheus text exposition format
+    def toPrometheus(self,prefix='evoodec'):
+        snap  = self.snapshot()
+        lines = ['# HELP %s_stage_seconds Time spent in each processing stage' % prefix,
+                 '# TYPE %s_stage_seconds summary' % prefix]
+        for s in snap['spans']:
+            labels = dict(s['labels'],stage=s['stage'])
+            lines.append('%s_stage_seconds_sum%s %.9g' % (prefix,_labels(labels),s['sum']))
+            lines.append('%s_stage_seconds_count%s %d' % (prefix,_labels(labels),s['count']))
+        lines.append('# HELP %s_stage_seconds_max Longest span of each processing stage' % prefix)
+        lines.append('# TYPE %s_stage_seconds_max gauge' % prefix)
+        for s in snap['spans']:
+            labels = dict(s['labels'],stage=s['stage'])
+            lines.append('%s_stage_seconds_max%s %.9g' % (prefix,_labels(labels),s['max']))
+        names = []
+        for c in snap['counters']:
+            if c['name'] not in names:
+                names.append(c['name'])
+                lines.append('# TYPE %s_%s counter' % (prefix,c['name']))
+            lines.append('%s_%s%s %.17g' % (prefix,c['name'],_labels(c['labels']),c['value']))
+        return '\n'.join(lines)+'\n'
+
+    # Write the Prometheus text to a file (atomically, for node exporters
+    # reading it at any time)
+    def writePrometheus(self,path,prefix='evoodec'):
+        tmp = '%s.%d.tmp' % (path,os.getpid())
+        with open(tmp,'w') as f:
+            f.write(self.toPrometheus(prefix))
+        os.replace(tmp,path)
+
+    # Text report of the time spent in each stage
+    def report(self):
+        times  = self.stageTimes()
+        counts = {}
+        for s in self.snapshot()['spans']:
+            counts[s['stage']] = counts.get(s['stage'],0)+s['count']
+        total = sum(times.values())
+        out   = '%-12s %8s %12s %7s\n' % ('Stage','Count','Time (ms)','Share')
+        for stage in STAGES+sorted(set(times)-set(STAGES)):
+            if stage not in times: continue
+            count = counts[stage]
+            out  += '%-12s %8d %12.3f %6.1f%%\n' % (stage,count,times[stage]*1000,
+                    100*times[stage]/total if total > 0 else 0)
+        return out
+
+
+# >>> Total time (s) of each stage in a snapshot, all labels summed
+def stageTimes(snap):
+    times = {}
+    for s in snap['spans']:
+        times[s['stage']] = times.get(s['stage'],0.0)+s['sum']
+    return times
+
+
+# >>> Prometheus labels {a="x",b="y"}
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k,str(v).replace('\\','\\\\').replace('"','\\"'))
+                             for k,v in sorted(labels.items()))
+
+
+class EventLog:
+
+    # Structured log: one JSON object per line, with a timestamp
+    #   out : file object, or file name (opened in append mode)
+    def __init__(self,out):
+        self._own = isinstance(out,str)
+        self.out  = open(out,'a') if self._own else out
+        self._lock = threading.Lock()
+
+    def write(self,event,**fields):
+        rec = dict(ts=round(time.time(),6),event=event,**fields)
+        line = json.dumps(rec,default=str)
+        with self._lock:
+            self.out.write(line+'\n')
+            self.out.flush()
+
+    def close(self):
+        if self._own: self.out.close()
+
+
+# Default metrics shared by the engine, the batch and the watch modes
+METRICS = Metrics()
@@ -0,0 +1,101 @@
+"""
+EVOODec savgol - Savitzky-Golay smoothing and derivatives of spectra
+
+A Savitzky-Golay filter fits a polynomial of a given order to the points
+of a moving window and replaces the central point by the value (or a
+derivative) of the polynomial there. On an evenly spaced x-axis the fit is
+linear in the data, so the filter is a convolution with a fixed kernel
+that depends only on the window length, the order, the derivative and the
+grid step. The first and last half-windows are evaluated on the polynomial
+fitted to the first and last full windows (as mode='interp' of
+scipy.signal.savgol_filter).
+
+The kernels are computed once (see engine.FilterCache) and applied to a
+spectrum or a batch of spectra in one vectorized pass over the window
+taps, so the cost is O(n_points * window) per spectrum.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+from math import factorial
+
+import numpy as np
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+class SavitzkyGolay:
+
+    # Savitzky-Golay filter
+    #   window : number of points of the moving window (odd)
+    #   order  : order of the fitted polynomial (smaller than window)
+    #   deriv  : derivative of the polynomial (0 for smoothing, at most order)
+    #   step   : grid step of the x-axis (signed, the derivatives are taken
+    #            with respect to x)
+    # Operators:
+    #   coef   : kernel of the interior points, coef[j] weights the point
+    #            j-half of the window
+    #   left   : rows of the first half-window points, shape (half, window)
+    #   right  : rows of the last half-window points, shape (half, window)
+    def __init__(self,window,order=2,deriv=0,step=1.0):
+        window = int(window)
+        order  = int(order)
+        deriv  = int(deriv)
+        if(window < 1 or window % 2 == 0):
+            raise Exception("Savitzky-Golay window must be a positive odd number of points!")
+        if(order >= window):
+            raise Exception("Savitzky-Golay order must be smaller than the window!")
+        if not 0 <= deriv <= order:
+            raise Exception("Savitzky-Golay derivative must be between 0 and the order!")
+        if(step == 0):
+            raise Exception("Savitzky-Golay filter needs a non-zero grid step!")
+        self.window = window
+        self.order  = order
+        self.deriv  = deriv
+        self.step   = float(step)
+
+        # Least squares fit of the polynomial on the window offsets, then
+        # the derivative of the polynomial at the evaluated offsets
+        half = window//2
+        t    = np.arange(-half,half+1,dtype=float)
+        PINV = np.linalg.pinv(t[:,None]**np.arange(order+1))
+        def rows(s):
+            s = np.asarray(s,dtype=float)
+            D = np.zeros((len(s),order+1))
+            for p in range(deriv,order+1):
+                D[:,p] = factorial(p)/factorial(p-deriv)*s**(p-deriv)
+            return np.dot(D,PINV)/self.step**deriv
+        self.coef  = rows([0.0])[0]
+        self.left  = rows(t[:half])
+        self.right = rows(t[half+1:])
+
+    @property
+    def nbytes(self):
+        return self.coef.nbytes+self.left.nbytes+self.right.nbytes
+
+    # Filter a spectrum (n_points,) or a batch of spectra along axis
+    def apply(self,ABS,axis=-1):
+        ABS = np.asarray(ABS)
+        if ABS.dtype != np.float32: ABS = ABS.astype(float)
+        Y   = np.moveaxis(ABS,axis,-1)
+        n   = Y.shape[-1]
+        w   = self.window
+        half = w//2
+        if(n < w):
+            raise Exception("Spectrum has %d points, less than the Savitzky-Golay "
+                            "window (%d)!" % (n,w))
+
+        coef = self.coef.astype(Y.dtype)
+        OUT  = np.empty(Y.shape,dtype=Y.dtype)
+        MID  = OUT[...,half:n-half]
+        np.multiply(Y[...,:n-w+1],coef[0],out=MID)
+        for j in range(1,w):
+            MID += coef[j]*Y[...,j:n-w+1+j]
+        OUT[...,:half]    = np.dot(Y[...,:w],self.left.T.astype(Y.dtype))
+        OUT[...,n-half:]  = np.dot(Y[...,n-w:],self.right.T.astype(Y.dtype))
+        return np.moveaxis(OUT,-1,axis)
@@ -0,0 +1,490 @@
+"""
+EVOODec service - local HTTP service for the deconvolution of spectra
+
+Loads the pigments reference once and keeps it, with the factorizations of
+its overlap matrix, warm in a pool of worker processes. Spectra are posted
+over HTTP and deconvolved with the options given on the command line:
+
+    POST /deconvolve    CSV body (sample file format, text/csv) or JSON
+                        {"x": [...], "abs": [...] or [[...], ...],
+                         "names": [...], "oplen": 1.0 or [...],
+                         "reconstruct": false}
+                        returns the concentrations (mg/kg) and R^2 of every
+                        spectrum, and the reconstructed spectra if asked
+                        (?reconstruct=1 for CSV bodies, ?wide=1 for CSV
+                        bodies with one sample per column)
+    GET  /health        status of the service
+    GET  /metrics       stage timings and counters (Prometheus text)
+
+Requests whose spectra share the x-axis are coalesced and deconvolved as a
+single batch (at most --batch-size spectra) by one worker: while all the
+workers are busy a batch waits --batch-wait ms for more requests, a free
+worker takes it at once. The number of spectra waiting is
+bounded by --max-pending: beyond it requests are refused (503) instead of
+queued.
+
+Usage:
+    python evoodec.py serve -r pigments/pigments.csv --port 8750 -j 2
+    curl --data-binary @spectra/evoo_test.csv -H 'Content-Type: text/csv' \\
+        http://127.0.0.1:8750/deconvolve
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import time
+import json
+import signal
+import asyncio
+import argparse
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+import engine
+import batch
+from metrics import METRICS
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+REASONS = {200:'OK',400:'Bad Request',404:'Not Found',405:'Method Not Allowed',
+           411:'Length Required',413:'Payload Too Large',422:'Unprocessable Entity',
+           500:'Internal Server Error',503:'Service Unavailable'}
+
+
+class RequestError(Exception):
+
+    # Error of a request, answered with the HTTP status
+    def __init__(self,status,msg):
+        Exception.__init__(self,msg)
+        self.status = status
+
+
+# >>> Load the reference data once per worker process and warm the cache of
+# factorizations with a deconvolution on the reference x-axis
+def initWorker(ref_file,opts):
+    global _REF,_OPTS
+    _REF  = engine.loadRef(ref_file)
+    _OPTS = opts
+    warm  = engine.Options(**dict(opts.__dict__,CI=0))
+    try:
+        engine.analyze(_REF,engine.Spectrum(_REF.X,_REF.EPS.sum(axis=1)),warm)
+    except Exception:
+        pass
+
+def _ping():
+    time.sleep(0.05)
+    return os.getpid()
+
+
+# >>> Deconvolve a batch of spectra (runs in the worker process).
+# Returns one dict per spectrum, the x-axis of the reconstruction (None if
+# not asked) and the metrics of the batch.
+def deconvolveBatch(X,ABS,OPLEN,names,reconstruct=False):
+    with METRICS.collect() as m:
+        evoo = engine.Spectrum(X,ABS,'request',names=names,OPLEN=OPLEN)
+        res  = engine.analyze(_REF,evoo,_OPTS)
+        conc = res.concppmAll()
+        ci   = None if res.CI is None else res.CI.limitsAll(res.FILTER)
+        samples = []
+        for i,name in enumerate(names):
+            s = {'name' : name,
+                 'rsq'  : _number(res.RSQ[i]),
+                 'conc' : dict(zip(_REF.PIGMENTS,_numbers(conc[i])))}
+            if res.SHIFT is not None:
+                s['shift'] = _number(res.SHIFT[i])
+            if ci is not None:
+                s['ci'] = {'low'  : dict(zip(_REF.PIGMENTS,_numbers(ci[0][i]))),
+                           'high' : dict(zip(_REF.PIGMENTS,_numbers(ci[1][i])))}
+            if reconstruct:
+                s['calc'] = _numbers(res.ABS_CALC[i])
+            samples.append(s)
+        X_REF = _numbers(res.X_REF) if reconstruct else None
+    return samples,X_REF,m.snapshot()
+
+
+# >>> JSON values of numbers (None for NaN and infinities)
+def _number(v):
+    v = float(v)
+    return v if np.isfinite(v) else None
+
+def _numbers(a):
+    return [_number(v) for v in np.ravel(a)]
+
+
+class Coalescer:
+
+    # Spectra sharing the x-axis and submitted within wait seconds of each
+    # other are deconvolved together by run(X, ABS, OPLEN, names,
+    # reconstruct) (a coroutine), in batches of at most max_batch spectra.
+    # When idle() is true (a worker is free) a batch does not wait: it only
+    # takes the spectra submitted in the same iteration of the event loop.
+    def __init__(self,run,max_batch=64,wait=0.001,idle=None):
+        self.run       = run
+        self.max_batch = max_batch
+        self.wait      = wait
+        self.idle      = idle
+        self._groups   = {}
+
+    # Results of the spectra ABS (n_samples, n_points) on the x-axis X
+    async def submit(self,X,ABS,OPLEN,names,reconstruct=False):
+        loop  = asyncio.get_running_loop()
+        fut   = loop.create_future()
+        key   = X.tobytes()
+        group = self._groups.get(key)
+        if group is None:
+            if self.idle is not None and self.idle():
+                timer = loop.call_soon(self._flush,key)
+            else:
+                timer = loop.call_later(self.wait,self._flush,key)
+            group = self._groups[key] = {'X':X,'items':[],'size':0,'timer':timer}
+        group['items'].append((ABS,OPLEN,names,reconstruct,fut))
+        group['size'] += len(ABS)
+        if(group['size'] >= self.max_batch):
+            group['timer'].cancel()
+            self._flush(key)
+        return await fut
+
+    def _flush(self,key):
+        group = self._groups.pop(key,None)
+        if group is not None:
+            asyncio.ensure_future(self._run(group))
+
+    async def _run(self,group):
+        items = group['items']
+        ABS   = np.vstack([it[0] for it in items])
+        OPLEN = np.concatenate([it[1] for it in items])
+        names = [n for it in items for n in it[2]]
+        METRICS.inc('coalesced_batches_total')
+        METRICS.inc('coalesced_spectra_total',len(ABS))
+        try:
+            samples,X_REF = await self.run(group['X'],ABS,OPLEN,names,
+                                           any(it[3] for it in items))
+        except Exception as e:
+            for it in items:
+                if not it[4].done(): it[4].set_exception(e)
+            return
+        i = 0
+        for A,_,_,reconstruct,fut in items:
+            if not fut.done():
+                fut.set_result((samples[i:i+len(A)],X_REF if reconstruct else None))
+            i += len(A)
+
+
+class Service:
+
+    # HTTP service (see the module documentation)
+    #   ref, opts   : reference data and deconvolution options
+    #   pool        : executor running deconvolveBatch (process pool, or a
+    #                 thread in the service process)
+    #   max_pending : largest number of spectra waiting for a worker
+    #   max_body    : largest request body (bytes)
+    def __init__(self,ref,opts,pool,workers,max_batch=64,wait=0.001,
+        max_pending=1024,max_body=16*1024**2,wide=False,events=None):
+        self.ref         = ref
+        self.opts        = opts
+        self.pool        = pool
+        self.workers     = workers
+        self.max_pending = max_pending
+        self.max_body    = max_body
+        self.wide        = wide
+        self.events      = events
+        self.pending     = 0
+        self.running     = 0
+        self.started     = time.time()
+        self.coalescer   = Coalescer(self.run,max_batch,wait,
+                                     lambda: self.running < max(workers,1))
+        self._slots      = asyncio.Semaphore(2*max(workers,1))
+
+    # Deconvolve a coalesced batch in the pool (at most two batches per
+    # worker are handed to the pool, the others wait here)
+    async def run(self,X,ABS,OPLEN,names,reconstruct):
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            self.running += 1
+            try:
+                samples,X_REF,snap = await loop.run_in_executor(self.pool,
+                    deconvolveBatch,X,ABS,OPLEN,names,reconstruct)
+            finally:
+                self.running -= 1
+        if self.workers > 0:
+            METRICS.merge(snap)
+        return samples,X_REF
+
+    # >>> Connection of a client: HTTP/1.1 requests, kept alive
+    async def handle(self,reader,writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                t0 = time.perf_counter()
+                try:
+                    method,target,version = line.decode('latin-1').split()
+                except ValueError:
+                    await self.respond(writer,400,'Malformed request line',close=True)
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b'\r\n',b'\n',b''):
+                        break
+                    k,_,v = h.decode('latin-1').partition(':')
+                    headers[k.strip().lower()] = v.strip()
+                keep = (version == 'HTTP/1.1' and
+                        headers.get('connection','').lower() != 'close')
+
+                try:
+                    if 'transfer-encoding' in headers:
+                        raise RequestError(411,"Chunked bodies are not supported, "
+                                               "send a Content-Length!")
+                    length = int(headers.get('content-length') or 0)
+                    if(length > self.max_body):
+                        keep = False
+                        raise RequestError(413,"Request body larger than %d bytes!"
+                                               % self.max_body)
+                    body = await reader.readexactly(length) if length > 0 else b''
+                    status,ctype,payload = await self.route(method,target,headers,body)
+                except RequestError as e:
+                    status,ctype,payload = e.status,'application/json',{'error':str(e)}
+                except ValueError as e:
+                    status,ctype,payload = 400,'application/json',{'error':str(e)}
+                except Exception as e:
+                    # Unexpected failure: answer instead of dropping the
+                    # connection, then close it
+                    METRICS.inc('errors_total')
+                    keep = False
+                    status,ctype,payload = 500,'application/json',{
+                        'error':"Internal error: %s: %s" % (type(e).__name__,e)}
+
+                await self.respond(writer,status,payload,ctype,not keep)
+                path = urlsplit(target).path
+                dt   = time.perf_counter()-t0
+                METRICS.inc('http_requests_total',path=path,status=status)
+                METRICS.observe('request',dt,path=path)
+                if self.events is not None:
+                    self.events.write('request',method=method,path=path,status=status,
+                                      latency=dt,error=payload.get('error')
+                                      if isinstance(payload,dict) else None)
+                if not keep:
+                    break
+        except (asyncio.IncompleteReadError,ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self,writer,status,payload,ctype='application/json',close=False):
+        if(ctype == 'application/json'):
+            if isinstance(payload,str): payload = {'error':payload}
+            body = json.dumps(payload,allow_nan=False).encode()
+        else:
+            body = payload.encode()
+        head = ('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                'Connection: %s\r\n\r\n' % (status,REASONS.get(status,''),ctype,
+                len(body),'close' if close else 'keep-alive'))
+        writer.write(head.encode('latin-1')+body)
+        await writer.drain()
+
+    # >>> Status, content type and payload of a request
+    async def route(self,method,target,headers,body):
+        url   = urlsplit(target)
+        query = {k:v[-1] for k,v in parse_qs(url.query).items()}
+        if(url.path == '/health'):
+            if(method != 'GET'): raise RequestError(405,"Use GET!")
+            return 200,'application/json',self.health()
+        if(url.path == '/metrics'):
+            if(method != 'GET'): raise RequestError(405,"Use GET!")
+            return 200,'text/plain; version=0.0.4',METRICS.toPrometheus()
+        if(url.path == '/deconvolve'):
+            if(method != 'POST'): raise RequestError(405,"Use POST!")
+            return 200,'application/json',await self.deconvolve(headers,body,query)
+        raise RequestError(404,"Unknown path %s!" % url.path)
+
+    def health(self):
+        return {'status'    : 'ok',
+                'reference' : self.ref.filename,
+                'pigments'  : self.ref.PIGMENTS,
+                'workers'   : self.workers,
+                'running'   : self.running,
+                'pending'   : self.pending,
+                'uptime'    : round(time.time()-self.started,3)}
+
+    # >>> Deconvolution of the spectra of a request
+    async def deconvolve(self,headers,body,query):
+        X,ABS,OPLEN,names,reconstruct = self.parse(headers,body,query)
+        if(self.pending+len(ABS) > self.max_pending):
+            METRICS.inc('rejected_spectra_total',len(ABS))
+            raise RequestError(503,"Too many spectra waiting, retry later!")
+        self.pending += len(ABS)
+        try:
+            samples,X_REF = await self.coalescer.submit(X,ABS,OPLEN,names,reconstruct)
+        except Exception as e:
+            METRICS.inc('errors_total')
+            raise RequestError(422,str(e))
+        finally:
+            self.pending -= len(ABS)
+        out = {'pigments':self.ref.PIGMENTS,'samples':samples}
+        if reconstruct: out['x'] = X_REF
+        return out
+
+    # >>> x-axis, spectra (n_samples, n_points), optical path lengths, sample
+    # ids and reconstruction flag of a request body
+    def parse(self,headers,body,query):
+        ctype = headers.get('content-type','').split(';')[0].strip().lower()
+        flag  = lambda v: str(v).lower() in ('1','true','yes')
+        if(ctype == 'application/json'):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                raise RequestError(400,"Request body is not valid JSON!")
+            if not isinstance(data,dict):
+                raise RequestError(400,"Request body must be a JSON object with the "
+                                       "fields x and abs!")
+            missing = [k for k in ('x','abs') if k not in data]
+            if missing:
+                raise RequestError(400,"Missing field %s!" % ' and '.join(missing))
+            try:
+                X   = np.asarray(data['x'],dtype=float)
+                ABS = np.asarray(data['abs'],dtype=float)
+            except (TypeError,ValueError):
+                raise RequestError(400,"Fields x and abs must be lists of numbers "
+                                       "(abs: one list per spectrum, all of the same length)!")
+            names = data.get('names')
+            oplen = data.get('oplen')
+            reconstruct = flag(data.get('reconstruct',query.get('reconstruct',False)))
+        else:
+            try:
+                evoo  = engine.parseCSV(body.splitlines(),query.get('name','request'),
+                                        wide=self.wide or flag(query.get('wide',False)))
+            except Exception as e:
+                raise RequestError(400,str(e))
+            X,ABS = evoo.X,evoo.ABS
+            names = evoo.names
+            oplen = query.get('oplen')
+            reconstruct = flag(query.get('reconstruct',False))
+
+        # Spectra: 1-D wavelength, absorbances with its points, enough of
+        # them for the resampling, finite values
+        if(X.ndim != 1):
+            raise RequestError(400,"Wavelength x must be a list of numbers!")
+        if(ABS.ndim not in (1,2)):
+            raise RequestError(400,"Absorbance abs must be a list of numbers or a list "
+                                   "of spectra!")
+        if(ABS.ndim == 2 and len(ABS) == 0):
+            raise RequestError(400,"No spectra in the request!")
+        if(ABS.shape[-1] != len(X)):
+            raise RequestError(400,"Absorbance has %d points, wavelength has %d!"
+                               % (ABS.shape[-1],len(X)))
+        npt = engine.Resampler.MIN_POINTS[self.opts.RESAMPLE]
+        if(len(X) < npt):
+            raise RequestError(400,"Spectra must have at least %d points!" % npt)
+        if not (np.isfinite(X).all() and np.isfinite(ABS).all()):
+            raise RequestError(400,"Spectra must not contain NaN or infinite values!")
+        dx = np.diff(X)
+        if not (np.all(dx > 0) or np.all(dx < 0)):
+            raise RequestError(400,"Wavelengths must be strictly increasing or decreasing!")
+        if(ABS.ndim == 1):
+            names = [names if isinstance(names,str) else query.get('name','sample')]
+            ABS   = ABS[None,:]
+        elif names is None:
+            names = ['sample:%d' % i for i in range(len(ABS))]
+        if not isinstance(names,list):
+            raise RequestError(400,"Names must be a list of sample ids!")
+        if(len(names) != len(ABS)):
+            raise RequestError(400,"%d names for %d spectra!" % (len(names),len(ABS)))
+
+        # Optical path length: one for all the spectra or one per spectrum
+        try:
+            OPLEN = np.asarray(self.opts.OPLEN if oplen is None else oplen,dtype=float)
+            OPLEN = np.broadcast_to(OPLEN,(len(ABS),)).copy()
+        except (TypeError,ValueError):
+            raise RequestError(400,"Optical path length must be a number or one "
+                                   "number per spectrum!")
+        if not (np.isfinite(OPLEN).all() and (OPLEN > 0).all()):
+            raise RequestError(400,"Optical path lengths must be positive numbers!")
+        return X,ABS,OPLEN,[str(n) for n in names],reconstruct
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec serve',
+        description='HTTP service for the deconvolution of EVOO spectra')
+    parser.add_argument('--host',default='127.0.0.1',
+        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port',type=int,default=8750,
+        help='port to listen on (default: %(default)s)')
+    parser.add_argument('-j','--workers',type=int,default=1,
+        help='worker processes, 0 to deconvolve in the service process '
+             '(default: %(default)s)')
+    parser.add_argument('--batch-size',type=int,default=64,
+        help='largest number of spectra deconvolved together (default: %(default)s)')
+    parser.add_argument('--batch-wait',type=float,default=1.0,
+        help='time (ms) a request waits for others to share its batch while '
+             'all the workers are busy (default: %(default)s)')
+    parser.add_argument('--max-pending',type=int,default=1024,
+        help='largest number of spectra waiting for a worker (default: %(default)s)')
+    parser.add_argument('--max-body',type=int,default=16*1024**2,
+        help='largest request body in bytes (default: %(default)s)')
+    batch.addOptionArgs(parser)
+    return parser.parse_args(argv)
+
+
+# >>> Run the service until interrupted
+async def serve(args,ref,opts,log):
+    if(args.workers > 0):
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=args.workers,initializer=initWorker,
+                                   initargs=(args.ref,opts))
+
+        # Start all the workers (and warm their caches) before serving
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(pool,_ping)
+                               for i in range(args.workers)])
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        initWorker(args.ref,opts)
+        pool = ThreadPoolExecutor(max_workers=1)
+
+    events  = batch.openEvents(args)
+    service = Service(ref,opts,pool,args.workers,args.batch_size,args.batch_wait/1000,
+                      args.max_pending,args.max_body,args.wide,events)
+    server  = await asyncio.start_server(service.handle,args.host,args.port)
+    stop    = asyncio.Event()
+    loop    = asyncio.get_running_loop()
+    for sig in (signal.SIGINT,signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig,stop.set)
+        except (NotImplementedError,RuntimeError):
+            pass
+    log("Serving %s on http://%s:%d (%d workers, Ctrl+C to stop)\n"
+        % (os.path.basename(args.ref),args.host,args.port,args.workers))
+    try:
+        async with server:
+            await stop.wait()
+    finally:
+        pool.shutdown()
+        batch.writeMetrics(args,events,log)
+
+
+# >>> Entry point of the service mode
+def main(argv=None):
+    args = parseArgs(argv)
+    log  = lambda msg: sys.stderr.write(msg)
+
+    ref  = engine.loadRef(args.ref)
+    opts = batch.optionsFromArgs(args,ref)
+    try:
+        asyncio.run(serve(args,ref,opts,log))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
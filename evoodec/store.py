@@ -0,0 +1,460 @@
+"""
+EVOODec store - indexed database of the deconvolution results
+
+Results of batch runs, of the watch mode and of the GUI are recorded in a
+SQLite database (one file, Python standard library only):
+
+    runs            one line per run: date, reference file and content
+                    hash, pigments of the reference, deconvolution options
+                    (JSON), source of the run (batch, watch, gui)
+    results         one line per sample: run, sample id, source file,
+                    date, R^2, error message, archive and index of the
+                    sample (samples read from a spectral archive)
+    concentrations  one line per sample and pigment used in the
+                    deconvolution: concentration and confidence interval
+                    limits (mg/kg)
+
+Concentrations are indexed by pigment and value, results by date, sample id
+and file, so queries such as "all the samples with Pheo-a above 2 mg/kg
+this month" do not scan the table. The samples of a run are inserted in a
+single transaction. Spectra are not stored: run options, reference hash,
+source file (or archive) and sample id are the reference of the
+reconstruction, which is recomputed on demand (see ResultStore.reconstruct).
+
+Usage:
+    python evoodec.py -r pigments/pigments.csv spectra/ --store results.db
+    python evoodec.py query results.db --where "Pheo-a>2" --month 2026-10
+    python evoodec.py query results.db --reconstruct 42 -o sample42.csv
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import re
+import json
+import time
+import sqlite3
+import argparse
+import datetime
+
+import numpy as np
+
+import engine
+import batch
+from metrics import METRICS
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id          INTEGER PRIMARY KEY,
+    created     REAL NOT NULL,
+    source      TEXT,
+    reference   TEXT,
+    ref_digest  TEXT,
+    pigments    TEXT NOT NULL,
+    options     TEXT NOT NULL,
+    wide        INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS results (
+    id          INTEGER PRIMARY KEY,
+    run_id      INTEGER NOT NULL REFERENCES runs(id),
+    sample      TEXT NOT NULL,
+    file        TEXT,
+    created     REAL NOT NULL,
+    rsq         REAL,
+    error       TEXT,
+    archive     TEXT,
+    member      INTEGER
+);
+CREATE TABLE IF NOT EXISTS concentrations (
+    result_id   INTEGER NOT NULL REFERENCES results(id),
+    pigment     TEXT NOT NULL,
+    conc        REAL,
+    low         REAL,
+    high        REAL,
+    PRIMARY KEY (result_id,pigment)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS conc_pigment    ON concentrations(pigment,conc);
+CREATE INDEX IF NOT EXISTS results_created ON results(created);
+CREATE INDEX IF NOT EXISTS results_sample  ON results(sample);
+CREATE INDEX IF NOT EXISTS results_file    ON results(file);
+CREATE INDEX IF NOT EXISTS results_run     ON results(run_id);
+"""
+
+# Columns added to the tables of databases created by earlier versions
+COLUMNS = [('results','archive','TEXT'),('results','member','INTEGER')]
+
+# Comparison operators of the concentration conditions
+OPERATORS = ['>=','<=','>','<','=']
+
+
+class StoredResult:
+
+    # Result read from the store
+    #   id, run      : ids of the result and of its run
+    #   sample, file : sample id and source file
+    #   archive      : archive of the sample and index in it (member), None
+    #                  if the sample was not read from an archive
+    #   created      : date of the run (s since the epoch)
+    #   rsq, error   : R^2 and error message ('' if none)
+    #   conc         : {pigment: (concentration, low, high)} (mg/kg), the
+    #                  limits are None without confidence intervals
+    def __init__(self,**kwargs):
+        self.__dict__.update(kwargs)
+
+
+# >>> JSON form of the deconvolution options (NumPy values as lists and
+# numbers) and back
+def optionsToJSON(opts):
+    def value(v):
+        if isinstance(v,np.ndarray): return v.tolist()
+        if isinstance(v,np.generic): return v.item()
+        return v
+    return json.dumps({k: value(v) for k,v in sorted(vars(opts).items())})
+
+def optionsFromJSON(text):
+    return engine.Options(**json.loads(text))
+
+
+# >>> Condition on the concentration of a pigment: "Pheo-a>2" ->
+# ('Pheo-a', '>', 2.0)
+def parseCondition(text):
+    m = re.match(r'^\s*(.+?)\s*(%s)\s*([-+.\deE]+)\s*$' % '|'.join(OPERATORS),text)
+    if m is None:
+        raise Exception("Invalid condition '%s' (expected e.g. Pheo-a>2)!" % text)
+    return m.group(1),m.group(2),float(m.group(3))
+
+
+# >>> Date of the command line (YYYY-MM-DD, optionally followed by a time
+# HH:MM[:SS]) as seconds since the epoch, local time
+def parseDate(text):
+    for fmt in ('%Y-%m-%d','%Y-%m-%d %H:%M','%Y-%m-%dT%H:%M',
+                '%Y-%m-%d %H:%M:%S','%Y-%m-%dT%H:%M:%S'):
+        try:
+            return time.mktime(time.strptime(text,fmt))
+        except ValueError:
+            pass
+    raise Exception("Invalid date '%s' (expected YYYY-MM-DD [HH:MM[:SS]])!" % text)
+
+# >>> First and last instant (exclusive) of a month YYYY-MM
+def monthRange(text):
+    try:
+        start = datetime.datetime.strptime(text,'%Y-%m')
+    except ValueError:
+        raise Exception("Invalid month '%s' (expected YYYY-MM)!" % text)
+    end = start.replace(year=start.year+start.month//12,month=start.month%12+1)
+    return time.mktime(start.timetuple()),time.mktime(end.timetuple())
+
+
+def _real(x):
+    x = float(x)
+    return None if np.isnan(x) else x
+
+
+class ResultStore:
+
+    # Results database (the file is created with its tables on first use).
+    # Writes use the write-ahead log: readers (queries) are not blocked by
+    # a batch inserting its results.
+    def __init__(self,path):
+        self.path = path
+        self.db   = sqlite3.connect(path,isolation_level=None,timeout=30)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(SCHEMA)
+        for table,column,decl in COLUMNS:
+            if column not in [c[1] for c in self.db.execute('PRAGMA table_info(%s)' % table)]:
+                self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table,column,decl))
+        self._runs = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    # Statements run in one transaction: committed at the end of the block,
+    # rolled back on errors
+    def _transaction(self,run):
+        cur = self.db.cursor()
+        cur.execute('BEGIN IMMEDIATE')
+        try:
+            out = run(cur)
+        except BaseException:
+            cur.execute('ROLLBACK')
+            raise
+        cur.execute('COMMIT')
+        return out
+
+    # Record a run of the deconvolution of the reference ref with the
+    # options opts, returns its id. ref_file is the reference file (for the
+    # reconstructions), source the program that produced the results.
+    def addRun(self,ref,opts,ref_file=None,source=None,wide=False):
+        opts.mask(len(ref.PIGMENTS))
+        row = (time.time(),source,None if ref_file is None else os.path.abspath(ref_file),
+               ref.digest,json.dumps(list(ref.PIGMENTS)),optionsToJSON(opts),int(wide))
+        return self._transaction(lambda cur: cur.execute(
+            'INSERT INTO runs (created,source,reference,ref_digest,pigments,options,wide) '
+            'VALUES (?,?,?,?,?,?,?)',row).lastrowid)
+
+    # Pigments of the reference and mask of the pigments used in a run
+    def _pigments(self,run):
+        if run not in self._runs:
+            row = self.db.execute('SELECT pigments,options FROM runs WHERE id=?',
+                                  (run,)).fetchone()
+            if row is None:
+                raise Exception("Run %d not found in %s!" % (run,self.path))
+            pigments = json.loads(row[0])
+            self._runs[run] = (pigments,optionsFromJSON(row[1]).mask(len(pigments)))
+        return self._runs[run]
+
+    # Bulk insert of rows of the results table (see batch.resultRows) in a
+    # single transaction, returns the ids of the results. Only the pigments
+    # used in the deconvolution get a concentration; failed samples none.
+    def insertRows(self,run,rows,created=None):
+        pigments,mask = self._pigments(run)
+        used = np.nonzero(mask)[0]
+        if created is None: created = time.time()
+
+        # Parameters are prepared before the transaction (column-wise, one
+        # row per sample and pigment used), ids added in it
+        paths = {}
+        for row in rows:
+            f = row[1]
+            if f not in paths: paths[f] = os.path.abspath(f) if f and f != '-' else f
+            if row[6] is not None and row[6][0] not in paths:
+                paths[row[6][0]] = os.path.abspath(row[6][0])
+        ok   = [k for k,row in enumerate(rows) if not row[4]]
+        nan  = np.full(len(mask),np.nan)
+        def column(i,j=None):
+            V = np.array([rows[k][i] if j is None else
+                          (nan if rows[k][i] is None else rows[k][i][j]) for k in ok],
+                         dtype=float).reshape(len(ok),len(mask))[:,used].ravel()
+            OUT = V.astype(object)
+            OUT[np.isnan(V)] = None
+            return OUT.tolist()
+        K    = np.repeat(ok,len(used))
+        PIG  = [pigments[i] for i in used]*len(ok)
+        CONC = list(zip(PIG,column(3),column(5,0),column(5,1)))
+
+        def insert(cur):
+            first = cur.execute('SELECT COALESCE(MAX(id),0)+1 FROM results').fetchone()[0]
+            cur.executemany('INSERT INTO results VALUES (?,?,?,?,?,?,?,?,?)',
+                [(first+k,run,name,paths[f],created,_real(rsq),err or None)+
+                 ((None,None) if member is None else (paths[member[0]],int(member[1])))
+                 for k,(name,f,rsq,conc,err,lim,member) in enumerate(rows)])
+            cur.executemany('INSERT INTO concentrations VALUES (?,?,?,?,?)',
+                [(rid,)+c for rid,c in zip((K+first).tolist(),CONC)])
+            return list(range(first,first+len(rows)))
+
+        ids = self._transaction(insert)
+        METRICS.inc('stored_results_total',len(ids))
+        return ids
+
+    # Store a deconvolution result (engine.Result) of a run
+    def insertResult(self,run,res,name=None):
+        return self.insertRows(run,batch.resultRows(res,name))
+
+    # Results matching all the given conditions, in order of insertion:
+    #   where        : conditions on the concentrations, (pigment, operator,
+    #                  value) tuples (see parseCondition)
+    #   since, until : dates of the run (s since the epoch, until excluded)
+    #   sample, file : sample id and source file, glob patterns
+    #   run          : run id
+    #   limit        : largest number of results
+    def query(self,where=(),since=None,until=None,sample=None,file=None,run=None,
+              limit=None):
+        sql  = ['SELECT id,run_id,sample,file,created,rsq,error,archive,member '
+                'FROM results WHERE 1']
+        args = []
+        for pigment,op,value in where:
+            if op not in OPERATORS:
+                raise Exception("Unknown operator '%s'!" % op)
+            sql.append('AND id IN (SELECT result_id FROM concentrations '
+                       'WHERE pigment=? AND conc %s ?)' % op)
+            args += [pigment,value]
+        for column,op,value in (('created','>=',since),('created','<',until),
+                                ('sample','GLOB',sample),('file','GLOB',file),
+                                ('run_id','=',run)):
+            if value is not None:
+                sql.append('AND %s %s ?' % (column,op))
+                args.append(value)
+        sql.append('ORDER BY id')
+        if limit is not None:
+            sql.append('LIMIT %d' % int(limit))
+        rows = self.db.execute(' '.join(sql),args).fetchall()
+
+        results = [StoredResult(id=r[0],run=r[1],sample=r[2],file=r[3],created=r[4],
+                                rsq=np.nan if r[5] is None else r[5],
+                                error=r[6] or '',archive=r[7],member=r[8],conc={})
+                   for r in rows]
+        index = {res.id: res for res in results}
+        ids   = list(index)
+        for i in range(0,len(ids),500):
+            chunk = ids[i:i+500]
+            for rid,pigment,conc,low,high in self.db.execute(
+                    'SELECT result_id,pigment,conc,low,high FROM concentrations '
+                    'WHERE result_id IN (%s)' % ','.join('?'*len(chunk)),chunk):
+                index[rid].conc[pigment] = (np.nan if conc is None else conc,low,high)
+        return results
+
+    # Pigments of the runs of the results, in the order of the references
+    def pigments(self,results):
+        out = []
+        for run in sorted({res.run for res in results}):
+            out += [p for p in self._pigments(run)[0] if p not in out]
+        return out
+
+    # Deconvolution of a stored result recomputed from the source file (or
+    # the archive: same grid and optical path length as in the run), the
+    # reference and the options of its run (engine.Result). The reference
+    # file must be unchanged; ref_file replaces the one of the run (e.g.
+    # moved to another directory).
+    def reconstruct(self,result_id,ref_file=None,log=None):
+        row = self.db.execute(
+            'SELECT r.sample,r.file,r.archive,r.member,u.reference,u.ref_digest,'
+            'u.options,u.wide FROM results r JOIN runs u ON u.id=r.run_id WHERE r.id=?',
+            (result_id,)).fetchone()
+        if row is None:
+            raise Exception("Result %d not found in %s!" % (result_id,self.path))
+        sample,filename,arc,member,reference,digest,options,wide = row
+        source = filename if arc is None else arc
+        if not source or source == '-' or not os.path.exists(source):
+            raise Exception("Source %s of result %d is not available (%s)!"
+                            % ('file' if arc is None else 'archive',result_id,source or 'none'))
+        ref = engine.loadRef(ref_file or reference,log)
+        if(ref.digest != digest):
+            raise Exception("Reference data differ from the ones of the run of "
+                            "result %d!" % result_id)
+        if arc is not None:
+            import archive
+            a = archive.Archive(arc)
+            if(member >= len(a) or a.names[member] != sample):
+                raise Exception("Sample %s not found at index %d of %s!" % (sample,member,arc))
+            evoo = a.spectrum(member)
+        else:
+            evoo = loadSample(filename,sample,log,bool(wide))
+        return engine.analyze(ref,evoo,optionsFromJSON(options),log)
+
+
+# >>> Sample of a source file (engine.Spectrum): the file itself, or the
+# sample id of a batch. A suffix ~N made the id unique in an archive (see
+# archive.ArchiveWriter), the source file has the id without it.
+def loadSample(filename,sample,log=None,wide=False):
+    evoo = engine.loadEVOO(filename,log,wide=wide)
+    if not evoo.isBatch():
+        return evoo
+    names = list(evoo.names)
+    if sample not in names:
+        sample = re.sub(r'~\d+$','',sample)
+    if sample not in names:
+        raise Exception("Sample %s not found in %s!" % (sample,filename))
+    return evoo.sample(names.index(sample))
+
+
+# >>> Table of query results (";" separated, as the batch results table);
+# nan for the pigments not used in the run of a result
+def writeQuery(results,pigments,out):
+    ci = any(c[1] is not None for res in results for c in res.conc.values())
+    cols = ['%s (mg/kg)' % p for p in pigments]
+    if ci:
+        cols += ['%s low (mg/kg)' % p for p in pigments]
+        cols += ['%s high (mg/kg)' % p for p in pigments]
+    out.write('#Id;Run;Date;Sample;File;R-square;%sError\n' % ''.join(c+';' for c in cols))
+    for res in results:
+        vals = [res.conc.get(p,(np.nan,None,None)) for p in pigments]
+        conc = [v[0] for v in vals]
+        if ci:
+            conc += [np.nan if v[1] is None else v[1] for v in vals]
+            conc += [np.nan if v[2] is None else v[2] for v in vals]
+        out.write('%d;%d;%s;%s;%s;%.6f;%s%s\n' % (res.id,res.run,
+                  time.strftime('%Y-%m-%d %H:%M:%S',time.localtime(res.created)),
+                  res.sample,res.file or '',res.rsq,
+                  ''.join('%.4f;' % c for c in conc),
+                  res.error.replace(';',',').replace('\n',' ')))
+
+
+# >>> Reconstructed spectrum of a result (";" separated): wavelength,
+# processed sample, reconstruction and contribution of every pigment
+def writeReconstruction(res,out):
+    cols = ['Wavelength (nm)','Sample','Calculated']+list(res.PIGMENTS)
+    out.write('#%s\n' % ';'.join(cols))
+    DATA = [res.X_REF,res.ABS_EVOO,res.ABS_CALC]
+    if res.ABS_CALC_CONTR is not None:
+        DATA += list(np.asarray(res.ABS_CALC_CONTR).T)
+    np.savetxt(out,np.column_stack(DATA),fmt="%16.8E",delimiter=";")
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec query',
+        description='Query the results database of EVOODec')
+    parser.add_argument('database',
+        help='results database (see --store of the batch and watch modes)')
+    parser.add_argument('--where',action='append',default=[],metavar='COND',
+        help='condition on a concentration in mg/kg, e.g. "Pheo-a>2" '
+             '(operators %s, repeat for several conditions)' % ' '.join(OPERATORS))
+    parser.add_argument('--since',default=None,metavar='DATE',
+        help='results of the runs from this date (YYYY-MM-DD [HH:MM[:SS]])')
+    parser.add_argument('--until',default=None,metavar='DATE',
+        help='results of the runs before this date')
+    parser.add_argument('--month',default=None,metavar='YYYY-MM',
+        help='results of the runs of this month')
+    parser.add_argument('--sample',default=None,
+        help='sample id (glob pattern)')
+    parser.add_argument('--file',default=None,
+        help='source file (glob pattern on the absolute path)')
+    parser.add_argument('--run',type=int,default=None,
+        help='results of this run id')
+    parser.add_argument('--limit',type=int,default=None,
+        help='largest number of results')
+    parser.add_argument('--reconstruct',type=int,default=None,metavar='ID',
+        help='write the reconstructed spectrum of this result instead')
+    parser.add_argument('-r','--ref',default=None,
+        help='reference file of the reconstruction (default: the one of the run)')
+    parser.add_argument('-o','--output',default='-',
+        help='output file, "-" for standard output (default)')
+    return parser.parse_args(argv)
+
+
+# >>> Entry point of the query mode
+def main(argv=None):
+    args = parseArgs(argv)
+    if not os.path.exists(args.database):
+        sys.stderr.write("%s not found!\n" % args.database)
+        return 1
+
+    out = sys.stdout if args.output == '-' else open(args.output,'w')
+    try:
+        with ResultStore(args.database) as db:
+            if args.reconstruct is not None:
+                writeReconstruction(db.reconstruct(args.reconstruct,args.ref),out)
+                return 0
+            since = None if args.since is None else parseDate(args.since)
+            until = None if args.until is None else parseDate(args.until)
+            if args.month is not None:
+                start,end = monthRange(args.month)
+                since = start if since is None else max(since,start)
+                until = end if until is None else min(until,end)
+            results = db.query([parseCondition(c) for c in args.where],since,until,
+                               args.sample,args.file,args.run,args.limit)
+            writeQuery(results,db.pigments(results),out)
+            sys.stderr.write("%d results\n" % len(results))
+    finally:
+        if out is not sys.stdout: out.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
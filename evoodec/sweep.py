@@ -0,0 +1,149 @@
+"""
+EVOODec sweep - stability of the deconvolution over the spectral window
+
+Deconvolves every sample over a grid of spectral windows (all the
+combinations of the start and end wavelengths) and writes one row per
+sample and window (";" separated) with the R^2 and the concentrations. The
+stability of every pigment over the windows and the window of highest R^2
+are reported on the standard error.
+
+The results of a window are the ones of the deconvolution of that window
+alone. Without baseline or with the min baseline, the quadratures of every
+window come from prefix sums over the reference x-axis (see
+engine.sweepWindows), so hundreds of windows cost about as much as a single
+deconvolution. The other baseline models (--baseline-model poly,
+rubberband, als) and the Savitzky-Golay filter (--savgol) depend on the
+whole window: every window is then pre-processed and deconvolved on its
+own, at the cost of a full deconvolution per window.
+
+Usage:
+    python evoodec.py sweep -r pigments/pigments.csv sample.csv \\
+        --start 390:500:5 --end 450:720:5 -o sweep.csv
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import argparse
+
+import numpy as np
+
+import engine
+import batch
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+# >>> Wavelengths from a "first:last:step" range (last included) or a comma
+# separated list
+def parseRange(text):
+    try:
+        if ':' in text:
+            first,last,step = [float(v) for v in text.split(':')]
+            if(step <= 0):
+                raise ValueError
+            return np.arange(first,last+step/2,step)
+        return np.array([float(v) for v in text.split(',')])
+    except ValueError:
+        raise argparse.ArgumentTypeError("'%s' is not a wavelength range "
+                                         "(first:last:step or a list)" % text)
+
+
+# >>> Write the rows of a sweep: one per sample and evaluated window
+def writeSweep(sw,out):
+    conc = sw.concppm
+    RSQ  = sw.RSQ
+    if sw.names is None:
+        names = [os.path.basename(sw.filename)]
+        conc  = conc[:,:,None]
+        RSQ   = RSQ[:,:,None]
+    else:
+        names = sw.names
+    for i,j in np.argwhere(sw.NPT > 0):
+        for k,name in enumerate(names):
+            out.write('%s;%s;%g;%g;%d;%.6f;%s\n' % (name,sw.filename,
+                      sw.X_START[i],sw.X_END[j],sw.NPT[i,j],RSQ[i,j,k],
+                      ';'.join('%.4f' % c for c in conc[i,j,k])))
+
+def writeHeader(pigments,out):
+    out.write('#Sample;File;Start (nm);End (nm);Points;R-square;%s\n' %
+              ';'.join('%s (mg/kg)' % p for p in pigments))
+
+
+# >>> Text report of the stability of the concentrations over the windows
+def formatStability(sw):
+    ave,std,rsd = sw.stability()
+    names = [os.path.basename(sw.filename)] if sw.names is None else sw.names
+    if sw.names is None:
+        ave,std,rsd = ave[None],std[None],rsd[None]
+    out = ''
+    for k,name in enumerate(names):
+        start,end = sw.best(None if sw.names is None else k)
+        out += '\n%s: %d windows, best R-square from %g to %g nm\n' % (
+               name,np.count_nonzero(sw.NPT),start,end)
+        out += '    PIGMENT       MEAN (mg/kg)  STD (mg/kg)   RSD\n'
+        for p,a,s,r in zip(sw.PIGMENTS,ave[k],std[k],rsd[k]):
+            out += '%-12s  %12.4g %12.4g %6.1f%%\n' % (p,a,s,100*r)
+    return out
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec sweep',
+        description='Deconvolution of EVOO spectra over a grid of spectral windows',
+        epilog='With --baseline-model poly, rubberband or als, or with --savgol, every '
+               'window is pre-processed and deconvolved on its own (a full '
+               'deconvolution per window, much slower than the other sweeps).')
+    parser.add_argument('samples',nargs='+',
+        help='sample files, directories or glob patterns (.csv, .xls, .xlsx)')
+    parser.add_argument('--start',type=parseRange,required=True,
+        help='start wavelengths of the windows: first:last:step (nm) or a list')
+    parser.add_argument('--end',type=parseRange,required=True,
+        help='end wavelengths of the windows: first:last:step (nm) or a list')
+    parser.add_argument('--min-points',type=int,default=None,
+        help='smallest number of points of a window (default: number of pigments + 1)')
+    batch.addOptionArgs(parser)
+    return parser.parse_args(argv)
+
+
+# >>> Entry point of the window sweep
+def main(argv=None):
+    args = parseArgs(argv)
+    log  = lambda msg: sys.stderr.write(msg)
+
+    files = batch.findSamples(args.samples)
+    if not files:
+        sys.stderr.write("No sample files found!\n")
+        return 1
+
+    ref  = engine.loadRef(args.ref)
+    opts = batch.optionsFromArgs(args,ref)
+    PIGMENTS = [p for p,f in zip(ref.PIGMENTS,opts.mask(len(ref.PIGMENTS))) if f]
+
+    out = sys.stdout if args.output == '-' else open(args.output,'w')
+    events = batch.openEvents(args)
+    try:
+        writeHeader(PIGMENTS,out)
+        for f in files:
+            try:
+                evoo = engine.loadEVOO(f,wide=args.wide)
+                sw   = engine.sweepWindows(ref,evoo,args.start,args.end,opts,
+                                           min_points=args.min_points)
+            except Exception as e:
+                log("%s: %s\n" % (f,e))
+                continue
+            writeSweep(sw,out)
+            log(formatStability(sw))
+    finally:
+        if out is not sys.stdout: out.close()
+        batch.writeMetrics(args,events,log)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,305 @@
+"""
+EVOODec watch - streaming deconvolution of spectra as they are acquired
+
+Monitors the output directory of the instrument (or reads framed spectra
+from the standard input) and pushes every new spectrum through a pipeline
+of generators:
+
+    parse -> window/resample -> deconvolve -> emit
+
+Each stage runs in its own thread and hands its records to the next one
+through a bounded queue: when a stage falls behind, the previous ones block
+(backpressure) instead of piling up spectra in memory.
+
+Usage:
+    python evoodec.py watch -r pigments/pigments.csv /path/to/instrument/output
+    reader | python evoodec.py watch -r pigments/pigments.csv -
+
+On the standard input the spectra use the CSV format of the sample files
+(wavelength;absorbance) and are separated by an empty line. An optional
+comment line "#sample: <id>" sets the sample id of the frame. With --wide
+every column after the wavelength is a sample (files and frames). A frame
+whose wavelengths are not strictly monotonic (two spectra without the empty
+line between them) is reported as an error.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os, sys
+import time
+import queue
+import argparse
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+import engine
+import batch
+from metrics import METRICS
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+_STOP = object()   # End of stream marker
+
+
+class Record:
+
+    # Spectrum flowing through the pipeline
+    #   name, filename : sample id and source file
+    #   evoo           : parsed spectrum (engine.Spectrum)
+    #   proc           : pre-processed spectra (engine.processSpectra)
+    #   result         : deconvolution result (engine.Result)
+    #   error          : error raised by any of the stages
+    #   t0             : time the spectrum was detected
+    #   stages         : time spent in each processing stage (s)
+    def __init__(self,name,filename='',evoo=None):
+        self.name     = name
+        self.filename = filename
+        self.evoo     = evoo
+        self.proc     = None
+        self.result   = None
+        self.error    = None
+        self.t0       = time.time()
+        self.stages   = {}
+
+    # Add the stage timings of the with block to the record
+    @contextmanager
+    def timed(self):
+        with METRICS.collect() as m:
+            yield
+        for stage,t in m.stageTimes().items():
+            self.stages[stage] = self.stages.get(stage,0.0)+t
+
+
+class _Failure:
+
+    # Exception raised by a stage thread, re-raised by the consumer
+    def __init__(self,error):
+        self.error = error
+
+
+# >>> Run a generator in its own thread, feeding a bounded queue.
+# The producer blocks when maxsize items are waiting to be consumed.
+def bounded(gen,maxsize=16):
+    q = queue.Queue(maxsize)
+
+    def run():
+        try:
+            for item in gen:
+                q.put(item)
+        except BaseException as e:
+            q.put(_Failure(e))
+        finally:
+            q.put(_STOP)
+
+    threading.Thread(target=run,daemon=True).start()
+    while True:
+        item = q.get()
+        if item is _STOP:
+            return
+        if isinstance(item,_Failure):
+            raise item.error
+        yield item
+
+
+# >>> Yield the sample files written in a directory.
+# A file is yielded once its size and modification time did not change
+# between two polls (the instrument finished writing it), and yielded
+# again only if it is rewritten. Files already present are skipped unless
+# existing is True.
+def watchDirectory(path,interval=0.2,existing=False,stop=None):
+    if stop is None: stop = threading.Event()
+
+    def scan():
+        found = {}
+        for entry in os.scandir(path):
+            if(entry.is_file() and
+               os.path.splitext(entry.name)[1].lower() in batch.EXTENSIONS):
+                st = entry.stat()
+                found[entry.path] = (st.st_size,st.st_mtime_ns)
+        return found
+
+    seen    = {} if existing else scan()
+    pending = {}
+    while not stop.is_set():
+        for filename,sig in sorted(scan().items()):
+            if seen.get(filename) == sig:
+                continue
+            if pending.get(filename) == sig and sig[0] > 0:
+                seen[filename] = sig
+                del pending[filename]
+                yield filename
+            else:
+                pending[filename] = sig
+        stop.wait(interval)
+
+
+# >>> Yield the spectra framed on a stream (separated by empty lines)
+def readFrames(stream,wide=False):
+    lines = []
+    name  = None
+    count = 0
+    for line in stream:
+        if line.strip():
+            if line.lower().startswith('#sample:'):
+                name = line.split(':',1)[1].strip()
+            else:
+                lines.append(line)
+            continue
+        if lines:
+            count += 1
+            yield _frame(lines,name,count,wide)
+        lines = []
+        name  = None
+    if lines:
+        count += 1
+        yield _frame(lines,name,count,wide)
+
+def _frame(lines,name,count,wide=False):
+    if not name: name = 'stdin:%d' % count
+    rec = Record(name,'-')
+    try:
+        with rec.timed(), METRICS.span('parse',source='stream'):
+            rec.evoo = engine.parseCSV(lines,'-',wide=wide)
+
+        # A missing blank line merges two spectra in one frame: the
+        # wavelength goes back at the start of the second one
+        dx = np.diff(rec.evoo.X)
+        if not (np.all(dx > 0) or np.all(dx < 0)):
+            raise Exception("Frame %d (%s): wavelengths are not strictly monotonic "
+                            "(missing blank line between two spectra?)!" % (count,name))
+    except Exception as e:
+        rec.evoo  = None
+        rec.error = e
+    return rec
+
+
+# >>> Pipeline stages
+def parseStage(files,wide=False):
+    for filename in files:
+        rec = Record(os.path.basename(filename),filename)
+        try:
+            with rec.timed():
+                rec.evoo = engine.loadEVOO(filename,wide=wide)
+        except Exception as e:
+            rec.error = e
+        yield rec
+
+def preprocessStage(records,ref,opts):
+    for rec in records:
+        if rec.error is None:
+            try:
+                with rec.timed():
+                    rec.proc = engine.processSpectra(ref,rec.evoo,opts)
+            except Exception as e:
+                rec.error = e
+        yield rec
+
+def deconvolveStage(records,ref,opts):
+    for rec in records:
+        if rec.error is None:
+            try:
+                with rec.timed():
+                    rec.result = engine.fitSpectra(ref,rec.proc,opts,
+                        filename=rec.filename,names=rec.evoo.names)
+            except Exception as e:
+                rec.error = e
+        yield rec
+
+
+# >>> Build the pipeline on a stream of records
+def pipeline(records,ref,opts,maxsize=16):
+    records = bounded(records,maxsize)
+    records = bounded(preprocessStage(records,ref,opts),maxsize)
+    records = bounded(deconvolveStage(records,ref,opts),maxsize)
+    return records
+
+
+# >>> Emit the results of a record as rows of the results table (and its
+# timings as an event of the structured log, if any)
+def emit(rec,ref,out,log=None,events=None,ci=False,db=None):
+    if rec.error is None:
+        name = None if rec.evoo.isBatch() else rec.name
+        rows = batch.resultRows(rec.result,name,rec.evoo.files,rec.evoo.members)
+    else:
+        METRICS.inc('errors_total')
+        rows = batch.errorRows(ref,rec.filename,rec.error,rec.name)
+    for row in rows:
+        batch.writeRow(row,out,ci)
+    out.flush()
+    if db is not None:
+        db[0].insertRows(db[1],rows)
+    latency = time.time()-rec.t0
+    engine._log(log,"%s processed in %.3f s\n" % (rec.name,latency))
+    if events is not None:
+        events.write('record',sample=rec.name,file=rec.filename,samples=len(rows),
+                     latency=latency,stages=rec.stages,
+                     error=None if rec.error is None else str(rec.error))
+
+
+# >>> Command line arguments
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(prog='evoodec watch',
+        description='Deconvolve EVOO spectra as the instrument writes them')
+    parser.add_argument('source',
+        help='directory to watch, "-" to read framed spectra from standard input')
+    parser.add_argument('--interval',type=float,default=0.2,
+        help='polling interval of the directory in s (default: %(default)s)')
+    parser.add_argument('--existing',action='store_true',
+        help='also process the files already in the directory')
+    parser.add_argument('--queue-size',type=int,default=16,
+        help='maximum number of spectra waiting between two stages (default: %(default)s)')
+    batch.addStoreArgs(parser)
+    batch.addOptionArgs(parser)
+    return parser.parse_args(argv)
+
+
+# >>> Entry point of the watch mode
+def main(argv=None):
+    args = parseArgs(argv)
+    log  = lambda msg: sys.stderr.write(msg)
+
+    ref  = engine.loadRef(args.ref)
+    opts = batch.optionsFromArgs(args,ref)
+
+    if(args.source == '-'):
+        records = readFrames(sys.stdin,args.wide)
+    elif os.path.isdir(args.source):
+        files   = watchDirectory(args.source,args.interval,args.existing)
+        records = parseStage(bounded(files,args.queue_size),args.wide)
+        log("Watching %s (Ctrl+C to stop)\n" % args.source)
+    else:
+        sys.stderr.write("%s is not a directory!\n" % args.source)
+        return 1
+
+    if(args.output == '-'):
+        out = sys.stdout
+    else:
+        new = not os.path.exists(args.output) or os.path.getsize(args.output) == 0
+        out = open(args.output,'a')
+    events = batch.openEvents(args)
+    db     = batch.openStore(args,ref,opts,'watch')
+    try:
+        if(out is sys.stdout or new):
+            batch.writeHeader(ref.PIGMENTS,out,opts.CI > 0)
+        for rec in pipeline(records,ref,opts,args.queue_size):
+            emit(rec,ref,out,log,events,opts.CI > 0,db)
+            if args.metrics: METRICS.writePrometheus(args.metrics)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if out is not sys.stdout: out.close()
+        if db is not None: db[0].close()
+        batch.writeMetrics(args,events,log)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,175 @@
+"""
+EVOODec workbook - bulk reader of multi-sheet, multi-sample Excel exports
+
+Every sheet of the workbook is read row by row in streaming mode (openpyxl
+read-only mode for .xlsx, xlrd on-demand mode for .xls) and every
+absorbance column becomes a sample of a single batch of spectra:
+
+    | wavelength (nm) | sample 1 | sample 2 | ... |
+
+Rows before the first numeric wavelength are header rows: the last one
+gives the sample ids. Cells that cannot be read as numbers are reported in
+Spectrum.skipped (as Sheet!A1 references) and filled by linear
+interpolation between the neighbouring wavelengths.
+
+"""
+
+# -----------------------------------------------------------------------------
+# MODULES
+#
+
+import os
+
+import numpy as np
+
+import engine
+from metrics import METRICS
+
+
+# -----------------------------------------------------------------------------
+# CLASSES AND FUNCTIONS
+#
+
+# >>> Float value of a cell (NaN if it is not a number)
+def _toFloat(v):
+    if v is None or isinstance(v,bool):
+        return np.nan
+    try:
+        return float(v)
+    except (TypeError,ValueError):
+        return np.nan
+
+_toFloatArray = np.frompyfunc(_toFloat,1,1)
+
+
+# >>> Excel names of a column and of a cell (row and col are 0-based)
+def colName(col):
+    letters = ''
+    col += 1
+    while col:
+        col,r   = divmod(col-1,26)
+        letters = chr(65+r)+letters
+    return letters
+
+def cellName(sheet,row,col):
+    return '%s!%s%d' % (sheet,colName(col),row+1)
+
+
+# >>> Stream the rows (lists of values) of every sheet of a workbook
+def iterSheets(filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if(ext == '.xlsx'):
+        try:
+            import openpyxl
+        except ImportError:
+            openpyxl = None
+        if openpyxl is not None:
+            wb = openpyxl.load_workbook(filename,read_only=True,data_only=True)
+            try:
+                for ws in wb.worksheets:
+                    yield ws.title,(list(row) for row in ws.iter_rows(values_only=True))
+            finally:
+                wb.close()
+            return
+
+    # .xls files (and .xlsx files when openpyxl is not available)
+    import xlrd
+    wb = xlrd.open_workbook(filename,on_demand=True)
+    try:
+        for i in range(wb.nsheets):
+            sheet = wb.sheet_by_index(i)
+            yield sheet.name,(sheet.row_values(r) for r in range(sheet.nrows))
+            wb.unload_sheet(i)
+    finally:
+        wb.release_resources()
+
+
+# >>> Read one sheet: returns wavelength, absorbances (n_samples, n_points),
+# sample ids and skipped cells
+def readSheet(name,rows):
+
+    # Header rows (before the first numeric wavelength) and data rows
+    header = []
+    data   = []
+    first  = None
+    skipped = []
+    for r,row in enumerate(rows):
+        if first is None:
+            if row and not np.isnan(_toFloat(row[0])):
+                first = r
+            else:
+                if any(v not in (None,'') for v in row): header = row
+                continue
+        data.append(row)
+    if not data:
+        return None,None,[],skipped
+
+    # Convert all the cells at once (rows are padded to the same length)
+    ncols  = max(len(row) for row in data)
+    cells  = np.empty((len(data),ncols),dtype=object)
+    for i,row in enumerate(data):
+        cells[i,:len(row)] = row
+    values = _toFloatArray(cells).astype(float)
+    empty  = np.frompyfunc(lambda v: v is None or v == '',1,1)(cells).astype(bool)
+
+    # Rows without a wavelength (e.g. footers) and columns without any value
+    rows_ok = ~np.isnan(values[:,0])
+    cols_ok = ~np.isnan(values[rows_ok]).all(axis=0)
+    cols_ok[0] = False
+    for i in np.flatnonzero(~rows_ok):
+        if not empty[i].all(): skipped.append(cellName(name,first+i,0))
+    for i,j in np.argwhere(np.isnan(values)):
+        if rows_ok[i] and cols_ok[j]: skipped.append(cellName(name,first+i,j))
+
+    X   = values[rows_ok,0]
+    ABS = values[rows_ok][:,cols_ok].T
+
+    # Fill the skipped cells
+    order = np.argsort(X)
+    for k in np.flatnonzero(np.isnan(ABS).any(axis=1)):
+        ok = ~np.isnan(ABS[k,order])
+        ABS[k,order[~ok]] = np.interp(X[order[~ok]],X[order[ok]],ABS[k,order[ok]])
+    ids = []
+    for j in np.flatnonzero(cols_ok):
+        label = header[j] if j < len(header) else None
+        label = colName(j) if label in (None,'') else str(label).strip()
+        ids.append('%s:%s' % (name,label))
+    return X,ABS,ids,skipped
+
+
+# >>> Load all the samples of a workbook as a batch of spectra.
+# Sheets sampled on a different wavelength grid are interpolated on the
+# grid of the first sheet (or skipped if they do not cover it).
+def loadWorkbook(filename,log=None):
+
+    X_ALL   = None
+    ABS_ALL = []
+    names   = []
+    skipped = []
+    for name,rows in iterSheets(filename):
+        X,ABS,ids,skip = readSheet(name,rows)
+        skipped += skip
+        if X is None or not len(ids):
+            continue
+        if X_ALL is None:
+            X_ALL = X
+        elif not np.array_equal(X,X_ALL):
+            if(X.min() > X_ALL.min() or X.max() < X_ALL.max()):
+                engine._log(log,"\nSheet %s does not cover the wavelengths of the "
+                                "first sheet, it will be ignored" % name)
+                skipped.append('%s!*' % name)
+                continue
+            ABS = engine.interpolateTo(X,ABS,X_ALL)
+        ABS_ALL.append(ABS)
+        names  += ids
+
+    if X_ALL is None:
+        raise Exception("No data found in EVOO file!")
+    if skipped:
+        METRICS.inc('skipped_cells_total',len(skipped))
+        engine._log(log,"\n%d cells skipped: %s%s" % (len(skipped),
+            ', '.join(skipped[:10]),' ...' if len(skipped) > 10 else ''))
+    engine._log(log,"\n%d samples loaded from %s" % (len(names),os.path.basename(filename)))
+
+    return engine.Spectrum(X_ALL,np.vstack(ABS_ALL),filename,names=names,
+                           skipped=skipped)